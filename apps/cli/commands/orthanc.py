@@ -74,7 +74,7 @@ def pull(ctx, accession_number, worklist, source, domain, destination, anonymize
 
             if destination:
                 # If dest is DicomFile
-                dixel = S.get(dixel, view='archive')
+                dixel = S.get(dixel, view='archive', stream=True)
                 logging.debug(dixel.meta['AccessionNumber'])
                 D.put(dixel, fn_from="AccessionNumber")
                 S.remove(dixel)
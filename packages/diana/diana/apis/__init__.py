@@ -1,8 +1,9 @@
 from .orthanc import Orthanc
 from .redis import Redis
 from .meta_cache import MetaCache
-from .dixel import Dixel
+from .dixel import Dixel, CompactDixel
 from .file_handler import DicomFile, ReportFile, ImageFile
 from .splunk import Splunk
 from .report import RadiologyReport, LungScreeningReport, MammographyReport, BoneAgeReport
 from .montage import Montage
+from .worklist import Worklist
@@ -1,8 +1,9 @@
-import logging, hashlib, datetime
+import logging, hashlib, datetime, uuid, sys
 import attr
 from dateutil import parser as dtparser
 from .report import RadiologyReport
 from ..utils import Pattern, orthanc_id
+from ..utils.pattern import process_hostname
 from ..utils.dicom import DicomLevel, dicom_strfdate, dicom_strfname, DicomUIDMint
 from guidmint import PseudoMint
 
@@ -17,6 +18,7 @@ class Dixel(Pattern):
 
     # Can't pickle a logger without dill, so Dixels don't need one
     logger = attr.ib(init=False, default=None)
+    _oids = attr.ib(init=False, default=None, repr=False)   # keys -> (values, oid)
 
     def __hash__(self):
 
@@ -48,12 +50,38 @@ class Dixel(Pattern):
                     v = dtparser.parse(v)
                 self.meta[k] = v
 
+        self._oids = None
         return self
 
     @property
     def AccessionNumber(self):
         return self.meta['AccessionNumber']
 
+    # Meta keys that identify an item at each level, and their sham counterparts
+    ID_KEYS = {
+        DicomLevel.PATIENTS:  ("PatientID",),
+        DicomLevel.STUDIES:   ("PatientID", "StudyInstanceUID"),
+        DicomLevel.SERIES:    ("PatientID", "StudyInstanceUID", "SeriesInstanceUID"),
+        DicomLevel.INSTANCES: ("PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID")
+    }
+    SHAM_KEYS = {
+        DicomLevel.STUDIES:   ("ShamID", "ShamStudyUID"),
+        DicomLevel.SERIES:    ("ShamID", "ShamStudyUID", "ShamSeriesUID"),
+        DicomLevel.INSTANCES: ("ShamID", "ShamStudyUID", "ShamSeriesUID", "ShamInstanceUID")
+    }
+
+    def memo_id(self, keys):
+        # orthanc_id for these meta keys, remembered until update or set_shams.
+        # Also rechecks the values, so a direct edit to meta can't return a stale id.
+        values = tuple(self.meta[k] for k in keys)
+        if self._oids is None:
+            self._oids = {}
+        memo = self._oids.get(keys)
+        if memo is None or memo[0] != values:
+            memo = (values, orthanc_id(*values))
+            self._oids[keys] = memo
+        return memo[1]
+
     def oid(self, level: DicomLevel=None):
 
         # Stashed, may not be computable
@@ -63,29 +91,15 @@ class Dixel(Pattern):
         # Can compute any parent oid
         level = level or self.level
 
-        if level == DicomLevel.PATIENTS:
-            return orthanc_id(self.meta['PatientID'])
-        elif level == DicomLevel.STUDIES:
-            return orthanc_id(self.meta['PatientID'], self.meta['StudyInstanceUID'])
-        elif level == DicomLevel.SERIES:
-            return orthanc_id(self.meta['PatientID'], self.meta['StudyInstanceUID'],
-                              self.meta['SeriesInstanceUID'])
-        elif level == DicomLevel.INSTANCES:
-            return orthanc_id(self.meta['PatientID'], self.meta['StudyInstanceUID'],
-                              self.meta['SeriesInstanceUID'], self.meta['SOPInstanceUID'])
-        else:
+        if level not in Dixel.ID_KEYS:
             raise ValueError("No such DICOM level: {}".format(level))
+        return self.memo_id(Dixel.ID_KEYS[level])
 
     def sham_oid(self):
 
-        if self.level == DicomLevel.STUDIES:
-            return orthanc_id(self.meta['ShamID'], self.meta['ShamStudyUID'])
-        elif self.level == DicomLevel.SERIES:
-            return orthanc_id(self.meta['ShamID'], self.meta['ShamStudyUID'], self.meta['ShamSeriesUID'])
-        elif self.level == DicomLevel.INSTANCES:
-            return orthanc_id(self.meta['ShamID'], self.meta['ShamStudyUID'], self.meta['ShamSeriesUID'], self.meta['ShamInstanceUID'])
-
-        raise TypeError("Cannot create sham oid from meta")
+        if self.level not in Dixel.SHAM_KEYS:
+            raise TypeError("Cannot create sham oid from meta")
+        return self.memo_id(Dixel.SHAM_KEYS[self.level])
 
     def get_pixels(self):
         if self.meta['PhotometricInterpretation'] == "RGB":
@@ -122,4 +136,242 @@ class Dixel(Pattern):
                                                         self.meta['SeriesDescription'],
                                                         self.meta['InstanceNumber'])
 
+        self._oids = None
         return self
+
+
+class LazyMeta(dict):
+    """
+    Dixel meta that fetches tags from its source on first access to a key it
+    doesn't have yet, so a handler that only needs the oid never fetches any.
+
+    `loader(fields)` returns tags: the requested projection for a list of fields,
+    or everything for None.  A miss on one of `fields` asks for the projection
+    first; any other miss, or iterating the whole mapping, loads everything.
+    Local edits win over fetched values.
+    """
+
+    __slots__ = ("loader", "fields", "projected", "loaded")
+
+    def __init__(self, loader, initial: dict=None, fields=None):
+        super().__init__(initial or {})
+        self.loader = loader
+        self.fields = set(fields) if fields else None
+        self.projected = False
+        self.loaded = False
+
+    def load(self, key=None):
+        if self.loaded:
+            return
+        if key is not None and self.fields and not self.projected and key in self.fields:
+            tags = self.loader(sorted(self.fields))
+            self.projected = True
+        else:
+            tags = self.loader(None)
+            self.loaded = True
+        for k, v in (tags or {}).items():
+            dict.setdefault(self, k, v)
+
+    def __missing__(self, key):
+        if self.loaded:
+            raise KeyError(key)
+        self.load(key)
+        return self[key]
+
+    def get(self, key, default=None):
+        if not dict.__contains__(self, key) and not self.loaded:
+            self.load(key)
+            return self.get(key, default)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key) and not self.loaded:
+            self.load(key)
+            return key in self
+        return dict.__contains__(self, key)
+
+    # Anything that walks the whole mapping needs all of it
+
+    def __iter__(self):
+        self.load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.load()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.load()
+        return dict.keys(self)
+
+    def items(self):
+        self.load()
+        return dict.items(self)
+
+    def values(self):
+        self.load()
+        return dict.values(self)
+
+    def copy(self):
+        self.load()
+        return dict(dict.items(self))
+
+    def __reduce__(self):
+        # The source doesn't travel, so pickle it loaded, as a plain dict
+        return dict, (self.copy(),)
+
+
+class CompactDixel(Dixel):
+    """
+    Dixel for bulk inventories (find results, index searches), with the same API.
+
+    Attributes live in slots, the uid is only minted if something asks for it,
+    the hostname is shared by the process, and meta keys are interned, so a
+    million dixels share one copy of each tag name.  Note that meta is copied
+    on init, so the caller's dict is not shared.
+    """
+
+    __slots__ = ("level", "meta", "pixels", "file", "_report", "_uid", "_oids")
+
+    logger = None
+
+    def __init__(self, uid=None, level=DicomLevel.STUDIES, meta=None,
+                 pixels=None, file=None, report=None):
+        self._uid = uid
+        self.level = level
+        self.meta = {sys.intern(k) if type(k) == str else k: v
+                     for k, v in (meta or {}).items()}
+        self.pixels = pixels
+        self.file = file
+        self._report = report
+        self._oids = None
+
+    @property
+    def uid(self):
+        if self._uid is None:
+            self._uid = uuid.uuid4()
+        return self._uid
+
+    @uid.setter
+    def uid(self, value):
+        self._uid = value
+
+    @property
+    def hostname(self):
+        return process_hostname()
+
+    @property
+    def report(self):
+        # Converted on first use, as the attrs converter would
+        if not isinstance(self._report, RadiologyReport):
+            self._report = RadiologyReport(self._report)
+        return self._report
+
+    @report.setter
+    def report(self, value):
+        self._report = value
+
+    @property
+    def pattern(self):
+        return {'class': Dixel.__name__,
+                'uid': self.uid,
+                'level': self.level,
+                'meta': self.meta,
+                'pixels': self.pixels,
+                'file': self.file,
+                'report': self.report}
+
+
+def test_compact_dixel():
+
+    import pickle
+
+    meta = {"PatientID": "abc", "StudyInstanceUID": "1.2.3",
+            "AccessionNumber": "12345", "StudyDate": "20180101"}
+    d = Dixel(meta=dict(meta), level=DicomLevel.STUDIES)
+    c = CompactDixel(meta=dict(meta), level=DicomLevel.STUDIES)
+
+    assert isinstance(c, Dixel)
+    assert not hasattr(c, "__dict__") or not c.__dict__
+    assert c.oid() == d.oid()
+    assert c.AccessionNumber == "12345"
+    assert hash(c) == hash(d)
+    assert c.hostname == d.hostname
+
+    # Keys are shared between instances
+    e = CompactDixel(meta={"".join(["Patient", "ID"]): "def"})
+    assert next(iter(e.meta)) is next(iter(c.meta))
+
+    c.update(Dixel(meta={"StudyDate": "20180102", "StudyDateTime": "20180102"},
+                   level=DicomLevel.STUDIES))
+    assert c.meta["StudyDateTime"] == datetime.datetime(2018, 1, 2)
+
+    # Uid is minted lazily, but stable once it is
+    uid = c.uid
+    assert c.uid == uid
+    f = pickle.loads(pickle.dumps(c))
+    assert f.uid == uid and f.meta == c.meta and f.level == c.level
+
+    assert c.report.text is None
+    assert c.pattern["meta"] is c.meta
+
+
+def test_oid_memo():
+
+    d = Dixel(meta={"PatientID": "abc", "StudyInstanceUID": "1.2.3"}, level=DicomLevel.STUDIES)
+    oid = d.oid()
+    assert oid == orthanc_id("abc", "1.2.3")
+    assert d._oids and d.oid() is oid
+    assert d.oid(DicomLevel.PATIENTS) == orthanc_id("abc")
+
+    # Invalidated by update
+    d.update(Dixel(meta={"StudyInstanceUID": "1.2.4"}, level=DicomLevel.STUDIES))
+    assert d._oids is None
+    assert d.oid() == orthanc_id("abc", "1.2.4")
+
+    # And never stale, even after a direct edit
+    d.meta["PatientID"] = "def"
+    assert d.oid() == orthanc_id("def", "1.2.4")
+
+    d.meta.update({"ShamID": "xyz", "ShamStudyUID": "9.8.7"})
+    assert d.sham_oid() == orthanc_id("xyz", "9.8.7")
+
+    c = CompactDixel(meta=d.meta, level=DicomLevel.STUDIES)
+    assert c.oid() == d.oid() and c.sham_oid() == d.sham_oid()
+
+
+def test_lazy_meta():
+
+    import pickle
+
+    calls = []
+
+    def loader(fields):
+        calls.append(fields)
+        if fields:
+            return {"AccessionNumber": "12345"}
+        return {"AccessionNumber": "12345", "PatientID": "abc", "StudyInstanceUID": "1.2.3"}
+
+    d = Dixel(meta=LazyMeta(loader, {"oid": "xyz"}, fields=["AccessionNumber"]),
+              level=DicomLevel.STUDIES)
+
+    # Only the oid is needed, nothing is fetched
+    assert d.oid() == "xyz"
+    repr(d)
+    assert not calls
+
+    # A requested field fetches the projection
+    assert d.AccessionNumber == "12345"
+    assert calls == [["AccessionNumber"]]
+
+    # Anything else fetches everything, once
+    assert d.meta.get("PatientID") == "abc"
+    assert d.meta.get("Missing") is None and "Missing" not in d.meta
+    assert len(calls) == 2
+
+    d.meta["PatientID"] = "def"
+    assert sorted(d.meta) == ["AccessionNumber", "PatientID", "StudyInstanceUID", "oid"]
+    assert d.oid(DicomLevel.STUDIES) == orthanc_id("def", "1.2.3")
+
+    e = pickle.loads(pickle.dumps(d))
+    assert type(e.meta) == dict and e.meta == d.meta
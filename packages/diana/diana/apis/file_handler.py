@@ -1,7 +1,9 @@
 import os, time
+from functools import partial
 from typing import Union, Sequence
 import attr
 from diana.apis import Dixel
+from diana.apis.dixel import LazyMeta
 from diana.utils import Pattern, gateway
 from diana.utils.dicom import DicomLevel, dicom_strpdtime
 
@@ -100,7 +102,7 @@ class DicomFile(Pattern):
 
     def remove(self, item: Dixel, path: str=None):
 
-        if type(item) == Dixel:
+        if isinstance(item, Dixel):
             fn = item.meta['FileName']
             path = item.meta['FilePath']
         else:
@@ -109,16 +111,25 @@ class DicomFile(Pattern):
         return self.gateway.remove(fn, path=path)
 
 
-    def get(self, item: Union[str, Dixel], path: str=None, view: str="tags") -> Dixel:
-        # print("getting")
+    def get(self, item: Union[str, Dixel], path: str=None, view: str="tags", stream: bool=False,
+            fields: Sequence[str]=None) -> Dixel:
+        # With stream, a "file" view dixel carries the file path rather than its
+        # bytes, and Orthanc.put or DicomFile.put send it straight from disk.
+        # The "lazy" view returns a dixel that only reads the file when its meta
+        # is read, and then only the `fields` elements if that's all it needs.
 
         # Get needs to accept oid's or items with oid's
-        if type(item) == Dixel:
+        if isinstance(item, Dixel):
             fn = item.meta['FileName']
             path = item.meta['FilePath']
         else:
             fn = item
 
+        if view == "lazy":
+            return Dixel(level=DicomLevel.INSTANCES,
+                         meta=LazyMeta(partial(self.read_tags, fn, path),
+                                       {'FileName': fn, 'FilePath': path}, fields))
+
         dcm, fp = self.gateway.read(fn, path=path, pixels=(view=="pixels"))
 
         # Core data required for shamming
@@ -155,9 +166,24 @@ class DicomFile(Pattern):
             _pixels = dcm.pixel_array
 
         _file = None
-        if view=="file":
+        if view=="file" and stream:
+            _file = fp
+        elif view=="file":
             with open(fp, 'rb') as f:
                 _file = f.read()
 
         item = Dixel(level=DicomLevel.INSTANCES, meta=_meta, pixels=_pixels, file=_file)
         return item
+
+    def read_tags(self, fn: str, path: str=None, fields: Sequence[str]=None) -> dict:
+        if not fields:
+            return self.get(fn, path=path, view="tags").meta
+
+        dcm, fp = self.gateway.read(fn, path=path, tags=fields)
+        tags = {'FullPath': fp}
+        for k in fields:
+            v = getattr(dcm, k, None)
+            if v is not None:
+                # PersonNames and the like, as `get` does
+                tags[k] = v if isinstance(v, (str, int, float)) else str(v)
+        return tags
@@ -1,26 +1,98 @@
 """
 Reads dixel meta and reports from or writes to a csv file
+
+With a `store`, items are kept in an indexed sqlite file instead of a dict,
+so multi-million row worklists don't have to fit in memory, and changes are
+written as they're made rather than by a full `dump`.
+
+>>> pull_list = MetaCache(location="montage.csv", store="/data/pull_list.db")
+>>> pull_list.load(keymap=MetaCache.montage_keymap)
+>>> d = pull_list.select_random()
 """
 
 import random
-from csv import DictReader, DictWriter
-from typing import Union, Mapping
+from contextlib import contextmanager
+from csv import DictWriter, reader as csv_reader
+from datetime import datetime
+from itertools import islice
+from typing import Union, Mapping, Iterator, List, Sequence
 from dateutil import parser as dtparser
 import attr
-from ..utils import Pattern
+from ..utils import Pattern, MetaStore
 from ..utils.smart_encode import stringify
 from ..utils.dicom import DicomLevel, dicom_strpdate
-from .dixel import Dixel
+from .dixel import Dixel, CompactDixel
 import os
 
 from pprint import pprint, pformat
 
+@attr.s
+class DateParser(object):
+    """
+    Parses one csv column's dates with a single fixed format, worked out from a
+    sample of the column, and remembers what it has parsed (worklist dates repeat
+    a lot).  Values the format doesn't fit fall back to dateutil, as before.
+    """
+    fmt = attr.ib( default=None )
+    memo = attr.ib( init=False, factory=dict, repr=False )
+    memo_size = attr.ib( default=100000 )
+
+    # Tried in order, so month-first as dateutil would read them
+    FORMATS = ["%Y-%m-%d", "%Y%m%d", "%m/%d/%Y", "%m/%d/%y",
+               "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y%m%d%H%M%S",
+               "%m/%d/%Y %H:%M", "%m/%d/%Y %H:%M:%S",
+               "%m/%d/%Y %I:%M %p", "%m/%d/%Y %I:%M:%S %p"]
+
+    @classmethod
+    def for_values(cls, values: Sequence[str]) -> "DateParser":
+        for fmt in cls.FORMATS:
+            try:
+                for v in values:
+                    datetime.strptime(v, fmt)
+                return cls(fmt=fmt)
+            except ValueError:
+                continue
+        return cls()
+
+    @staticmethod
+    def fallback(v: str):
+        try:
+            return dtparser.parse(v)
+        except ValueError:
+            try:
+                return dicom_strpdate(v)
+            except:
+                raise ValueError("No date can be parsed from {}".format(v))
+
+    def __call__(self, v: str):
+        result = self.memo.get(v)
+        if result is None:
+            if self.fmt:
+                try:
+                    result = datetime.strptime(v, self.fmt)
+                except ValueError:
+                    pass
+            if result is None:
+                result = self.fallback(v)
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+            self.memo[v] = result
+        return result
+
+
 # Doesn't really need to be patternable
 @attr.s
 class MetaCache(Pattern):
     location = attr.ib( default=None )
-    cache = attr.ib( init=False, factory=dict )
     key_field = attr.ib( default="AccessionNumber" )
+    store = attr.ib( default=None )    # sqlite file for an on-disk cache, or None for a dict
+    cache = attr.ib( init=False )
+
+    @cache.default
+    def make_cache(self):
+        if self.store:
+            return MetaStore(location=self.store)
+        return dict()
 
     montage_keymap = {
         "Accession Number": "AccessionNumber",
@@ -63,7 +135,7 @@ class MetaCache(Pattern):
     def get(self, item: Union[Dixel, str], **kwargs):
 
         # Get needs to accept oid's or items with oid's
-        if type(item) == Dixel:
+        if isinstance(item, Dixel):
             id = item.uid
         elif type(item) == str or type(item) == tuple:
             id = item
@@ -71,6 +143,9 @@ class MetaCache(Pattern):
             raise ValueError("Can not get type {}!".format(type(item)))
 
         meta = self.cache.get( id )
+        return self.dixel_from( meta )
+
+    def dixel_from(self, meta: dict, cls=Dixel) -> Dixel:
         # self.logger.debug(meta)
         if type( meta.get("_level") ) == DicomLevel:
             level = meta.get("_level")
@@ -81,12 +156,12 @@ class MetaCache(Pattern):
         report = meta.get('_report')
         uid    = meta.get('_uid')
 
-        item = Dixel( uid=uid, meta=meta, level=level, report=report )
+        item = cls( uid=uid, meta=meta, level=level, report=report )
         return item
 
     def remove(self, item: Union[Dixel, str] ):
 
-        if type(item) == Dixel:
+        if isinstance(item, Dixel):
             id = item.id
         elif type(item) == str:
             id = item
@@ -103,51 +178,82 @@ class MetaCache(Pattern):
             meta['_report'] = item.report
         self.cache[self.did(meta)] = meta
 
-    def load(self, fp: str=None, level=DicomLevel.STUDIES, keymap: Mapping=None):
+    def load(self, fp: str=None, level=DicomLevel.STUDIES, keymap: Mapping=None, chunk_size: int=10000):
         fp = fp or self.location
         self.logger.debug("loading {}".format(os.path.split(fp)[-1]))
 
-        def remap_keys(item):
-            ret = {}
-            # Only take kv's that are in the remapper
-            for k, v in keymap.items():
-                vv = item.get(k)
-                if vv:
-                    ret[v] = vv
-            return ret
+        for rows in self.iter_rows(fp, level=level, keymap=keymap, chunk_size=chunk_size):
+            # A commit per chunk when on disk
+            with self.transaction():
+                for item in rows:
+                    self.cache[self.did(item)] = item
+
+    def iter_load(self, fp: str=None, level=DicomLevel.STUDIES, keymap: Mapping=None,
+                  chunk_size: int=10000) -> Iterator[List[Dixel]]:
+        # Yields lists of (compact) dixels without caching them, so a csv of any
+        # size can be worked through in bounded memory
+        fp = fp or self.location
+        for rows in self.iter_rows(fp, level=level, keymap=keymap, chunk_size=chunk_size):
+            yield [self.dixel_from(item, CompactDixel) for item in rows]
+
+    @staticmethod
+    def iter_rows(fp: str, level=DicomLevel.STUDIES, keymap: Mapping=None,
+                  chunk_size: int=10000, sample_size: int=100) -> Iterator[List[dict]]:
 
         # This encoding seems to fix a lot of Montage read errors
         # - https://stackoverflow.com/questions/33819557/unicodedecodeerror-utf-8-codec-while-reading-a-csv-file
-        with open(fp, encoding="cp1252") as f:
+        with open(fp, encoding="cp1252", newline="") as f:
         # with open(fp, encoding="UTF8") as f:
-            reader = DictReader(f)
-
-            for item in reader:
-                if keymap:
-                    item = remap_keys(item)
-                if not item.get("_level"):
-                    item["_level"] = level
-                else:
-                    item["_level"] = DicomLevel.of(item.get("_level"))
-
-                for k, v in item.items():
-                    # if this k is a "date", normalize it
-                    if v and \
-                            (k.lower().find("date") >= 0 or \
-                            k.lower().find("dob") >= 0 ):
-                        try:
-                            # self.logger.debug(v)
-                            item[k] = dtparser.parse(v)
-                        except ValueError:
-                            try:
-                                item[k] = dicom_strpdate(v)
-                            except:
-                                raise ValueError("No date can be parsed from {}".format(v))
-
-                # self.logger.debug( pformat( dict(item) ))
-
-                self.cache[self.did(item)] = dict(item)
-
+            reader = csv_reader(f)
+            header = next(reader, None)
+            if not header:
+                return
+
+            # Remap once, by column: only take columns that are in the remapper
+            if keymap:
+                columns = [(i, keymap[k]) for i, k in enumerate(header) if k in keymap]
+            else:
+                columns = list(enumerate(header))
+
+            # if this k is a "date", normalize it
+            date_keys = [k for i, k in columns
+                         if k.lower().find("date") >= 0 or k.lower().find("dob") >= 0]
+            parsers = None
+            levels = {}
+
+            while True:
+                chunk = list(islice(reader, chunk_size))
+                if not chunk:
+                    return
+
+                rows = []
+                for row in chunk:
+                    if keymap:
+                        item = {k: row[i] for i, k in columns if i < len(row) and row[i]}
+                    else:
+                        item = {k: row[i] if i < len(row) else None for i, k in columns}
+                    rows.append(item)
+
+                if parsers is None:
+                    # Each date column's format is worked out once, from a sample
+                    parsers = {k: DateParser.for_values(
+                                   [r[k] for r in rows if r.get(k)][:sample_size])
+                               for k in date_keys}
+
+                for item in rows:
+                    for k, parser in parsers.items():
+                        v = item.get(k)
+                        if v:
+                            item[k] = parser(v)
+                    v = item.get("_level")
+                    if not v:
+                        item["_level"] = level
+                    else:
+                        if v not in levels:
+                            levels[v] = DicomLevel.of(v)
+                        item["_level"] = levels[v]
+
+                yield rows
 
     def dump(self, fp=None, fieldnames=None, extra_fieldnames=[]):
         self.logger.debug("dumping")
@@ -185,15 +291,44 @@ class MetaCache(Pattern):
 
                 writer.writerow(w)
 
+    @contextmanager
+    def transaction(self):
+        # One commit for a batch of puts/removes when on disk
+        if isinstance(self.cache, MetaStore):
+            with self.cache.transaction():
+                yield
+        else:
+            yield
+
     def select_random(self, remove=True):
+        if isinstance(self.cache, MetaStore):
+            if remove:
+                key, meta = self.cache.pop_random()
+                return self.dixel_from(meta)
+            return self.get(self.cache.random_key())
+
         key = random.choice(tuple(self.cache.keys()))
         dixel = self.get(key)
         if remove:
             self.remove(key)
         return dixel
 
+    def find(self, **criteria):
+        # By indexed fields when on disk, ie, find(PatientID="abc").  Values
+        # compare as MetaStore columns do in memory too: as strings, with
+        # datetimes matching on their date, so find(StudyDate=date(2018, 1, 1))
+        # finds a 10:30 study either way
+        if isinstance(self.cache, MetaStore):
+            for key, meta in self.cache.find(**criteria):
+                yield self.dixel_from(meta)
+            return
+        criteria = {k: MetaStore.column_value(v) for k, v in criteria.items()}
+        for meta in list(self.cache.values()):
+            if all(MetaStore.column_value(meta.get(k)) == v for k, v in criteria.items()):
+                yield self.dixel_from(meta)
+
     def __len__(self):
-        return len(self.cache.keys())
+        return len(self.cache)
 
     def __iter__(self):
         # self.logger.debug("Setting iterator = cache.keys()")
@@ -209,5 +344,41 @@ class MetaCache(Pattern):
         # self.logger.debug(self.did(other.meta))
         # self.logger.debug(self.cache.keys())
 
-        return self.did(other.meta) in self.cache.keys()
+        return self.did(other.meta) in self.cache
+
+
+
+def test_meta_cache_load():
+
+    import tempfile, csv
+
+    fp = os.path.join(tempfile.mkdtemp(), "montage.csv")
+    with open(fp, "w", newline="", encoding="cp1252") as f:
+        w = csv.writer(f)
+        w.writerow(["Accession Number", "Patient MRN", "Exam Completed Date", "Organization", "Unmapped"])
+        for i in range(25):
+            w.writerow(["A{:03d}".format(i), "P{}".format(i % 4),
+                        "{}/{}/2018 10:30".format(i % 12 + 1, i % 28 + 1), "", "x"])
+        # Off-format dates still parse, the slow way
+        w.writerow(["A999", "P0", "Jan 5, 2018", "", "x"])
+
+    m = MetaCache(location=fp)
+    m.load(keymap=MetaCache.montage_keymap, chunk_size=10)
+    assert len(m) == 26
+    d = m.get("A013")
+    assert d.meta["StudyDate"] == datetime(2018, 2, 14, 10, 30)
+    assert "Organization" not in d.meta and "Unmapped" not in d.meta
+    assert d.level == DicomLevel.STUDIES
+    assert m.get("A999").meta["StudyDate"] == datetime(2018, 1, 5)
+
+    # Matches on the date, as a MetaStore index would
+    for when in (datetime(2018, 2, 14), datetime(2018, 2, 14, 10, 30), datetime(2018, 2, 14).date()):
+        assert [e.meta["AccessionNumber"] for e in m.find(StudyDate=when)] == ["A013"]
+
+    chunks = list(m.iter_load(keymap=MetaCache.montage_keymap, chunk_size=10))
+    assert [len(c) for c in chunks] == [10, 10, 6]
+    assert chunks[1][3].meta == d.meta
 
+    parser = DateParser.for_values(["20180101", "20181231"])
+    assert parser.fmt == "%Y%m%d"
+    assert parser("20180704") is parser("20180704")
@@ -14,6 +14,7 @@ class Montage(Pattern):
     path = attr.ib( default="api/v1" )
     user = attr.ib( default="montage" )
     password = attr.ib( default="montage" )
+    pool_size = attr.ib( default=10 )
     gateway = attr.ib( init=False )
 
     domains = attr.ib( factory=dict )  # Mapping of domain name -> retreive destination names
@@ -21,7 +22,8 @@ class Montage(Pattern):
     @gateway.default
     def connect(self):
         return gateway.Montage(host=self.host, port=self.port, path=self.path,
-                               user=self.user, password=self.password)
+                               user=self.user, password=self.password,
+                               pool_size=self.pool_size)
 
     def __attrs_post_init__(self):
         indices = self.gateway.get("index")
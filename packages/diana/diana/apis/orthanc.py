@@ -1,13 +1,16 @@
 # DICOM node or proxy
 
 import datetime
+from functools import partial
 from pprint import pformat
-from typing import Mapping, Callable, Union
+from collections import OrderedDict
+from typing import Mapping, Callable, Union, Iterable, List
 import attr
 from requests import ConnectionError
-from ..utils import Pattern, gateway
+from ..utils import Pattern, TieredCache, gateway, orthanc_id
+from ..utils.gateway import OrthancJob
 from ..utils.dicom import DicomLevel, dicom_clean_tags, dicom_strfdate, dicom_strpdate, dicom_strpdtime
-from .dixel import Dixel
+from .dixel import Dixel, CompactDixel, LazyMeta
 from diana.utils import update_json_file
 
 
@@ -39,6 +42,58 @@ def simple_sham_map(meta):
     return map
 
 
+def find_item_query(item: Dixel) -> dict:
+    # Usually want to mask the dixel data to just AccessionNumber to isolate a study, or
+    # AccessionNumber and SeriesDescription to isolate a series, if possible
+
+    q = {}
+    keys = {}
+
+    # All levels have these
+    keys[DicomLevel.STUDIES] = ['PatientID',
+                                'PatientName',
+                                'PatientBirthDate',
+                                'PatientSex',
+                                'StudyInstanceUID',
+                                'StudyDate',
+                                'StudyTime',
+                                'AccessionNumber']
+
+    # Series level has these
+    keys[DicomLevel.SERIES] = keys[DicomLevel.STUDIES] + \
+                              ['SeriesInstanceUID',
+                               'SeriesDescription',
+                               'ProtocolName',
+                               'SeriesNumber',
+                               'NumberOfSeriesRelatedInstances',
+                               'Modality']
+
+    # For instance level, use the minimum
+    keys[DicomLevel.INSTANCES] = ['SOPInstanceUID', 'SeriesInstanceUID']
+
+    def add_key(q, key, dixel):
+        q[key] = dixel.meta.get(key, '')
+        return q
+
+    for k in keys[item.level]:
+        q = add_key(q, k, item)
+
+    if item.level == DicomLevel.STUDIES and item.meta.get('Modality'):
+        q['ModalitiesInStudy'] = item.meta.get('Modality')
+
+    return q
+
+
+def answer2dixel(d: dict, level: DicomLevel) -> Dixel:
+    d['StudyDateTime'] = dicom_strpdtime(d['StudyDate'] + d['StudyTime'])
+    try:
+        d['PatientBirthDate'] = dicom_strpdate(d['PatientBirthDate'])
+    except:
+        # No patient birthdate discovered
+        pass
+    return CompactDixel(meta=d, level=level)
+
+
 @attr.s(hash=False)
 class Orthanc(Pattern):
     host = attr.ib( default="localhost" )
@@ -46,14 +101,42 @@ class Orthanc(Pattern):
     path = attr.ib( default=None )
     user = attr.ib( default="orthanc" )
     password = attr.ib( default="orthanc" )
+    pool_size = attr.ib( default=10 )
+    max_concurrency = attr.ib( default=10 )  # In-flight limit for the *_async handlers
+    send_batch_size = attr.ib( default=100 ) # Resources per store request in send_batch
+    page_size = attr.ib( default=1000 )      # Ids per request when walking the inventory
     gateway = attr.ib( init=False )
+    _agateway = attr.ib( init=False, default=None, repr=False )
 
     domains = attr.ib( factory=dict )  # Mapping of domain name -> retrieve destination names
 
+    # Read-through cache of cleaned tags, configured with TieredCache kwargs,
+    # ie, {"maxsize": 10000, "ttl": 86400, "location": "/var/cache/diana/tags.db"}
+    tag_cache = attr.ib( default=None )
+    tag_cache_levels = attr.ib( default=(DicomLevel.SERIES, DicomLevel.INSTANCES) )
+    cache = attr.ib( init=False, repr=False )
+
+    @cache.default
+    def make_cache(self):
+        if self.tag_cache is None:
+            return None
+        return TieredCache(**self.tag_cache)
+
     @gateway.default
     def connect(self):
         return gateway.Orthanc(host=self.host, port=self.port, path=self.path,
-                               user=self.user, password=self.password)
+                               user=self.user, password=self.password,
+                               pool_size=self.pool_size)
+
+    @property
+    def agateway(self):
+        # Only created when a caller opts into the async handlers
+        if self._agateway is None:
+            self._agateway = gateway.AsyncOrthanc(host=self.host, port=self.port, path=self.path,
+                                                  user=self.user, password=self.password,
+                                                  pool_size=self.pool_size,
+                                                  max_concurrency=self.max_concurrency)
+        return self._agateway
 
     config_fp = attr.ib( default="/etc/orthanc/orthanc.json" )
     new_config = attr.ib( factory=dict )
@@ -72,10 +155,10 @@ class Orthanc(Pattern):
     def add_domain(self, domain: str, retrieve_dest: str=None ):
         self.domains[domain] = retrieve_dest
 
-    def get(self, item: Union[str, Dixel], level: DicomLevel=DicomLevel.STUDIES, view: str="tags") -> Dixel:
+    def item_ref(self, item: Union[str, Dixel], level: DicomLevel):
 
         # Get needs to accept oid's or items with oid's
-        if type(item) == Dixel:
+        if isinstance(item, Dixel):
             oid = item.oid()
             level = item.level
             meta = item.meta
@@ -85,24 +168,12 @@ class Orthanc(Pattern):
         else:
             raise ValueError("Can not get type {}!".format(type(item)))
 
-        self.logger.debug("{}: getting {}".format(self.__class__.__name__, oid))
-
-        if view=="instance_tags":
-            result = self.get(oid, level, view="meta")
-            oid = result['Instances'][0]
-            view = "tags"
-            level = DicomLevel.INSTANCES
-            # Now get tags as normal
+        return oid, level, meta
 
-        # print(oid)
-        result = self.gateway.get_item(oid, level, view=view)
+    def item_from(self, result, meta: Mapping, level: DicomLevel, view: str):
         if view == "tags":
             # We can clean tags and assemble a dixel
-            result = dicom_clean_tags(result)
-            item = Dixel(meta=result, level=level)
-            if hasattr(self, 'get_metadata'):
-                item = self.get_metadata(item)
-            return item
+            return self.tags2dixel(dicom_clean_tags(result), level)
         elif view == "file" or \
              view == "archive":
             # We can assemble a dixel with a file
@@ -112,7 +183,122 @@ class Orthanc(Pattern):
             # Return the top level info or binary data
             return result
 
+    def tags2dixel(self, tags: Mapping, level: DicomLevel) -> Dixel:
+        item = Dixel(meta=tags, level=level)
+        if hasattr(self, 'get_metadata'):
+            item = self.get_metadata(item)
+        return item
+
+    # Tag cache
+
+    def tags_key(self, oid: str, level: DicomLevel) -> tuple:
+        return self.location, str(level), oid, "tags"
+
+    def tags_group(self, oid: str) -> str:
+        return "{}|{}".format(self.location, oid)
+
+    def parent_groups(self, tags: Mapping, level: DicomLevel) -> list:
+        # The patient, study and series above a resource, so removing any of
+        # them uncaches it too
+        ids = [tags.get(k) for k in ("PatientID", "StudyInstanceUID", "SeriesInstanceUID")]
+        groups = []
+        for n in range(1, min(level.value, 3) + 1):
+            if not all(ids[:n]):
+                break
+            groups.append(self.tags_group(orthanc_id(*ids[:n])))
+        return groups
+
+    def caching(self, level: DicomLevel) -> bool:
+        return self.cache is not None and level in self.tag_cache_levels
+
+    def needs_stable(self, level: DicomLevel) -> bool:
+        # Series and study tags can change until Orthanc marks them stable,
+        # instances never change
+        return self.caching(level) and level != DicomLevel.INSTANCES
+
+    def cached_tags(self, oid: str, level: DicomLevel) -> Union[dict, None]:
+        if self.caching(level):
+            return self.cache.get(self.tags_key(oid, level))
+
+    def cache_tags(self, oid: str, level: DicomLevel, result, stable: bool=True) -> dict:
+        # Cleaning is part of what's worth caching
+        tags = dicom_clean_tags(result)
+        if self.caching(level) and stable:
+            self.cache.put(self.tags_key(oid, level), tags, groups=self.parent_groups(tags, level))
+        return tags
+
+    def uncache(self, oid: str, level: DicomLevel):
+        if self.cache is not None:
+            self.cache.invalidate(self.tags_key(oid, level))
+            self.cache.invalidate_group(self.tags_group(oid))
+
+    def get(self, item: Union[str, Dixel], level: DicomLevel=DicomLevel.STUDIES, view: str="tags",
+            stream: bool=False, fields: Iterable[str]=None) -> Dixel:
+        # With stream, file and archive dixels carry a generator of body chunks
+        # instead of the whole body, so they can be piped to disk or another endpoint.
+        # The "lazy" view returns a dixel that only fetches tags when its meta is
+        # read, and just the main tags first if those are all `fields` asks for.
+
+        oid, level, meta = self.item_ref(item, level)
+
+        self.logger.debug("{}: getting {}".format(self.__class__.__name__, oid))
+
+        if view == "lazy":
+            meta = dict(meta)
+            meta.setdefault('oid', oid)
+            return Dixel(meta=LazyMeta(partial(self.lazy_tags, oid, level), meta, fields),
+                         level=level)
+
+        if view=="instance_tags":
+            result = self.get(oid, level, view="meta")
+            oid = result['Instances'][0]
+            view = "tags"
+            level = DicomLevel.INSTANCES
+            # Now get tags as normal
+
+        if view == "tags":
+            tags = self.cached_tags(oid, level)
+            if tags is None:
+                # Stability is checked first, so the tags read after it are final
+                stable = not self.needs_stable(level) or \
+                         bool(self.gateway.get_item(oid, level, view="meta").get("IsStable"))
+                tags = self.cache_tags(oid, level, self.gateway.get_item(oid, level, view=view), stable)
+            return self.tags2dixel(tags, level)
+
+        # print(oid)
+        result = self.gateway.get_item(oid, level, view=view, stream=stream)
+        return self.item_from(result, meta, level, view)
+
+    def lazy_tags(self, oid: str, level: DicomLevel, fields: Iterable[str]=None) -> dict:
+        if fields:
+            # Main tags come from the resource itself, no dicom parsing needed
+            result = self.gateway.get_item(oid, level, view="meta")
+            tags = dict(result.get('PatientMainDicomTags', {}))
+            tags.update(result.get('MainDicomTags', {}))
+            return tags
+        return self.get(oid, level, view="tags").meta
+
     def put(self, item: Dixel):
+        parents = self.put_file(item)
+
+        if hasattr(self, 'put_metadata'):
+            item = self.put_metadata(item, parents=parents)
+
+    def put_batch(self, items: Iterable[Dixel]) -> List[Dixel]:
+        # Puts each instance as it comes, then writes metadata for them all at
+        # once, so a series or study the instances share is only written once.
+        # Files are dropped as they are sent, only the meta is kept.
+        done, parents = [], []
+        for item in items:
+            parents.append(self.put_file(item))
+            item.file = None
+            done.append(item)
+
+        if hasattr(self, 'put_metadata_batch'):
+            self.put_metadata_batch(done, parents=parents)
+        return done
+
+    def put_file(self, item: Dixel) -> Union[list, None]:
         self.logger.debug("{}: putting {}".format(self.__class__.__name__, item.uid))
 
         if item.level != DicomLevel.INSTANCES:
@@ -123,12 +309,16 @@ class Orthanc(Pattern):
             raise KeyError
 
         result = self.gateway.put_item(item.file)
-        # Problem
-        if result:
-            return result
+        return self.stash_put_result(item, result)
 
-        if hasattr(self, 'put_metadata'):
-            item = self.put_metadata(item)
+    def stash_put_result(self, item: Dixel, result):
+        # Orthanc replies to a put with the new instance and parent ID's; keep
+        # them so metadata writes don't have to look them up again
+        if not isinstance(result, Mapping) or not result.get('ID'):
+            return
+        item.meta.setdefault('oid', result['ID'])
+        return [(result['ParentSeries'], DicomLevel.SERIES),
+                (result['ParentStudy'], DicomLevel.STUDIES)]
 
     # Handlers
 
@@ -147,7 +337,8 @@ class Orthanc(Pattern):
                 # self.logger.debug("Could not find {} or {}".format(item.oid(), item.sham_oid()))
                 return False
 
-    def anonymize(self, item: Dixel, replacement_map: Callable[[dict],dict]=simple_sham_map, remove: bool=False) -> Dixel:
+    def anonymize(self, item: Dixel, replacement_map: Callable[[dict],dict]=simple_sham_map, remove: bool=False,
+                  asynchronous: bool=False) -> Union[Dixel, OrthancJob]:
 
         if not item.meta.get('ShamID'):
             item.set_shams()
@@ -156,6 +347,11 @@ class Orthanc(Pattern):
 
         self.logger.debug(replacement_dict)
 
+        if asynchronous and item.level < DicomLevel.INSTANCES:
+            # Returns a job handle, collect the anonymized dixel with `anonymized`
+            return self.gateway.anonymize_item(item.oid(), item.level, replacement_dict=replacement_dict,
+                                               asynchronous=True)
+
         result = self.gateway.anonymize_item(item.oid(), item.level, replacement_dict=replacement_dict)
         # self.logger.debug(result)
         if remove:
@@ -163,16 +359,36 @@ class Orthanc(Pattern):
         # self.logger.debug(result)
         if result:
             if item.level == DicomLevel.INSTANCES:
-                d = Dixel( item.sham_oid(), file=result, level=DicomLevel.INSTANCES )
-                if hasattr(d, "copy_metadata"):
-                    d.copy_metadata(item)
-                return d
+                return self.anonymized_instance(item, result)
             else:
                 return self.get( result['ID'], level=item.level )
 
+    def anonymized(self, item: Dixel, job: OrthancJob, remove: bool=False) -> Dixel:
+        # Wait for an anonymization job and return the new dixel
+        result = job.wait().result()
+        if remove:
+            self.remove(item)
+        return self.get( result['ID'], level=item.level )
+
+    def archive(self, item: Dixel) -> OrthancJob:
+        # Zip a study or series in the background
+        return self.gateway.archive_item(item.oid(), item.level)
+
+    def archived(self, item: Dixel, job: OrthancJob, stream: bool=False) -> Dixel:
+        # Wait for an archive job and attach the zip to the dixel, as get(view="archive")
+        result = job.wait().archive(stream=stream)
+        return self.item_from(result, item.meta, item.level, "archive")
+
+    def anonymized_instance(self, item: Dixel, result) -> Dixel:
+        d = Dixel( item.sham_oid(), file=result, level=DicomLevel.INSTANCES )
+        if hasattr(d, "copy_metadata"):
+            d.copy_metadata(item)
+        return d
+
     def remove(self, item: Dixel):
         oid = item.oid()
         level = item.level
+        self.uncache(oid, level)
         return self.gateway.delete_item(oid, level)
 
     def find_item(self, item: Dixel, domain: str="local", retrieve: bool=False):
@@ -182,47 +398,6 @@ class Orthanc(Pattern):
 
         # self.logger.debug("Finding {}".format(item.oid()))
 
-        def find_item_query(item):
-            # Usually want to mask the dixel data to just AccessionNumber to isolate a study, or
-            # AccessionNumber and SeriesDescription to isolate a series, if possible
-
-            q = {}
-            keys = {}
-
-            # All levels have these
-            keys[DicomLevel.STUDIES] = ['PatientID',
-                                        'PatientName',
-                                        'PatientBirthDate',
-                                        'PatientSex',
-                                        'StudyInstanceUID',
-                                        'StudyDate',
-                                        'StudyTime',
-                                        'AccessionNumber']
-
-            # Series level has these
-            keys[DicomLevel.SERIES] = keys[DicomLevel.STUDIES] + \
-                                      ['SeriesInstanceUID',
-                                       'SeriesDescription',
-                                       'ProtocolName',
-                                       'SeriesNumber',
-                                       'NumberOfSeriesRelatedInstances',
-                                       'Modality']
-
-            # For instance level, use the minimum
-            keys[DicomLevel.INSTANCES] = ['SOPInstanceUID', 'SeriesInstanceUID']
-
-            def add_key(q, key, dixel):
-                q[key] = dixel.meta.get(key, '')
-                return q
-
-            for k in keys[item.level]:
-                q = add_key(q, k, item)
-
-            if item.level == DicomLevel.STUDIES and item.meta.get('Modality'):
-                q['ModalitiesInStudy'] = item.meta.get('Modality')
-
-            return q
-
         q = find_item_query(item)
         # self.logger.debug(q)
 
@@ -235,7 +410,8 @@ class Orthanc(Pattern):
         self.logger.warning("No results returned")
 
 
-    def find(self, q: Mapping, level: DicomLevel, domain: str, retrieve: bool=False):
+    def find_iter(self, q: Mapping, level: DicomLevel, domain: str, retrieve: bool=False):
+        # Yields dixels as the answers arrive, repeats are not filtered
 
         query = {'Level': str(level),
                  'Query': q}
@@ -247,39 +423,89 @@ class Orthanc(Pattern):
         else:
             retrieve_dest = None
 
-        results = self.gateway.find(query, domain, retrieve_dest)
+        for d in self.gateway.find_iter(query, domain, retrieve_dest):
+            yield answer2dixel(d, level)
 
-        if results:
-            worklist = set()
-            for d in results:
-                d['StudyDateTime'] = dicom_strpdtime(d['StudyDate'] + d['StudyTime'])
-                try:
-                    d['PatientBirthDate'] = dicom_strpdate(d['PatientBirthDate'])
-                    # self.logger.debug(pformat(d))
-                except:
-                    # self.logger.info("No patient birthdate discovered")
-                    pass
-                worklist.add( Dixel(meta=d, level=level ) )
+    def find(self, q: Mapping, level: DicomLevel, domain: str, retrieve: bool=False):
 
+        worklist = set( self.find_iter(q, level, domain, retrieve=retrieve) )
+        if worklist:
             return worklist
 
         return []
 
-    def send(self, item: Dixel, peer_dest: str=None, modality_dest: str=None):
+    def send(self, item: Dixel, peer_dest: str=None, modality_dest: str=None, asynchronous: bool=False):
+        # Returns a job handle if asynchronous
         if modality_dest:
-            return self.gateway.send_item(item.oid(), dest=modality_dest, dest_type="modalities")
+            return self.gateway.send_item(item.oid(), dest=modality_dest, dest_type="modalities",
+                                          asynchronous=asynchronous)
         if peer_dest:
-            return self.gateway.send_item(item.oid(), dest=peer_dest, dest_type="peers")
+            return self.gateway.send_item(item.oid(), dest=peer_dest, dest_type="peers",
+                                          asynchronous=asynchronous)
+
+    def send_batch(self, items: Iterable[Union[str, Dixel]], peer_dest: str=None, modality_dest: str=None,
+                   batch_size: int=None) -> Mapping[str, bool]:
+        """
+        Send items with one store request per batch, returns {oid: sent}.  If a
+        batch fails, or reports failed instances, its items are retried one at
+        a time to find out which ones didn't make it.
+        """
+        if modality_dest:
+            dest, dest_type = modality_dest, "modalities"
+        elif peer_dest:
+            dest, dest_type = peer_dest, "peers"
+        else:
+            raise ValueError("No destination to send to!")
+
+        batch_size = batch_size or self.send_batch_size
+        oids = [item.oid() if isinstance(item, Dixel) else item for item in items]
+
+        outcomes = OrderedDict()
+        for i in range(0, len(oids), batch_size):
+            batch = oids[i:i+batch_size]
+
+            try:
+                result = self.gateway.send_items(batch, dest=dest, dest_type=dest_type)
+                ok = not (isinstance(result, Mapping) and result.get("FailedInstancesCount"))
+            except ConnectionError as e:
+                self.logger.warning("Batch send to {} failed ({}), sending one at a time".format(dest, e))
+                ok = False
+
+            if ok:
+                outcomes.update((oid, True) for oid in batch)
+                continue
+
+            for oid in batch:
+                try:
+                    self.gateway.send_item(oid, dest=dest, dest_type=dest_type)
+                    outcomes[oid] = True
+                except ConnectionError as e:
+                    self.logger.error("Failed to send {} to {}".format(oid, dest))
+                    outcomes[oid] = False
+
+        return outcomes
 
     def clear(self, desc: str="all"):
         if desc == "all" or desc == "studies":
-            self.inventory['studies'] = self.gateway.get("studies")
-            for oid in self.inventory['studies']:
-                self.gateway.delete_item(oid, DicomLevel.STUDIES)
+            if self.cache is not None:
+                self.cache.clear()
+            # Deleting shifts the paging offsets, so always take the first page
+            deleted = 0
+            last = None
+            while True:
+                page = self.gateway.get("studies", params={'since': 0, 'limit': self.page_size})
+                if not page or page == last:
+                    # Empty, or stuck on studies that won't delete
+                    break
+                self.gateway.bulk_delete(page, DicomLevel.STUDIES)
+                deleted += len(page)
+                last = page
+            self.inventory['studies'] = []
+            self.logger.debug("Cleared {} studies".format(deleted))
         elif desc == "exports":
-            self.gateway.do_delete("exports")
+            self.gateway.delete("exports")
         elif desc == "changes":
-            self.gateway.do_delete("changes")
+            self.gateway.delete("changes")
         else:
             raise NotImplementedError
 
@@ -289,23 +515,29 @@ class Orthanc(Pattern):
     def reset(self):
         return self.gateway.reset()
 
+    def inventory_iter(self, level: DicomLevel, expand: bool=False):
+        # Pages through the ids rather than pulling the whole list at once.  With
+        # expand, each page carries the resources' main tags too.
+        for r in self.gateway.inventory(level, page_size=self.page_size, expand=expand):
+            if expand:
+                meta = dict(r.get('PatientMainDicomTags', {}))
+                meta.update(r.get('MainDicomTags', {}))
+                meta['oid'] = r['ID']
+            else:
+                meta = {'oid': r}
+            yield CompactDixel(meta=meta, level=level)
+
     @property
     def instances(self):
-        oids = self.gateway.get("instances")
-        for oid in oids:
-            yield Dixel(meta={'oid': oid}, level=DicomLevel.INSTANCES)
+        yield from self.inventory_iter(DicomLevel.INSTANCES)
 
     @property
     def series(self):
-        oids = self.gateway.get("series")
-        for oid in oids:
-            yield Dixel(meta={'oid': oid}, level=DicomLevel.SERIES)
+        yield from self.inventory_iter(DicomLevel.SERIES)
 
     @property
     def studies(self):
-        oids = self.gateway.get("studies")
-        for oid in oids:
-            yield Dixel(meta={'oid': oid}, level=DicomLevel.STUDIES)
+        yield from self.inventory_iter(DicomLevel.STUDIES)
 
 
     def get_parent(self, item: Dixel) -> Dixel:
@@ -322,6 +554,120 @@ class Orthanc(Pattern):
 
         return Dixel(meta={'oid': oid}, level=level)
 
+    # Async handlers
+    #
+    # Coroutine twins of the core handlers that run over `agateway`, so one
+    # process can keep up to `max_concurrency` requests in flight, e.g.
+    #
+    # >>> loop.run_until_complete( asyncio.gather(*[orthanc.get_async(d) for d in worklist]) )
+
+    async def get_async(self, item: Union[str, Dixel], level: DicomLevel=DicomLevel.STUDIES, view: str="tags",
+                        stream: bool=False) -> Dixel:
+
+        oid, level, meta = self.item_ref(item, level)
+
+        self.logger.debug("{}: getting {}".format(self.__class__.__name__, oid))
+
+        if view=="instance_tags":
+            result = await self.get_async(oid, level, view="meta")
+            oid = result['Instances'][0]
+            view = "tags"
+            level = DicomLevel.INSTANCES
+
+        if view == "tags":
+            tags = self.cached_tags(oid, level)
+            if tags is None:
+                stable = not self.needs_stable(level) or \
+                         bool((await self.agateway.get_item(oid, level, view="meta")).get("IsStable"))
+                tags = self.cache_tags(oid, level, await self.agateway.get_item(oid, level, view=view), stable)
+            # Metadata lookups are blocking, keep them off the loop
+            return await self.agateway.run(self.tags2dixel, tags, level)
+
+        result = await self.agateway.get_item(oid, level, view=view, stream=stream)
+        return self.item_from(result, meta, level, view)
+
+    async def put_async(self, item: Dixel):
+        self.logger.debug("{}: putting {}".format(self.__class__.__name__, item.uid))
+
+        if item.level != DicomLevel.INSTANCES:
+            self.logger.warning("Can only 'put' Dicom instances.")
+            raise ValueError
+        if not item.file:
+            self.logger.warning("Can only 'put' file data.")
+            raise KeyError
+
+        result = await self.agateway.put_item(item.file)
+
+        if hasattr(self, 'put_metadata'):
+            parents = self.stash_put_result(item, result)
+            await self.agateway.run(self.put_metadata, item, parents=parents)
+
+    async def check_async(self, item: Dixel) -> bool:
+        try:
+            await self.agateway.get_item(item.oid(), item.level)
+            return True
+        except ConnectionError:
+            try:
+                await self.agateway.get_item(item.sham_oid(), item.level)
+                return True
+            except ConnectionError:
+                return False
+
+    async def anonymize_async(self, item: Dixel, replacement_map: Callable[[dict],dict]=simple_sham_map, remove: bool=False) -> Dixel:
+
+        if not item.meta.get('ShamID'):
+            item.set_shams()
+
+        replacement_dict = replacement_map(item.meta)
+
+        result = await self.agateway.anonymize_item(item.oid(), item.level, replacement_dict=replacement_dict)
+        if remove:
+            await self.remove_async(item)
+        if result:
+            if item.level == DicomLevel.INSTANCES:
+                return self.anonymized_instance(item, result)
+            else:
+                return await self.get_async( result['ID'], level=item.level )
+
+    async def remove_async(self, item: Dixel):
+        self.uncache(item.oid(), item.level)
+        return await self.agateway.delete_item(item.oid(), item.level)
+
+    async def find_item_async(self, item: Dixel, domain: str="local", retrieve: bool=False):
+
+        q = find_item_query(item)
+        result = await self.find_async(q, item.level, domain, retrieve=retrieve)
+
+        if result:
+            return item.update(result.pop())
+
+        self.logger.warning("No results returned")
+
+    async def find_async(self, q: Mapping, level: DicomLevel, domain: str, retrieve: bool=False):
+
+        query = {'Level': str(level),
+                 'Query': q}
+
+        if retrieve:
+            retrieve_dest = self.domains[domain]
+        else:
+            retrieve_dest = None
+
+        results = await self.agateway.find(query, domain, retrieve_dest)
+
+        if results:
+            return set( answer2dixel(d, level) for d in results )
+
+        return []
+
+    async def send_async(self, item: Dixel, peer_dest: str=None, modality_dest: str=None):
+        if modality_dest:
+            return await self.agateway.send_item(item.oid(), dest=modality_dest, dest_type="modalities")
+        if peer_dest:
+            return await self.agateway.send_item(item.oid(), dest=peer_dest, dest_type="peers")
+
+
+
 #
 # @attr.s
 # class OrthancPeer(Pattern):
@@ -332,3 +678,147 @@ class Orthanc(Pattern):
 #     def put(self, item):
 #         self.source.send(item, peer=self.peer_name)
 
+
+def test_orthanc_find():
+
+    from ..utils.gateway.orthanc import CannedOrthanc
+
+    answer = {"AccessionNumber": "12345", "PatientID": "abc", "StudyInstanceUID": "1.2.3",
+              "StudyDate": "20180101", "StudyTime": "120000", "PatientBirthDate": "19700101"}
+    orthanc = Orthanc(domains={"pacs": "diana"})
+    orthanc.gateway = CannedOrthanc("localhost", "8042",
+                                    responses={"modalities/pacs/query": {"ID": "q1"},
+                                               "queries/q1/answers": [answer]})
+
+    found = orthanc.find({"AccessionNumber": "12345"}, DicomLevel.STUDIES, "pacs", retrieve=True)
+    assert [d.meta["StudyInstanceUID"] for d in found] == ["1.2.3"]
+    assert ("post", "queries/q1/retrieve", "diana") in orthanc.gateway.calls
+
+    d = Dixel(meta={"AccessionNumber": "12345"}, level=DicomLevel.STUDIES)
+    d = orthanc.find_item(d, "pacs")
+    assert d.meta["PatientID"] == "abc"
+
+
+def test_orthanc_tag_cache():
+
+    from ..utils.gateway.orthanc import CannedOrthanc
+
+    pid, stuid, seruid, instuid = "abc", "1.2.3", "1.2.3.4", "1.2.3.4.5"
+    study, series = orthanc_id(pid, stuid), orthanc_id(pid, stuid, seruid)
+    instance = orthanc_id(pid, stuid, seruid, instuid)
+    tags = {"PatientID": pid, "StudyInstanceUID": stuid, "SeriesInstanceUID": seruid}
+
+    gateway = CannedOrthanc("localhost", "8042",
+                            responses={"series/" + series: {"IsStable": False},
+                                       "series/{}/shared-tags".format(series): tags,
+                                       "series/{}/metadata".format(series): {},
+                                       "instances/{}/tags".format(instance):
+                                           dict(tags, SOPInstanceUID=instuid),
+                                       "instances/{}/metadata".format(instance): {}})
+    orthanc = Orthanc(tag_cache={"maxsize": 100})
+    orthanc.gateway = gateway
+
+    def fetches():
+        return len([c for c in gateway.calls if c[1].endswith("tags")])
+
+    # An unstable series isn't cached, a stable one is
+    orthanc.get(series, DicomLevel.SERIES)
+    orthanc.get(series, DicomLevel.SERIES)
+    assert fetches() == 2
+    gateway.responses["series/" + series]["IsStable"] = True
+    orthanc.get(series, DicomLevel.SERIES)
+    assert orthanc.get(series, DicomLevel.SERIES).meta["SeriesInstanceUID"] == seruid
+    assert fetches() == 3
+
+    # Instances are always stable
+    orthanc.get(instance, DicomLevel.INSTANCES)
+    orthanc.get(instance, DicomLevel.INSTANCES)
+    assert fetches() == 4 and ("get", "instances/" + instance) not in gateway.calls
+
+    # Removing the study uncaches its series and instances
+    orthanc.remove(Dixel(meta={"oid": study}, level=DicomLevel.STUDIES))
+    assert ("delete", "studies/" + study) in gateway.calls
+    orthanc.get(series, DicomLevel.SERIES)
+    orthanc.get(instance, DicomLevel.INSTANCES)
+    assert fetches() == 6
+
+
+def test_send_batch():
+
+    from ..utils.gateway.orthanc import CannedOrthanc
+
+    peer = {"batch": {"FailedInstancesCount": 0}, "down": set()}
+
+    def store(data=None, json=None):
+        # A list of resources is one batch, a single oid is sent as text
+        if json is not None:
+            if isinstance(peer["batch"], Exception):
+                raise peer["batch"]
+            return peer["batch"]
+        if data in peer["down"]:
+            raise ConnectionError("{} refused".format(data))
+
+    gateway = CannedOrthanc("localhost", "8042", responses={"/peers/backup/store": store})
+    orthanc = Orthanc()
+    orthanc.gateway = gateway
+    items = ["a", "b", "c", Dixel(meta={"oid": "d"}, level=DicomLevel.INSTANCES), "e"]
+
+    def sends():
+        return [c[2] for c in gateway.calls if c[0] == "post"]
+
+    # Batches go through in one request each
+    assert orthanc.send_batch(items, peer_dest="backup", batch_size=2) == \
+        {"a": True, "b": True, "c": True, "d": True, "e": True}
+    assert sends() == [None] * 3
+
+    # A batch that errors is sent one at a time, to find which didn't make it
+    del gateway.calls[:]
+    peer["batch"], peer["down"] = ConnectionError("association refused"), {"c"}
+    assert orthanc.send_batch(items, peer_dest="backup", batch_size=5) == \
+        {"a": True, "b": True, "c": False, "d": True, "e": True}
+    assert sends() == [None, "a", "b", "c", "d", "e"]
+
+    # So is one that reports failed instances
+    del gateway.calls[:]
+    peer["batch"], peer["down"] = {"FailedInstancesCount": 1}, {"d"}
+    assert orthanc.send_batch(items, peer_dest="backup", batch_size=3) == \
+        {"a": True, "b": True, "c": True, "d": False, "e": True}
+    assert sends() == [None, "a", "b", "c", None, "d", "e"]
+
+
+def test_orthanc_clear():
+
+    from ..utils.gateway.orthanc import CannedOrthanc
+
+    # Studies s0..s7 and one that refuses to delete
+    store = ["s{}".format(i) for i in range(4)] + ["stuck"] + ["s{}".format(i) for i in range(4, 8)]
+    pages = []
+
+    def studies(params=None):
+        pages.append((params["since"], params["limit"]))
+        page = store[params["since"]:params["since"] + params["limit"]]
+        if "expand" in params:
+            return [{"ID": oid, "MainDicomTags": {"StudyInstanceUID": "1.2." + oid}} for oid in page]
+        return page
+
+    def bulk_delete(data=None, json=None):
+        store[:] = [oid for oid in store if oid == "stuck" or oid not in json["Resources"]]
+
+    gateway = CannedOrthanc("localhost", "8042",
+                            responses={"studies": studies, "tools/bulk-delete": bulk_delete})
+    orthanc = Orthanc(page_size=4)
+    orthanc.gateway = gateway
+
+    # The inventory comes a page at a time
+    assert [d.oid() for d in orthanc.studies] == store
+    assert pages == [(0, 4), (4, 4), (8, 4)]
+    d = list(orthanc.inventory_iter(DicomLevel.STUDIES, expand=True))[4]
+    assert d.oid() == "stuck" and d.meta["StudyInstanceUID"] == "1.2.stuck"
+
+    # Clearing always takes the first page, and gives up on a study that won't go
+    del pages[:]
+    orthanc.clear()
+    assert store == ["stuck"]
+    assert set(pages) == {(0, 4)}
+    # 4 deleted, 3 deleted, 1 deleted, then the same page twice
+    assert len(pages) == 5
@@ -1,4 +1,7 @@
 import json, logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
 from datetime import datetime, timedelta
 from hashlib import md5
 from cryptography.fernet import Fernet
@@ -110,35 +113,137 @@ def decode_data_sig(self: Dixel, fkey):
     return res
 
 
-# Write values from dixel into Orthanc metadata
-def put_metadata(self: Orthanc, item: Dixel):
-    self.logger.debug("Putting meta data keys")
+# Metadata reads and writes fan out over the gateway's connection pool, on
+# threads that only live for the one call
+def metadata_executor(self: Orthanc, n: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=max(1, min(self.gateway.pool_size, n)))
 
+
+def metadata_values(item: Dixel) -> dict:
+    values = {}
     for k in SUPPORTED_METADATA:
         if item.meta.get( k ):
-            self.gateway.put_metadata(item.oid(), item.level, k, stringify( item.meta.get( k ) ))
+            values[k] = stringify( item.meta.get( k ) )
+    return values
+
+
+def get_ancestors(self: Orthanc, item: Dixel) -> list:
+    # (oid, level) of parent series and study, computed locally when the
+    # dixel carries its uids and looked up otherwise
+    if item.level == DicomLevel.INSTANCES:
+        levels = [DicomLevel.SERIES, DicomLevel.STUDIES]
+    elif item.level == DicomLevel.SERIES:
+        levels = [DicomLevel.STUDIES]
+    else:
+        return []
+
+    try:
+        return [(item.oid(level), level) for level in levels]
+    except KeyError:
+        pass
+
+    ancestors = []
+    parent = item
+    for level in levels:
+        parent = self.get_parent(parent)
+        ancestors.append((parent.oid(), parent.level))
+    return ancestors
+
+
+def changed_metadata(self: Orthanc, oid: str, level: DicomLevel, values: dict) -> list:
+    # Diffed against what the resource holds right now, so a resource that was
+    # removed and put again gets all of its keys back
+    try:
+        current = self.gateway.get_all_metadata(oid, level)
+    except ConnectionError:
+        current = None
+    if not isinstance(current, dict):
+        # Can't diff without 'expand' support, so write everything
+        current = {}
+
+    return [(k, v) for k, v in values.items() if current.get(k) != v]
+
+
+def write_metadata(self: Orthanc, writes: list):
+    # writes is a list of (oid, level, values); diff every resource, then send
+    # all the changed keys at once
+    if not writes:
+        return
+    with metadata_executor(self, len(writes) * len(SUPPORTED_METADATA)) as pool:
+        changes = pool.map(lambda w: changed_metadata(self, *w), writes)
+
+        futures = []
+        for (oid, level, values), changed in zip(writes, changes):
+            for k, v in changed:
+                futures.append(pool.submit(self.gateway.put_metadata, oid, level, k, v))
+        for f in futures:
+            f.result()
+
+
+# Write values from dixel into Orthanc metadata
+def put_metadata(self: Orthanc, item: Dixel, parents: list=None):
+    self.logger.debug("Putting meta data keys")
+
+    values = metadata_values(item)
+    if not values:
+        return
 
-    if item.level == DicomLevel.INSTANCES or item.level == DicomLevel.SERIES:
-        parent = self.get_parent(item)
-        parent.copy_metadata(item)
-        self.put_metadata(parent)
+    # Propagate up to the series and study
+    writes = [(item.oid(), item.level, values)]
+    for oid, level in parents or get_ancestors(self, item):
+        writes.append((oid, level, values))
+
+    write_metadata(self, writes)
+
+
+# Write values for a batch of dixels, each shared parent is written once.
+# parents, if given, holds each item's (oid, level) parents as from put_file
+def put_metadata_batch(self: Orthanc, items: Iterable[Dixel], parents: list=None):
+    self.logger.debug("Putting meta data keys for batch")
+
+    items = list(items)
+    parents = parents or [None] * len(items)
+
+    writes = OrderedDict()
+    for item, item_parents in zip(items, parents):
+        values = metadata_values(item)
+        if not values:
+            continue
+        writes[item.oid(), item.level] = values
+        for oid, level in item_parents or get_ancestors(self, item):
+            # Later items win, as they would if put one at a time
+            writes.pop((oid, level), None)
+            writes[oid, level] = values
+
+    write_metadata(self, [(oid, level, values) for (oid, level), values in writes.items()])
 
 
 # Read values from Orthanc and update dixel
 def get_metadata(self: Orthanc, item: Dixel) -> Dixel:
     self.logger.debug("Checking for metadata keys")
 
+    try:
+        result = self.gateway.get_all_metadata(item.oid(), item.level)
+    except ConnectionError as e:
+        # Nothing there, just skip it
+        return item
+    except Exception as e:
+        self.logger.error(e)
+        return item
+
+    if isinstance(result, list):
+        # No 'expand' support, only fetch keys that are actually set
+        keys = [k for k in result if k in SUPPORTED_METADATA]
+        with metadata_executor(self, len(keys)) as pool:
+            values = list(pool.map(
+                lambda k: self.gateway.get_metadata(item.oid(), item.level, k), keys))
+        result = {}
+        for k, v in zip(keys, values):
+            result[k] = v.decode("UTF8") if isinstance(v, bytes) else v
+
     for k in SUPPORTED_METADATA:
-        try:
-            result = self.gateway.get_metadata(item.oid(), item.level, k)
-        except ConnectionError as e:
-            # Nothing there, just skip it
-            result = None
-        except Exception as e:
-            self.logger.error(e)
-            result = None
-        if result:
-            item.meta[k] = result
+        if result.get(k):
+            item.meta[k] = result[k]
     return item
 
 
@@ -149,5 +254,62 @@ Dixel.encode_data_sig = encode_data_sig
 Dixel.decode_data_sig = decode_data_sig
 
 Orthanc.put_metadata = put_metadata
+Orthanc.put_metadata_batch = put_metadata_batch
 Orthanc.get_metadata = get_metadata
 
+
+def test_orthanc_metadata():
+
+    from diana.utils import orthanc_id
+    from diana.utils.gateway.orthanc import CannedOrthanc
+
+    pid, stuid, seruid = "abc", "1.2.3", "1.2.3.4"
+    study, series = orthanc_id(pid, stuid), orthanc_id(pid, stuid, seruid)
+    instances = [orthanc_id(pid, stuid, seruid, "1.2.3.4.{}".format(i)) for i in range(3)]
+
+    def dixel(i):
+        return Dixel(meta={"PatientID": pid, "StudyInstanceUID": stuid, "SeriesInstanceUID": seruid,
+                           "SOPInstanceUID": "1.2.3.4.{}".format(i),
+                           "SubmittingSite": "site", "DataSignature": "sig"},
+                     level=DicomLevel.INSTANCES)
+
+    # The study already has the site, but an old signature
+    responses = {"studies/{}/metadata".format(study): {"SubmittingSite": "site", "DataSignature": "old"},
+                 "series/{}/metadata".format(series): {}}
+    for oid in instances:
+        responses["instances/{}/metadata".format(oid)] = {}
+    gateway = CannedOrthanc("localhost", "8042", responses=responses)
+    orthanc = Orthanc()
+    orthanc.gateway = gateway
+
+    orthanc.put_metadata_batch([dixel(i) for i in range(3)])
+
+    # One read per resource, the shared series and study included
+    reads = [c[1] for c in gateway.calls if c[0] == "get"]
+    assert sorted(reads) == sorted(responses)
+
+    # Only changed keys are written, and the shared parents only once
+    writes = [c[1] for c in gateway.calls if c[0] == "put"]
+    assert len(writes) == len(set(writes)) == 3 * 2 + 2 + 1
+    assert "studies/{}/metadata/SubmittingSite".format(study) not in writes
+    assert "studies/{}/metadata/DataSignature".format(study) in writes
+
+    # Parents of a fresh upload come from the put reply, not from the uids
+    del gateway.calls[:]
+    gateway.responses["instances"] = {"ID": instances[0], "ParentSeries": series, "ParentStudy": study}
+    d = Dixel(meta={"SubmittingSite": "site"}, level=DicomLevel.INSTANCES, file=b"DICM")
+    assert orthanc.put_batch([d])[0].file is None
+    writes = [c[1] for c in gateway.calls if c[0] == "put"]
+    assert sorted(writes) == sorted("{}/metadata/SubmittingSite".format(r) for r in
+                                    ("instances/" + instances[0], "series/" + series))
+
+    # Without 'expand', only the supported keys that are set are fetched
+    del gateway.calls[:]
+    oid = instances[1]
+    gateway.responses["instances/{}/metadata".format(oid)] = ["SubmittingSite", "RemoteAet"]
+    gateway.responses["instances/{}/metadata/SubmittingSite".format(oid)] = b"site"
+    d = dixel(1)
+    d.meta.pop("SubmittingSite")
+    assert orthanc.get_metadata(d).meta["SubmittingSite"] == "site"
+    reads = [c[1] for c in gateway.calls if c[0] == "get"]
+    assert reads == ["instances/{}/metadata".format(oid), "instances/{}/metadata/SubmittingSite".format(oid)]
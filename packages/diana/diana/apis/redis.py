@@ -23,9 +23,9 @@ class Redis(Pattern):
 
     @classmethod
     def item2str(cls, item: Union[Dixel, UUID, str], key: str=None) -> str:
-        if type(item) == Dixel and key:
+        if isinstance(item, Dixel) and key:
             id = str( item.meta[key] )
-        elif type(item) == Dixel:
+        elif isinstance(item, Dixel):
             id = str( item.uid )
         elif type(item) == UUID:
             id = str(item)
@@ -1,10 +1,10 @@
 import logging
-from typing import Mapping
+from typing import Mapping, Iterable
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import attr
-from .dixel import Dixel
-from ..utils import Pattern, DatetimeInterval, gateway
+from .dixel import Dixel, CompactDixel
+from ..utils import Pattern, DatetimeInterval, DatetimeInterval2, IntervalCache, IndexedKeySet, gateway
 from ..utils.dicom import DicomLevel
 # splunk-sdk is 2.7 only, so diana.utils.gateway provides a minimal query/put replacement
 
@@ -21,6 +21,7 @@ class Splunk(Pattern):
     password = attr.ib( default="admin" )
     hec_protocol = attr.ib( default="http" )
     hec_port = attr.ib( default="8088" )
+    pool_size = attr.ib( default=10 )
     gateway = attr.ib( init=False )
 
     hec_tokens = attr.ib( factory=dict )  # Mapping of domain name -> token
@@ -28,6 +29,33 @@ class Splunk(Pattern):
     default_token = attr.ib( default=None )
     default_index = attr.ib( default='main' )
 
+    # Buffer events into batched HEC posts, configured with HECBuffer kwargs,
+    # ie, {"max_events": 500, "max_bytes": 1048576, "max_age": 5, "compress": True}
+    hec_batch = attr.ib( default=None )
+
+    # Cache search results over the time windows already seen, configured with
+    # IntervalCache kwargs, ie, {"maxsize": 100, "ttl": 3600, "settle": 300}
+    query_cache = attr.ib( default=None )
+    cache = attr.ib( init=False, repr=False )
+
+    # Local record of keys already put to each index, configured with
+    # IndexedKeySet kwargs, ie, {"location": "/var/cache/diana/keys.db", "bloom_capacity": 1000000}
+    indexed_keys = attr.ib( default=None )
+    key_field = attr.ib( default="AccessionNumber" )
+    keyset = attr.ib( init=False, repr=False )
+
+    @keyset.default
+    def make_keyset(self):
+        if self.indexed_keys is None:
+            return None
+        return IndexedKeySet(**self.indexed_keys)
+
+    @cache.default
+    def make_cache(self):
+        if self.query_cache is None:
+            return None
+        return IntervalCache(**self.query_cache)
+
     @gateway.default
     def connect(self):
 
@@ -39,7 +67,8 @@ class Splunk(Pattern):
             hec_port=self.hec_port,
             hec_protocol=self.hec_protocol,
             user=self.user,
-            password=self.password
+            password=self.password,
+            pool_size=self.pool_size
         )
 
     def add_hec_token(self, name: str, token: str):
@@ -48,21 +77,41 @@ class Splunk(Pattern):
     def find_items(self,
             query: Mapping,
             time_interval: DatetimeInterval=None):
+        # As a set, or None if nothing was found; goes through the query cache
+        # like find_items_iter
+
+        return set( self.find_items_iter(query, time_interval) ) or None
+
+
+    def find_items_iter(self,
+            query: Mapping,
+            time_interval: DatetimeInterval=None,
+            fields: Iterable[str]=None):
+        # Yields dixels as Splunk streams them back; with fields, only those
+        # fields (plus 'level') are returned
 
-        results = self.gateway.find_events(query, time_interval)
+        if fields:
+            fields = sorted( set(fields) | {'level'} )
 
-        # logging.debug("Splunk query: {}".format(query))
-        # logging.debug("Splunk results: {}".format(results))
+        if self.cache is not None and time_interval:
+            results = self.cached_events(query, time_interval, fields)
+        else:
+            results = self.gateway.iter_events(query, time_interval, fields=fields)
+
+        for d in results:
+            yield CompactDixel(meta=d, level=DicomLevel.of( d['level'] ) )
 
-        if results:
-            worklist = set()
-            for d in results:
-                worklist.add( Dixel(meta=d, level=DicomLevel.of( d['level'] ) ) )
+    def cached_events(self, query: str, time_interval: DatetimeInterval, fields: Iterable[str]=None) -> list:
+        # Only asks Splunk about the parts of the (padded) window it hasn't seen
 
-            # logging.debug(worklist)
+        key = (" ".join(query.split()), tuple(fields or ()))
+        padding = timedelta(minutes=2)
 
-            return worklist
+        def fetch(begin, end):
+            return self.gateway.iter_events(query, DatetimeInterval2(begin, end), fields=fields,
+                                            padding=timedelta(0), with_time=True)
 
+        return self.cache.fetch(key, time_interval.earliest - padding, time_interval.latest + padding, fetch)
 
     def put(self, item: Dixel, host: str, token: str, index: str=None ):
 
@@ -95,8 +144,102 @@ class Splunk(Pattern):
 
         _host = "{}@{}".format(host, self.hostname)
 
+        key = item.meta.get(self.key_field)
+
         # at $time $event was reported by $host for $index with credentials $auth
+        if self.hec_batch is not None:
+            data = self.gateway.event_data( timestamp=timestamp, event=event, host=_host, index=index )
+            buffer = self.gateway.hec_buffer( _token, on_sent=self.record_keys, **self.hec_batch )
+            buffer.add( data, key=(index, key) if key else None )
+            return
+
         self.gateway.put_event( timestamp=timestamp, event=event, host=_host, index=index, token=_token )
+        if key:
+            self.record_keys( [(index, key)] )
 
         # Real auth description
         # headers = {'Authorization': 'Splunk {0}'.format(self.hec_tok[hec])}
+
+    def record_keys(self, keys: Iterable[tuple]):
+        # (index, key) pairs that made it into Splunk
+        if self.keyset is None:
+            return
+        by_index = {}
+        for index, key in keys:
+            by_index.setdefault(index, []).append(key)
+        for index, _keys in by_index.items():
+            self.keyset.add(index, _keys)
+
+    def reconcile_keys(self, index: str):
+        # Replace the local key set with what the index really holds
+        q = "search index={} | dedup {}".format(index, self.key_field)
+        found = self.gateway.iter_events(q, DatetimeInterval2(datetime(1970, 1, 1), datetime.now()),
+                                         fields=[self.key_field], padding=timedelta(0))
+        self.keyset.replace(index, (d.get(self.key_field) for d in found))
+
+    def unknown_keys(self, index: str, keys: Iterable[str], time_interval: DatetimeInterval=None) -> set:
+        # Keys the index doesn't have, only asking Splunk about keys the local
+        # set hasn't seen, and remembering any it turns out to have
+        keys = set(keys)
+        if self.keyset is not None:
+            keys = set(self.keyset.unknown(index, keys))
+        if not keys:
+            return keys
+
+        # Keep the search strings a sane length
+        found = set()
+        batch = sorted(keys)
+        for i in range(0, len(batch), 500):
+            terms = " OR ".join('{}="{}"'.format(self.key_field, k) for k in batch[i:i+500])
+            q = "search index={} ({}) | dedup {}".format(index, terms, self.key_field)
+            found |= set( d.get(self.key_field) for d in
+                          self.gateway.iter_events(q, time_interval, fields=[self.key_field]) )
+
+        if self.keyset is not None:
+            self.keyset.add(index, found)
+        return keys - found
+
+    def flush(self):
+        # Send anything still waiting in the HEC buffers
+        for buffer in self.gateway.hec_buffers.values():
+            buffer.flush()
+
+
+def test_find_items_cache():
+
+    t0 = datetime(2018, 10, 1, 12)
+
+    class StandInGateway(object):
+        # A study every minute, each search is recorded
+        def __init__(self):
+            self.searches = []
+
+        def iter_events(self, q, timerange=None, fields=None, padding=None, with_time=False):
+            self.searches.append((timerange.earliest, timerange.latest))
+            for m in range(-10, 30):
+                t = t0 + timedelta(minutes=m)
+                if timerange.earliest <= t <= timerange.latest:
+                    event = {"AccessionNumber": str(m), "level": "study"}
+                    yield (t, event) if with_time else event
+
+    splunk = Splunk(query_cache={"maxsize": 10})
+    splunk.gateway = StandInGateway()
+
+    def accessions(items):
+        return sorted(int(d.meta["AccessionNumber"]) for d in items)
+
+    window = DatetimeInterval2(t0, t0 + timedelta(minutes=10))
+    first = splunk.find_items("search index=dicom", window)
+    # The padded window is searched once, then served from the cache
+    assert accessions(first) == list(range(-2, 13)) and len(splunk.gateway.searches) == 1
+    assert accessions(splunk.find_items("search index=dicom", window)) == accessions(first)
+    assert len(splunk.gateway.searches) == 1
+
+    # A later window only searches the part it hasn't seen
+    later = DatetimeInterval2(t0 + timedelta(minutes=5), t0 + timedelta(minutes=15))
+    assert accessions(splunk.find_items("search index=dicom", later)) == list(range(3, 18))
+    assert splunk.gateway.searches[-1] == (t0 + timedelta(minutes=12), t0 + timedelta(minutes=17))
+
+    # Nothing found is still None
+    empty = DatetimeInterval2(t0 + timedelta(hours=1), t0 + timedelta(hours=2))
+    assert splunk.find_items("search index=dicom", empty) is None
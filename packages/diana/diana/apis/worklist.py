@@ -0,0 +1,133 @@
+"""
+Worklist of dixels indexed by a key tuple, for diffing what a source has
+against what a dest already holds without nested scans.
+
+>>> recent = Worklist(orthanc.find(q, DicomLevel.SERIES, "pacs"), key=SERIES)
+>>> indexed = splunk.find_items_iter(q2, fields=SERIES)
+>>> new_items = recent.difference(indexed)
+
+`other` may be another Worklist, any iterable of dixels (only their keys are
+kept, so a stream is never held in memory) or a set of key tuples.  Items
+missing a key field never match anything.
+"""
+
+from collections import OrderedDict
+from typing import Iterable, Tuple, Set, Union, Iterator
+import attr
+from .dixel import Dixel
+
+ACCESSION = ("AccessionNumber",)
+STUDY = ("StudyInstanceUID",)
+SERIES = ("StudyInstanceUID", "SeriesInstanceUID")
+INSTANCE = ("StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID")
+
+
+@attr.s(init=False)
+class Worklist(object):
+    key = attr.ib()
+    index = attr.ib( repr=False )   # key tuple -> [dixels]
+
+    def __init__(self, items: Iterable[Dixel]=(), key: Tuple[str]=ACCESSION):
+        self.key = tuple(key)
+        self.index = OrderedDict()
+        for item in items:
+            self.add(item)
+
+    def key_of(self, item: Dixel, key: Tuple[str]=None) -> Tuple:
+        return tuple( item.meta.get(k) for k in key or self.key )
+
+    def keys_of(self, items: Iterable[Dixel], key: Tuple[str]=None) -> Set[Tuple]:
+        return set( self.key_of(item, key) for item in items )
+
+    def add(self, item: Dixel):
+        self.index.setdefault(self.key_of(item), []).append(item)
+
+    def other_keys(self, other: Union["Worklist", Iterable[Dixel], Set[Tuple]]) -> Set[Tuple]:
+        if isinstance(other, Worklist) and other.key == self.key:
+            return other.index.keys()
+        if isinstance(other, (set, frozenset)):
+            return other
+        return self.keys_of(other)
+
+    @staticmethod
+    def complete(k: Tuple) -> bool:
+        return all(v is not None for v in k)
+
+    def difference(self, other) -> "Worklist":
+        # Items without a match in other
+        keys = self.other_keys(other)
+        return self.filtered(lambda k: not self.complete(k) or k not in keys)
+
+    def intersection(self, other) -> "Worklist":
+        # Items with a match in other
+        keys = self.other_keys(other)
+        return self.filtered(lambda k: self.complete(k) and k in keys)
+
+    def join(self, other: Iterable[Dixel]) -> Iterator[Tuple[Dixel, Dixel]]:
+        # (ours, theirs) for every pair sharing a key, hashing on our side
+        for theirs in other:
+            k = self.key_of(theirs)
+            if self.complete(k):
+                for ours in self.index.get(k, []):
+                    yield ours, theirs
+
+    def filtered(self, keep) -> "Worklist":
+        w = Worklist(key=self.key)
+        for k, items in self.index.items():
+            if keep(k):
+                w.index[k] = list(items)
+        return w
+
+    def reindex(self, key: Tuple[str]) -> "Worklist":
+        return Worklist(self, key=key)
+
+    __sub__ = difference
+    __and__ = intersection
+
+    def __contains__(self, item: Union[Dixel, Tuple]) -> bool:
+        k = item if isinstance(item, tuple) else self.key_of(item)
+        return self.complete(k) and k in self.index
+
+    def __iter__(self) -> Iterator[Dixel]:
+        for items in self.index.values():
+            yield from items
+
+    def __len__(self) -> int:
+        return sum( len(items) for items in self.index.values() )
+
+
+def test_worklist():
+
+    from ..utils.dicom import DicomLevel
+
+    def series(an, stuid, seruid):
+        return Dixel(meta={"AccessionNumber": an, "StudyInstanceUID": stuid,
+                           "SeriesInstanceUID": seruid}, level=DicomLevel.SERIES)
+
+    recent = Worklist([series("a", "1", "1.1"), series("a", "1", "1.2"),
+                       series("b", "2", "2.1"), series(None, "3", "3.1")])
+    assert len(recent) == 4
+
+    indexed = [series("a", "1", "1.1"), series(None, "3", "3.1")]
+
+    # Both series of "a" match by accession, the one without an accession never does
+    new = recent.difference(indexed)
+    assert sorted(d.meta["SeriesInstanceUID"] for d in new) == ["2.1", "3.1"]
+    assert len(recent & indexed) == 2
+
+    # By series, only the exact series match
+    by_series = recent.reindex(SERIES)
+    assert len(by_series - indexed) == 2
+    assert series("x", "1", "1.2") in by_series
+
+    # Keys as a set
+    assert len(recent.intersection({("b",)})) == 1
+
+    pairs = list(by_series.join(indexed))
+    assert [(a.meta["SeriesInstanceUID"], b.meta["SeriesInstanceUID"]) for a, b in pairs] == \
+           [("1.1", "1.1"), ("3.1", "3.1")]
+
+
+if __name__ == "__main__":
+
+    test_worklist()
@@ -2,6 +2,7 @@ import logging
 from typing import Collection, Union
 import attr
 from ..apis import Dixel, Orthanc, DicomFile, Splunk
+from ..apis.worklist import Worklist, ACCESSION
 from ..utils import Pattern
 
 
@@ -11,14 +12,15 @@ class Surveyor(object):
     source_domain = attr.ib( type=str, default=None )
     dest = attr.ib( type=Pattern, default=None )
     dest_domain = attr.ib( type=str, default=None )
+    key = attr.ib( default=ACCESSION )   # Meta fields that identify an item in both
 
     def find_items(self, source_query, dest_query=None) -> Collection:
 
-        candidates = self.source.find_items(source_query)
+        candidates = Worklist(self.source.find_items(source_query) or [], key=self.key)
 
-        if self.index and dest_query:
-            discovered = self.dest.find_items(dest_query)
-            return candidates - discovered
+        if self.dest is not None and dest_query:
+            discovered = self.dest.find_items(dest_query) or []
+            return candidates.difference(discovered)
         else:
             return candidates
 
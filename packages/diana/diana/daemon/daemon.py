@@ -1,3 +1,4 @@
+from ..apis import Dixel
 from ..utils.dicom import DicomLevel
 
 
@@ -72,27 +73,26 @@ def index_remote_series( proxy, remote_aet, index, dcm_query=None, splunk_query=
     copy_items(new_items, proxy, index, splunk_index=splunk_index)
 
 
-def route( source, dest, **kwargs ):
+def route( source, dest, batch_size=None, **kwargs ):
 
     current = 0
     done = False
 
     while not done:
-        changes = source.changes( since=current, limit=10 )
-        ret = source.requester.do_get('changes', params={ "since": current, "limit": 10 })
+        ret = source.gateway.changes( current=current, limit=batch_size or source.send_batch_size )
 
-        for change in ret['Changes']:
-            # We are only interested interested in the arrival of new instances
-            if change['ChangeType'] == 'NewInstance':
-                source.send( change['ID'], dest, level=DicomLevel.INSTANCES ).get()
-                source.remove( change['ID'], level=DicomLevel.INSTANCES )
+        # We are only interested interested in the arrival of new instances
+        new_instances = [ change['ID'] for change in ret['Changes']
+                          if change['ChangeType'] == 'NewInstance' ]
+
+        # One store request per page of changes, only remove what was sent
+        sent = source.send_batch( new_instances, peer_dest=dest, batch_size=batch_size )
+        for oid, ok in sent.items():
+            if ok:
+                source.remove( Dixel( meta={'oid': oid}, level=DicomLevel.INSTANCES ) )
 
         current = ret['Last']
         done = ret['Done']
 
-    source.changes( clear=True )
-    source.exports( clear=True )
-
-
-
-
+    source.clear( desc="changes" )
+    source.clear( desc="exports" )
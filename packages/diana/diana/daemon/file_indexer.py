@@ -117,7 +117,7 @@ class FileIndexer(object):
         dixels = self.find_items_for(accession_number)
         for d in dixels:
             # logging.debug(type(d))
-            d = self.filehandler.get(d, view="file")
+            d = self.filehandler.get(d, view="file", stream=True)
             dest.put(d)
 
 
@@ -10,6 +10,7 @@ with more complex discrimination if necessary.
 import logging
 import attr
 from ..utils.dicom import DicomLevel
+from ..apis.worklist import Worklist, ACCESSION
 from .harvester import Harvester
 
 
@@ -50,12 +51,8 @@ class DoseReportHarvester(Harvester):
         if not recent_sr_series:
             return
 
-        recent_ctsr_series = set()
-
         # Candidates = any SR series from a CT study
-        for item in recent_sr_series:
-            if item.AccessionNumber in [item.AccessionNumber for item in recent_ct_studies]:
-                recent_ctsr_series.add(item)
+        recent_ctsr_series = Worklist(recent_sr_series, key=ACCESSION).intersection(recent_ct_studies)
 
         logging.info("Found {} items from {}-{}".format(len(recent_ctsr_series), *self.time_window.as_dicom2()))
 
@@ -64,7 +61,9 @@ class DoseReportHarvester(Harvester):
     def discover_indexed(self):
 
         q = "search index={} | dedup AccessionNumber".format(self.dest_domain, self.source.location)
-        indexed = self.dest.find_items(q, time_interval=self.time_window)
+        # Stream just the keys rather than holding the whole window's events
+        indexed = self.dest.find_items_iter(q, time_interval=self.time_window,
+                                            fields=["AccessionNumber"])
         return indexed
 
     def handle_worklist(self, worklist):
@@ -86,3 +85,7 @@ class DoseReportHarvester(Harvester):
             d = self.source.get(series.oid(), level=DicomLevel.SERIES, view="instance_tags")
             self.dest.put(d, index=self.dest_domain, host=self.source.location, hec=self.dest_domain)
             self.source.remove(d)
+
+        # Push out any buffered events before the next discovery pass looks for them
+        if hasattr(self.dest, "flush"):
+            self.dest.flush()
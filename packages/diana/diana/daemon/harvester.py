@@ -13,6 +13,7 @@ TODO: Collect := at interval: Survey(source, q, dest, q) -> worklist; Transport(
 import logging, datetime, time
 import attr
 from ..utils import DatetimeInterval
+from ..apis.worklist import Worklist, ACCESSION
 
 
 @attr.s
@@ -30,6 +31,7 @@ class Harvester(object):
     time_window = attr.ib( init=False, type=DatetimeInterval )
 
     repeat_while = attr.ib( default=True )  # stop condition, false = once?
+    reconcile_period = attr.ib( default=86400 )  # secs between full key set reconciles with the dest
 
     @time_window.default
     def set_dtinterval(self):
@@ -53,21 +55,33 @@ class Harvester(object):
             return
 
         try:
+            if getattr(self.dest, "keyset", None) is not None:
+                # The dest remembers what it has indexed, only ask about the rest
+                new_items = self.discover_unindexed(recent)
+                if not new_items:
+                    logging.debug("No new items, nothing to do")
+                    return
+                logging.debug("Need to collect {} new items".format(len(new_items)))
+                self.handle_worklist(new_items)
+                return
+
+            recent = Worklist(recent, key=ACCESSION)
             indexed = self.discover_indexed()
 
-            if not indexed:
+            # May be a generator, so only keep the keys
+            indexed_keys = recent.keys_of( indexed or [] )
+
+            if not indexed_keys:
                 logging.debug("No items indexed, need to collect {} recent items".format(len(recent)))
                 new_items = recent
                 self.handle_worklist(new_items)
                 return
 
-            logging.debug("COMPARE==============================")
-            logging.debug( [x.AccessionNumber for x in recent] )
-            logging.debug( [y.AccessionNumber for y in indexed] )
-            logging.debug("=============================/COMPARE")
+            # Counts only, the key sets may be very large
+            logging.debug("Comparing {} recent items to {} indexed keys".format(
+                len(recent), len(indexed_keys)))
 
-            new_items = set( x for x in recent if x.meta["AccessionNumber"] not in
-                             [y.meta['AccessionNumber'] for y in indexed])
+            new_items = recent.difference(indexed_keys)
         except NotImplementedError:
             # Indexer not working, take them all
             logging.debug("No indexer available")
@@ -86,5 +100,16 @@ class Harvester(object):
     def discover_indexed(self):
         raise NotImplementedError
 
+    def discover_unindexed(self, recent):
+        # Needs a dest with a local key set, ie, Splunk(indexed_keys={...})
+        if self.dest.keyset.needs_reconcile(self.dest_domain, self.reconcile_period):
+            self.dest.reconcile_keys(self.dest_domain)
+
+        recent = Worklist(recent, key=ACCESSION)
+        unknown = self.dest.unknown_keys(self.dest_domain,
+                                         [k for (k,) in recent.index if k],
+                                         time_interval=self.time_window)
+        return recent.intersection( set( (k,) for k in unknown ) )
+
     def handle_worklist(self, worklist):
         raise NotImplementedError
@@ -12,11 +12,13 @@ files -> splunk
 
 """
 
-import logging
-from typing import Union
+import logging, asyncio, time, os, tempfile, threading
+from typing import Union, List, Mapping
 import attr
-from ..apis import MetaCache, Orthanc, DicomFile, Dixel
-from ..utils import Pattern
+from ..apis import MetaCache, Orthanc, DicomFile, Dixel, CompactDixel
+from ..utils import Pattern, ProgressJournal, LeaseQueue
+from ..utils.pattern import process_hostname
+from ..utils.pipeline import Pipeline, Stage
 
 @attr.s
 class Porter(object):
@@ -25,59 +27,511 @@ class Porter(object):
     dest = attr.ib( type=Pattern, default=None )
     explode = attr.ib( default=None )
     peer_dest = attr.ib( default=None, type=str )
+    max_jobs = attr.ib( default=10 )              # Orthanc jobs in flight for `run_jobs`
+    job_polling_interval = attr.ib( default=0.5 )
+    journal = attr.ib( default=None, type=ProgressJournal )  # Records progress, and resumes from it
+    progress_every = attr.ib( default=100 )       # Log throughput and ETA every n finished items
+    stage_workers = attr.ib( factory=dict )       # Overrides for STAGE_WORKERS in `run_pipelined`
+    read_ahead = attr.ib( default=4 )             # Items queued ahead of each pipeline stage
+    spool = attr.ib( default=None )               # Dir for downloaded archives, or the system tmp
+    lease_poll_interval = attr.ib( default=10 )   # Secs between asking for other workers' expired leases
+    finished = attr.ib( init=False, default=0 )
+    total = attr.ib( init=False, default=None )
+    leases = attr.ib( init=False, default=None )  # Shared queue in `run_leased`
+    owner = attr.ib( init=False, default=None )
+    released = attr.ib( init=False, factory=threading.Event, repr=False )
+    lock = attr.ib( init=False, factory=threading.Lock, repr=False )
+
+    # Workers per stage for `run_pipelined`.  Retrieves are C-MOVEs that mostly
+    # wait on the PACS, so more of them run at once
+    STAGE_WORKERS = {"retrieve": 4, "anonymize": 2, "download": 2, "put": 2, "clean": 1}
     # anonymize = attr.ib( default=True )
 
     def run2(self, dixels: MetaCache):
 
+        if hasattr(self, "move_items"):
+            return self.run2_batched(dixels)
+
         for d in dixels:
             e = self.get_item(d)
             if e:
                 self.move_item(e)
                 self.source.remove(e)
 
+    def run2_batched(self, dixels: MetaCache):
+        # Move items a batch at a time, only cleaning up the ones that made it
+
+        def flush(batch):
+            sent = self.move_items(batch)
+            for e in batch:
+                if sent.get(e.oid()):
+                    self.source.remove(e)
+
+        batch = []
+        for d in dixels:
+            e = self.get_item(d)
+            if e:
+                batch.append(e)
+            if len(batch) >= self.source.send_batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+    def run2_pipelined(self, dixels: MetaCache) -> Mapping[str, Mapping]:
+        # As `run2`, with get_item, move_item and the clean up as pipeline stages
+
+        def move(e: Dixel) -> Dixel:
+            self.move_item(e)
+            return e
+
+        def clean(e: Dixel) -> Dixel:
+            self.source.remove(e)
+            return e
+
+        workers = dict(self.STAGE_WORKERS, **self.stage_workers)
+        return Pipeline([Stage("retrieve", self.get_item, workers["retrieve"], self.read_ahead),
+                         Stage("put", move, workers["put"], self.read_ahead),
+                         Stage("clean", clean, workers["clean"], self.read_ahead)]).run(dixels)
+
     # def get_item(self, d: Dixel) -> Dixel:
     #     raise NotImplementedError
     #
     # def move_item(self, d: Dixel) -> Dixel:
     #     raise NotImplementedError
 
-    # Original Proxy+FileHandler
-    def run(self, dixels: MetaCache):
+    # Journal
 
-        for d in dixels:
+    def journal_key(self, d: Dixel) -> str:
+        # Accession number, or the oid for items without one
+        key = d.meta.get("AccessionNumber")
+        if not key:
+            try:
+                key = d.oid()
+            except (KeyError, ValueError):
+                logging.warning("No journal key for {}".format(d))
+        return key
+
+    def checkpoint(self, key: str, state: str, **kwargs):
+        # Journaled before the lease is let go, so a crash in between leaves an
+        # item that is re-leased and then passed over as finished
+        if self.journal is not None:
+            self.journal.mark(key, state, **kwargs)
+        if state in ProgressJournal.FINISHED + ("failed",):
+            self.release(key, state, kwargs.get("note"))
+        if self.journal is None and self.leases is None:
+            return
+        if state in ProgressJournal.FINISHED:
+            with self.lock:
+                self.finished += 1
+                report = self.finished % self.progress_every == 0
+            if report:
+                self.log_progress()
+
+    def resume_state(self, key: str, d: Dixel) -> Union[str, None]:
+        # Picks up the meta the item was retrieved with, so later steps don't
+        # have to ask the PACS again
+        if self.journal is None:
+            return
+        entry = self.journal.entry(key)
+        if not entry:
+            return
+        if entry["meta"]:
+            d.meta.update(entry["meta"])
+        return entry["state"]
+
+    def resume_anonymized(self, key: str, d: Dixel) -> Union[Dixel, None]:
+        # The anonymized copy a previous run left in the proxy, so it isn't
+        # anonymized again.  None if there isn't one, or it is gone.
+        if self.journal is None:
+            return
+        entry = self.journal.entry(key)
+        if not entry or entry["state"] != "anonymized" or not entry["sham_oid"]:
+            return
+        try:
+            return self.source.get(entry["sham_oid"], level=d.level)
+        except Exception as ex:
+            logging.debug("Anonymizing {} again ({})".format(key, ex))
+
+    def progress(self, total: int=None) -> Mapping:
+        # Across all workers when running from a lease queue
+        if self.leases is not None:
+            return self.leases.progress()
+        total = total if total is not None else self.total
+        return self.journal.progress(total=total)
+
+    def log_progress(self):
+        p = self.progress()
+        eta = "{:.0f}s".format(p["eta"]) if p.get("eta") is not None else "unknown"
+        logging.info("{} done{}, {:.2f} items/s, ETA {}".format(
+            p["done"], " of {}".format(self.total) if self.total else "", p["rate"], eta))
+
+    def start(self, dixels):
+        self.finished = 0
+        self.total = len(dixels) if hasattr(dixels, "__len__") else None
+
+    def clean_up(self, key: str, d: Dixel):
+        # Stored but not cleaned: remove the original and anonymized copies by oid
+        entry = self.journal.entry(key)
+        for oid in (entry["oid"], entry["sham_oid"]):
+            if oid:
+                try:
+                    self.source.remove(Dixel(meta={'oid': oid}, level=d.level))
+                except Exception as ex:
+                    logging.debug("Could not remove {} ({})".format(oid, ex))
+        self.checkpoint(key, "cleaned")
+
+    def retrieve_item(self, d: Dixel, state: str=None) -> Union[Dixel, None]:
+
+        key = self.journal_key(d)
+
+        if state in ("retrieved", "anonymized"):
+            # Already in the proxy, no need to probe the dest or the PACS again
+            return d
 
-            # Check for unfindable
-            if not d.meta.get("StudyInstanceUID"):
-                logging.debug("Skipping {} - apparently unfindable".format(d.meta["ShamAccession"]))
-                continue
+        # Check for unfindable
+        if not d.meta.get("StudyInstanceUID"):
+            logging.debug("Skipping {} - apparently unfindable".format(d.meta["ShamAccession"]))
+            self.checkpoint(key, "skipped", note="unfindable")
+            return
 
+        if state != "found":
             # Check and see if file already exists
             if self.dest.check(d, fn_from="ShamAccession", explode=self.explode):
                 logging.debug("Skipping {} - already exists".format(d.meta["ShamAccession"]))
-                continue
+                self.checkpoint(key, "skipped", note="exists")
+                return
+            self.checkpoint(key, "found")
 
-            # Shouldn't have a self-mutating function that can go to None...
-            my_accession = d.meta['ShamAccession']
-            d = self.source.find_item(d, self.proxy_domain, True)
+        # Shouldn't have a self-mutating function that can go to None...
+        my_accession = d.meta['ShamAccession']
+        d = self.source.find_item(d, self.proxy_domain, True)
 
-            if not d:
-                # obviously not d b/c d is None by now...
-                logging.debug("Skipping {} - found but unretrievable".format(my_accession))
+        if not d:
+            # obviously not d b/c d is None by now...
+            logging.debug("Skipping {} - found but unretrievable".format(my_accession))
+            self.checkpoint(key, "failed", note="unretrievable")
+            return
+
+        self.checkpoint(key, "retrieved", meta=d.meta)
+        return d
+
+    # Original Proxy+FileHandler
+    def run(self, dixels: MetaCache):
+        # With a journal, finished items are passed over and the rest pick up
+        # after their last recorded step
+
+        self.start(dixels)
+
+        for d in dixels:
+
+            key = self.journal_key(d)
+            state = self.resume_state(key, d)
+            if state in ProgressJournal.FINISHED:
+                continue
+            if state == "stored":
+                self.clean_up(key, d)
                 continue
 
-            try:
-                e = self.source.anonymize(d)
-            except:
-                logging.debug("Skipping {} - can not anonymize (bad uid?)".format(d.meta["ShamAccession"]))
+            d = self.retrieve_item(d, state)
+            if not d:
                 continue
 
-            e = self.source.get(e, view="archive")
+            e = self.resume_anonymized(key, d) if state == "anonymized" else None
+            if e is None:
+                try:
+                    e = self.source.anonymize(d)
+                except:
+                    logging.debug("Skipping {} - can not anonymize (bad uid?)".format(d.meta["ShamAccession"]))
+                    self.checkpoint(key, "failed", note="anonymize")
+                    continue
+                self.checkpoint(key, "anonymized", oid=d.oid(), sham_oid=e.oid())
+
+            e = self.source.get(e, view="archive", stream=True)
 
             self.dest.put(e, fn_from="AccessionNumber", explode=self.explode)
+            self.checkpoint(key, "stored")
 
             # Clean up proxy as you go
             self.source.remove(d)
             self.source.remove(e)
+            self.checkpoint(key, "cleaned")
+
+    # Same workflow as `run`, but anonymization and zipping run as Orthanc jobs,
+    # with up to `max_jobs` of them in flight instead of blocking on each one
+    def run_jobs(self, dixels: MetaCache):
+
+        self.start(dixels)
+        dixels = iter(dixels)
+        in_flight = []    # (stage, job, original, anonymized, journal key)
+        exhausted = False
+
+        while in_flight or not exhausted:
+
+            while not exhausted and len(in_flight) < self.max_jobs:
+                d = next(dixels, None)
+                if d is None:
+                    exhausted = True
+                    break
+
+                key = self.journal_key(d)
+                state = self.resume_state(key, d)
+                if state in ProgressJournal.FINISHED:
+                    continue
+                if state == "stored":
+                    self.clean_up(key, d)
+                    continue
+
+                d = self.retrieve_item(d, state)
+                if not d:
+                    continue
+
+                e = self.resume_anonymized(key, d) if state == "anonymized" else None
+                if e is not None:
+                    in_flight.append(("archive", self.source.archive(e), d, e, key))
+                    continue
+
+                try:
+                    job = self.source.anonymize(d, asynchronous=True)
+                except:
+                    logging.debug("Skipping {} - can not anonymize (bad uid?)".format(d.meta["ShamAccession"]))
+                    self.checkpoint(key, "failed", note="anonymize")
+                    continue
+                in_flight.append(("anonymize", job, d, None, key))
+
+            waiting = []
+            for stage, job, d, e, key in in_flight:
+
+                try:
+                    job.poll()
+                except Exception as ex:
+                    logging.debug("Skipping {} - can not poll {} job ({})".format(d.meta["ShamAccession"], stage, ex))
+                    self.checkpoint(key, "failed", note=stage)
+                    continue
+                if not job.done:
+                    waiting.append((stage, job, d, e, key))
+                    continue
+
+                try:
+                    if stage == "anonymize":
+                        e = self.source.anonymized(d, job)
+                        self.checkpoint(key, "anonymized", oid=d.oid(), sham_oid=e.oid())
+                        waiting.append(("archive", self.source.archive(e), d, e, key))
+                    else:
+                        e = self.source.archived(e, job, stream=True)
+                        self.dest.put(e, fn_from="AccessionNumber", explode=self.explode)
+                        self.checkpoint(key, "stored")
+
+                        # Clean up proxy as you go
+                        self.source.remove(d)
+                        self.source.remove(e)
+                        self.checkpoint(key, "cleaned")
+                except Exception as ex:
+                    logging.debug("Skipping {} - {} job failed ({})".format(d.meta["ShamAccession"], stage, ex))
+                    self.checkpoint(key, "failed", note=stage)
+
+            in_flight = waiting
+            if in_flight:
+                time.sleep(self.job_polling_interval)
+
+    # Same workflow as `run`, but each step is a pipeline stage with its own
+    # workers, so the next studies are retrieving while the current ones
+    # anonymize and download.  Items are (journal key, original, anonymized).
+    def run_pipelined(self, dixels: MetaCache) -> Mapping[str, Mapping]:
+
+        self.start(dixels)
+        workers = dict(self.STAGE_WORKERS, **self.stage_workers)
+        stages = [Stage(name, func, workers=workers[name], maxsize=self.read_ahead)
+                  for name, func in (("retrieve", self.retrieve_stage),
+                                     ("anonymize", self.anonymize_stage),
+                                     ("download", self.download_stage),
+                                     ("put", self.put_stage),
+                                     ("clean", self.clean_stage))]
+        pipeline = Pipeline(stages, on_error=self.stage_failed)
+        stats = pipeline.run((self.journal_key(d), d) for d in dixels)
+        for name, s in stats.items():
+            logging.info("{:10} {done} done, {dropped} dropped, {failed} failed, "
+                         "{busy:.1f}s busy".format(name, **s))
+        return stats
+
+    def stage_failed(self, stage: str, item: tuple, ex: Exception):
+        key, d = item[:2]
+        logging.debug("Skipping {} - {} failed ({})".format(d.meta.get("ShamAccession"), stage, ex))
+        self.checkpoint(key, "failed", note=stage)
+        if len(item) > 2 and isinstance(item[2].file, str):
+            self.unspool(item[2])
+
+    def retrieve_stage(self, item: tuple) -> Union[tuple, None]:
+        key, d = item
+        state = self.resume_state(key, d)
+        if state in ProgressJournal.FINISHED:
+            self.release(key, state)
+            return
+        if state == "stored":
+            self.clean_up(key, d)
+            return
+        d = self.retrieve_item(d, state)
+        if d:
+            return key, d
+
+    # Shared worklist
+
+    def share(self, dixels: MetaCache, queue: LeaseQueue):
+        # Adds a worklist to a lease queue, for `run_leased` porters on each proxy
+        queue.add((self.journal_key(d), (d.level, dict(d.meta))) for d in dixels)
+
+    def release(self, key: str, state: str, note: str=None):
+        if self.leases is None:
+            return
+        self.leases.release(self.owner, key, failed=(state == "failed"), note=note or state)
+        self.released.set()
+
+    def leased(self, batch: int):
+        # Leases items a batch at a time until none are left.  While items are
+        # still leased, waits for one of ours to be released (a failure goes
+        # back in the queue) or for another worker's lease to run out.
+        while True:
+            self.released.clear()
+            items = self.leases.lease(self.owner, n=batch)
+            for key, (level, meta) in items:
+                yield CompactDixel(meta=meta, level=level)
+            if not items:
+                if not self.leases.pending():
+                    return
+                self.released.wait(self.lease_poll_interval)
+
+    def run_leased(self, queue: LeaseQueue, owner: str=None, batch: int=None) -> Mapping[str, Mapping]:
+        # Pipelined run over a lease queue shared with porters on other proxies.
+        # A heartbeat renews this worker's leases every third of their ttl, so
+        # only a dead worker's items are reassigned.
+
+        self.leases = queue
+        self.owner = owner or "{}-{}".format(process_hostname(), os.getpid())
+        if batch is None:
+            # Enough to keep every stage busy
+            batch = sum(dict(self.STAGE_WORKERS, **self.stage_workers).values())
+
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(queue.ttl / 3):
+                queue.renew(self.owner)
+
+        beat = threading.Thread(target=heartbeat, name="lease-heartbeat", daemon=True)
+        beat.start()
+        try:
+            return self.run_pipelined(self.leased(batch))
+        finally:
+            stopped.set()
+            beat.join()
+            self.leases = None
+
+    def anonymize_stage(self, item: tuple) -> Union[tuple, None]:
+        key, d = item
+        e = self.resume_anonymized(key, d)
+        if e is not None:
+            return key, d, e
+        try:
+            e = self.source.anonymize(d)
+        except:
+            logging.debug("Skipping {} - can not anonymize (bad uid?)".format(d.meta["ShamAccession"]))
+            self.checkpoint(key, "failed", note="anonymize")
+            return
+        self.checkpoint(key, "anonymized", oid=d.oid(), sham_oid=e.oid())
+        return key, d, e
+
+    def download_stage(self, item: tuple) -> tuple:
+        # Spools the archive to disk, so a download isn't left holding a proxy
+        # connection open until a put worker is free
+        key, d, e = item
+        e = self.source.get(e, view="archive", stream=True)
+        fd, fp = tempfile.mkstemp(suffix=".zip", dir=self.spool)
+        with os.fdopen(fd, "wb") as f:
+            if isinstance(e.file, (bytes, bytearray)):
+                f.write(e.file)
+            else:
+                for chunk in e.file:
+                    f.write(chunk)
+        e.file = fp
+        return key, d, e
+
+    def unspool(self, e: Dixel):
+        try:
+            os.remove(e.file)
+        except OSError:
+            pass
+
+    def put_stage(self, item: tuple) -> tuple:
+        key, d, e = item
+        self.dest.put(e, fn_from="AccessionNumber", explode=self.explode)
+        self.unspool(e)
+        self.checkpoint(key, "stored")
+        return item
+
+    def clean_stage(self, item: tuple):
+        key, d, e = item
+        self.source.remove(d)
+        self.source.remove(e)
+        self.checkpoint(key, "cleaned")
+        return item
+
+    # Same workflow as `run`, but keeps up to source.max_concurrency items in flight
+    # through the source's async gateway
+    def run_async(self, dixels: MetaCache) -> List[Dixel]:
+        # Returns the items that failed
+        return asyncio.run(self.move_items_async(dixels))
+
+    async def move_items_async(self, dixels: MetaCache) -> List[Dixel]:
+        # A fixed set of workers pulls from the worklist, so items are only read
+        # as they are needed, and an item that fails is logged and passed over
+        # rather than ending the run
+        items = iter(dixels)
+        failed = []
+
+        async def worker():
+            for d in items:
+                try:
+                    await self.move_item_async(d)
+                except Exception as ex:
+                    logging.error("Failed to move {} ({})".format(d.meta.get("ShamAccession"), ex))
+                    failed.append(d)
+
+        await asyncio.gather(*[worker() for _ in range(self.source.max_concurrency)])
+        return failed
+
+    async def move_item_async(self, d: Dixel):
+
+        # Check for unfindable
+        if not d.meta.get("StudyInstanceUID"):
+            logging.debug("Skipping {} - apparently unfindable".format(d.meta["ShamAccession"]))
+            return
+
+        # Check and see if file already exists, off the loop as it hits the disk
+        if await self.source.agateway.run(self.dest.check, d, fn_from="ShamAccession",
+                                          explode=self.explode):
+            logging.debug("Skipping {} - already exists".format(d.meta["ShamAccession"]))
+            return
+
+        my_accession = d.meta['ShamAccession']
+        d = await self.source.find_item_async(d, self.proxy_domain, True)
+
+        if not d:
+            logging.debug("Skipping {} - found but unretrievable".format(my_accession))
+            return
+
+        try:
+            e = await self.source.anonymize_async(d)
+        except:
+            logging.debug("Skipping {} - can not anonymize (bad uid?)".format(d.meta["ShamAccession"]))
+            return
+
+        e = await self.source.get_async(e, view="archive", stream=True)
+
+        await self.source.agateway.run(self.dest.put, e, fn_from="AccessionNumber", explode=self.explode)
+
+        # Clean up proxy as you go
+        await asyncio.gather(self.source.remove_async(d),
+                             self.source.remove_async(e))
 
 
 @attr.s
@@ -127,7 +581,7 @@ class FilePutMixin(object):
     explode = attr.ib( default=None )
 
     def move_item(self, e: Dixel):
-        e = self.source.get(e, view="archive")
+        e = self.source.get(e, view="archive", stream=True)
         self.dest.put(e, fn_from="AccessionNumber", explode=self.explode)
 
 
@@ -138,6 +592,336 @@ class PeerSendMixin(object):
     def move_item(self, e: Dixel):
         self.source.send(e, peer_dest=self.peer_dest)
 
+    def move_items(self, items: List[Dixel]) -> Mapping[str, bool]:
+        return self.source.send_batch(items, peer_dest=self.peer_dest)
+
+
+class _StandInProxy(object):
+    # Orthanc proxy stand-in for the porter tests.  Records its calls and
+    # waits `latency[call]` secs in each, ie, for C-MOVE latency
+
+    def __init__(self, name: str="proxy", latency: Mapping=None):
+        self.name = name
+        self.latency = latency or {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def call(self, name: str, key: str):
+        with self.lock:
+            self.calls.append((name, key))
+        if self.latency.get(name):
+            time.sleep(self.latency[name])
+
+    def find_item(self, d, domain, retrieve):
+        self.call("find", d.meta["AccessionNumber"])
+        d.meta["PatientID"] = "p" + d.meta["AccessionNumber"]
+        return d
+
+    def anonymize(self, d):
+        self.call("anonymize", d.meta["AccessionNumber"])
+        return Dixel(meta={"oid": "sham-" + d.meta["AccessionNumber"],
+                           "AccessionNumber": d.meta["AccessionNumber"]}, level=d.level)
+
+    def get(self, e, view=None, stream=False, level=None):
+        if isinstance(e, str):
+            # By oid, ie, the anonymized copy left by a crashed run
+            self.call("get", e)
+            return Dixel(meta={"oid": e, "AccessionNumber": e[len("sham-"):]}, level=level)
+        self.call("download", e.meta["AccessionNumber"])
+        e.file = (c for c in (b"PK", e.meta["AccessionNumber"].encode()))
+        return e
+
+    def remove(self, d):
+        self.call("remove", d.oid())
 
 
+class _StandInFiles(object):
+    # Destination stand-in, keeps what is put by accession number.  Items in
+    # `exists` are already there, putting one in `fail_on` fails
+
+    def __init__(self, exists=(), fail_on=()):
+        self.exists = set(exists)
+        self.fail_on = set(fail_on)
+        self.calls = []
+        self.stored = {}
+
+    def check(self, d, **kwargs):
+        self.calls.append(("check", d.meta["AccessionNumber"]))
+        return d.meta["AccessionNumber"] in self.exists
+
+    def put(self, e, **kwargs):
+        if e.meta["AccessionNumber"] in self.fail_on:
+            raise IOError("disk full")
+        self.calls.append(("put", e.meta["AccessionNumber"]))
+        if isinstance(e.file, str):
+            # Spooled by run_pipelined
+            with open(e.file, "rb") as f:
+                self.stored[e.meta["AccessionNumber"]] = f.read()
+
+
+class _StandInAsyncProxy(_StandInProxy):
+    # Async handlers over the same calls, keeping track of how many items are
+    # in flight at once.  Finding an item in `unreachable` fails
+
+    max_concurrency = 4
+
+    def __init__(self, *args, unreachable=(), **kwargs):
+        _StandInProxy.__init__(self, *args, **kwargs)
+        self.unreachable = set(unreachable)
+        from ..utils.gateway.async_requester import AsyncRequester
+        self.agateway = AsyncRequester("localhost", "8042", max_concurrency=self.max_concurrency)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def find_item_async(self, d, domain, retrieve):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency.get("find", 0))
+            if d.meta["AccessionNumber"] in self.unreachable:
+                raise ConnectionError("no route to pacs")
+            return self.find_item(d, domain, retrieve)
+        finally:
+            self.in_flight -= 1
+
+    async def anonymize_async(self, d):
+        return self.anonymize(d)
+
+    async def get_async(self, e, view=None, stream=False):
+        return self.get(e, view=view, stream=stream)
+
+    async def remove_async(self, d):
+        self.remove(d)
+
+
+class _StandInJobs(object):
+    # Orthanc job endpoint stand-in.  Each job is Pending, then Running, then
+    # ends as submitted; polling one in `unreachable` fails
+
+    def __init__(self, unreachable=()):
+        self.unreachable = set(unreachable)
+        self.jobs = {}          # jid -> [polls, outcome, content]
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def submit(self, jid: str, outcome: str, content: Mapping=None):
+        from ..utils.gateway import OrthancJob
+        self.jobs[jid] = [0, outcome, content or {}]
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return OrthancJob(self, jid)
+
+    def get(self, resource: str, stream: bool=False):
+        _, jid, *archive = resource.split("/")
+        if archive:
+            return (c for c in (b"PK", jid.encode()))
+        if jid in self.unreachable:
+            self.in_flight -= 1
+            raise ConnectionError("jobs/{} unreachable".format(jid))
+        job = self.jobs[jid]
+        job[0] += 1
+        if job[0] == 3:
+            self.in_flight -= 1
+        states = ["Pending", "Running", job[1]]
+        return {"State": states[min(job[0], 3) - 1], "Content": job[2]}
+
+
+class _StandInJobProxy(_StandInProxy):
+    # Anonymizes and archives through jobs, as Orthanc does for run_jobs.
+    # Anonymizing an item in `failing` ends in a failed job
+
+    def __init__(self, *args, failing=(), unreachable=(), **kwargs):
+        _StandInProxy.__init__(self, *args, **kwargs)
+        self.failing = set(failing)
+        self.jobs = _StandInJobs(unreachable=unreachable)
+
+    def anonymize(self, d, asynchronous=False):
+        accession = d.meta["AccessionNumber"]
+        self.call("anonymize", accession)
+        return self.jobs.submit("anon-" + accession, "Failure" if accession in self.failing else "Success",
+                                {"ID": "sham-" + accession})
+
+    def anonymized(self, d, job):
+        return self.get(job.wait().result()["ID"], level=d.level)
+
+    def archive(self, e):
+        self.call("archive", e.meta["AccessionNumber"])
+        return self.jobs.submit("zip-" + e.meta["AccessionNumber"], "Success")
+
+    def archived(self, e, job, stream=False):
+        e.file = job.wait().archive(stream=stream)
+        return e
+
 
+def _worklist(n: int) -> List[Dixel]:
+    from ..utils.dicom import DicomLevel
+    return [Dixel(meta={"AccessionNumber": str(i), "ShamAccession": "s" + str(i),
+                        "StudyInstanceUID": "1.2.{}".format(i)}, level=DicomLevel.STUDIES)
+            for i in range(n)]
+
+
+def test_porter_journal():
+
+    from ..utils.dicom import DicomLevel
+
+    journal = ProgressJournal()
+    proxy = _StandInProxy()
+    files = _StandInFiles(exists={"0"}, fail_on={"3"})
+    porter = Porter(source=proxy, proxy_domain="pacs", dest=files, journal=journal)
+
+    try:
+        porter.run(_worklist(5))
+    except IOError:
+        pass
+    assert journal.state("0") == "skipped" and journal.state("2") == "cleaned"
+    assert journal.state("3") == "anonymized"
+
+    # The restart only probes and retrieves what it hasn't already
+    del proxy.calls[:], files.calls[:]
+    files.fail_on.clear()
+    porter.run(_worklist(5))
+    calls = proxy.calls + files.calls
+    assert ("check", "0") not in calls and ("check", "3") not in calls
+    assert ("find", "3") not in calls
+    # and picks up the anonymized copy it already made
+    assert ("anonymize", "3") not in calls and ("get", "sham-3") in calls
+    assert ("put", "3") in calls and ("remove", "sham-3") in calls
+    assert ("check", "4") in calls and ("put", "4") in calls
+    assert all(journal.state(str(i)) in ProgressJournal.FINISHED for i in range(5))
+    assert porter.progress()["done"] == 5 and porter.progress()["remaining"] == 0
+
+    # Items without an accession number are journaled by oid
+    d = Dixel(meta={"PatientID": "abc", "StudyInstanceUID": "1.2.3"}, level=DicomLevel.STUDIES)
+    assert porter.journal_key(d) == d.oid()
+
+
+def test_porter_pipeline():
+
+    in_flight = {"find": 0, "max find": 0}
+    lock = threading.Lock()
+    overlapped = threading.Event()
+
+    class SlowProxy(_StandInProxy):
+        def find_item(self, d, domain, retrieve):
+            with lock:
+                in_flight["find"] += 1
+                in_flight["max find"] = max(in_flight["max find"], in_flight["find"])
+                if in_flight["find"] > 1:
+                    overlapped.set()
+            # Hold on until a second retrieve is in flight, however slow the machine
+            overlapped.wait(1.0)
+            d = _StandInProxy.find_item(self, d, domain, retrieve)
+            with lock:
+                in_flight["find"] -= 1
+            return d
+
+    spool = tempfile.mkdtemp()
+    journal = ProgressJournal()
+    files = _StandInFiles(fail_on={"7"})
+    porter = Porter(source=SlowProxy(latency={"find": 0.05, "anonymize": 0.01, "download": 0.02}),
+                    proxy_domain="pacs", dest=files, journal=journal,
+                    spool=spool, stage_workers={"retrieve": 5})
+
+    items = _worklist(20)
+    stats = porter.run_pipelined(items)
+
+    # Retrieves overlap, up to the 5 retrieve workers
+    assert 1 < in_flight["max find"] <= 5
+    assert stats["clean"]["done"] == 19 and stats["put"]["failed"] == 1
+    assert files.stored["3"] == b"PK3" and "7" not in files.stored
+    assert journal.state("7") == "failed" and journal.entry("7")["note"] == "put"
+    assert journal.counts()["cleaned"] == 19
+    # Nothing is left in the spool, failed or not
+    assert os.listdir(spool) == []
+
+    # A second run only redoes the failure
+    files.fail_on.clear()
+    del files.calls[:]
+    stats = porter.run_pipelined(items)
+    assert stats["clean"]["done"] == 1 and ("put", "7") in files.calls
+    assert len([c for c in files.calls if c[0] == "put"]) == 1
+    assert files.stored["7"] == b"PK7"
+
+
+def test_porter_leases():
+
+    class Proxy(_StandInProxy):
+        def anonymize(self, d):
+            if d.meta["AccessionNumber"] == "5":
+                raise ValueError("bad uid")
+            return _StandInProxy.anonymize(self, d)
+
+    fp = os.path.join(tempfile.mkdtemp(), "pull.leases")
+    porters = [Porter(source=Proxy("proxy{}".format(i), latency={"find": 0.01}), proxy_domain="pacs",
+                      dest=_StandInFiles(), spool=tempfile.mkdtemp(), lease_poll_interval=0.05)
+               for i in range(2)]
+    porters[0].share(_worklist(30), LeaseQueue(location=fp))
+
+    # A worker that died holding the first three
+    LeaseQueue(location=fp, ttl=0.3).lease("dead", n=3)
+
+    runs = [threading.Thread(target=p.run_leased,
+                             args=(LeaseQueue(location=fp, ttl=0.3, max_attempts=2), p.source.name))
+            for p in porters]
+    for t in runs:
+        t.start()
+    for t in runs:
+        t.join()
+
+    queue = LeaseQueue(location=fp)
+    # Each item was pulled once, by one of the live porters, and the bad one
+    # was tried twice and given up on
+    keys = [k for p in porters for call, k in p.source.calls if call == "anonymize"]
+    assert sorted(keys, key=int) == [str(i) for i in range(30) if i != 5]
+    assert {"0", "1", "2"} <= set(keys)
+    assert queue.counts() == {"done": 29, "failed": 1}
+    owners = queue.owners()
+    assert set(owners) == {"proxy0", "proxy1"} and sum(owners.values()) == 29
+
+
+def test_porter_async():
+
+    proxy = _StandInAsyncProxy(latency={"find": 0.01}, unreachable={"3"})
+    files = _StandInFiles(exists={"0"})
+    porter = Porter(source=proxy, proxy_domain="pacs", dest=files)
+
+    failed = porter.run_async(_worklist(20))
+
+    # The unreachable item fails alone, everything else goes through
+    assert [d.meta["AccessionNumber"] for d in failed] == ["3"]
+    put = sorted((k for call, k in files.calls if call == "put"), key=int)
+    assert put == [str(i) for i in range(20) if i not in (0, 3)]
+    assert ("remove", "sham-5") in proxy.calls
+
+    # Never more items in flight than the source allows
+    assert 1 < proxy.max_in_flight <= proxy.max_concurrency
+    proxy.agateway.close()
+
+
+def test_porter_jobs():
+
+    journal = ProgressJournal()
+    proxy = _StandInJobProxy(failing={"4"}, unreachable={"zip-6"})
+    files = _StandInFiles()
+    porter = Porter(source=proxy, proxy_domain="pacs", dest=files, journal=journal,
+                    max_jobs=3, job_polling_interval=0)
+
+    # A run that crashed after anonymizing 2
+    d = _worklist(3)[2]
+    d.meta["PatientID"] = "p2"
+    journal.mark("2", "retrieved", meta=d.meta)
+    journal.mark("2", "anonymized", oid=d.oid(), sham_oid="sham-2")
+    porter.run_jobs(_worklist(10))
+
+    # Never more jobs in flight than allowed
+    assert 1 < proxy.jobs.max_in_flight <= 3
+
+    # A failed job, or one that can't be polled, fails only its own item
+    assert journal.state("4") == "failed" and journal.entry("4")["note"] == "anonymize"
+    assert journal.state("6") == "failed" and journal.entry("6")["note"] == "archive"
+    assert journal.counts()["cleaned"] == 8
+    assert sorted(k for call, k in files.calls if call == "put") == \
+        [str(i) for i in range(10) if i not in (4, 6)]
+
+    # The resumed item is archived from its anonymized copy, not anonymized again
+    assert ("anonymize", "2") not in proxy.calls and ("archive", "2") in proxy.calls
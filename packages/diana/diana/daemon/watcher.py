@@ -35,10 +35,12 @@ class DianaWatcher(Watcher):
         logging.debug("Moving {}".format(item))
 
         try:
-            item = source.get(item, view="file")
+            # Send straight from disk, so the file has to outlive the put
+            item = source.get(item, view="file", stream=True)
+            result = dest.put(item)
             if remove:
                 source.remove(item)
-            return dest.put(item)
+            return result
         except DicomFormatError as e:
             logging.error(e)
 
@@ -63,7 +65,8 @@ class DianaWatcher(Watcher):
                      index=None):
         oid = event.event_data
         source = event.event_source
-        item = source.get(oid, level=DicomLevel.SERIES, view="tags")
+        # Tags are only fetched when the dest reads them
+        item = source.get(oid, level=DicomLevel.SERIES, view="lazy")
 
         logging.debug("Indexing {}".format(item))
         logging.debug("Dest: {}".format(dest))
@@ -76,7 +79,8 @@ class DianaWatcher(Watcher):
                      index=None):
         oid = event.event_data
         source = event.event_source
-        item = source.get(oid, level=DicomLevel.INSTANCES, view="tags")
+        # Tags are only fetched when the dest reads them
+        item = source.get(oid, level=DicomLevel.INSTANCES, view="lazy")
 
         logging.debug("Indexing {}".format(item))
         logging.debug("Dest: {}".format(dest))
@@ -116,17 +120,25 @@ class DianaWatcher(Watcher):
 
         logging.debug("Unzipping {}".format(item_fp))
 
+        def unpack(z):
+            for member in z.infolist():
+                logging.debug(member)
+                # member.is_dir() for 3.6 only!
+                if not member.filename.endswith("/"):
+                    # read the file
+                    logging.debug("Uploading {}".format(member))
+                    f = z.read(member)
+                    item = Dixel(level=DicomLevel.INSTANCES, file=f)
+                    logging.debug(item)
+                    yield item
+
         try:
             with zipfile.ZipFile(item_fp) as z:
-                for member in z.infolist():
-                    logging.debug(member)
-                    # member.is_dir() for 3.6 only!
-                    if not member.filename.endswith("/"):
-                        # read the file
-                        logging.debug("Uploading {}".format(member))
-                        f = z.read(member)
-                        item = Dixel(level=DicomLevel.INSTANCES, file=f)
-                        logging.debug(item)
+                if hasattr(dest, "put_batch"):
+                    # One metadata pass for the whole study
+                    dest.put_batch(unpack(z))
+                else:
+                    for item in unpack(z):
                         dest.put(item)
             if remove:
                 os.remove(item_fp)
@@ -207,11 +219,9 @@ class ObservableOrthancProxy(ObservableMixin, Orthanc):
         q['StudyTime'] = "{}-{}".format(t0, t1)
         q.update( self.query_dict )
 
-        response = self.find(q, level=self.query_level, domain=self.query_domain)
-
-        event_queue = []
-
-        for item in response:
+        # Yield events as answers arrive, so the poller can queue them early
+        found = 0
+        for item in self.find_iter(q, level=self.query_level, domain=self.query_domain):
 
             if self.query_level==DicomLevel.STUDIES:
                 match_key = item.meta['StudyInstanceUID']
@@ -225,11 +235,11 @@ class ObservableOrthancProxy(ObservableMixin, Orthanc):
                 # logging.debug("Adding new item")
                 # logging.debug(item)
                 self.discovery_queue.append(match_key)
-                event_queue.append( (DianaEventType.NEW_MATCH, item) )
+                found += 1
+                yield (DianaEventType.NEW_MATCH, item)
 
-        if event_queue:
-            self.logger.debug("Found {} matches on {}".format( len( event_queue ), self.query_domain))
-            return event_queue
+        if found:
+            self.logger.debug("Found {} matches on {}".format( found, self.query_domain))
 
 
 @attr.s(hash=False)
@@ -287,6 +297,7 @@ class ObservableDicomFile(ObservableMixin, DicomFile):
 
         observer.schedule(receiver, self.location, recursive=True)
         observer.start()
+        return observer
 
 
 # def test_anon_queue_routing(watcher:DianaWatcher):
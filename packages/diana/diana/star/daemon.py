@@ -1,6 +1,6 @@
 from .app import app
 from celery import chain
-from ..apis import Orthanc, Splunk
+from ..apis import Orthanc, Splunk, Dixel
 from ..utils.dicom import DicomLevel
 from .tasks import do
 
@@ -101,7 +101,7 @@ def index_remote( proxy, remote_aet, index, dcm_query=None, splunk_query=None, t
         copy(item)
 
 @app.task(name="route")
-def route( source, dest, **kwargs ):
+def route( source, dest, batch_size=None, **kwargs ):
 
     source = Orthanc(source)
 
@@ -109,24 +109,20 @@ def route( source, dest, **kwargs ):
     done = False
 
     while not done:
-        changes = source.changes( since=current, limit=10 )
-        ret = source.requester.do_get('changes', params={ "since": current, "limit": 10 })
+        ret = source.gateway.changes( current=current, limit=batch_size or source.send_batch_size )
 
-        for change in ret['Changes']:
-            # We are only interested interested in the arrival of new instances
-            if change['ChangeType'] == 'NewInstance':
+        # We are only interested interested in the arrival of new instances
+        new_instances = [ change['ID'] for change in ret['Changes']
+                          if change['ChangeType'] == 'NewInstance' ]
 
-                do(change['ID'], "send", peer=dest, level=DicomLevel.INSTANCES, remove=True, pattern=source)
-
-                # source.send( change['ID'], dest, level=DicomLevel.INSTANCES ).get()
-                # source.remove( change['ID'], level=DicomLevel.INSTANCES )
+        # One store request per page of changes rather than a send task per instance
+        sent = source.send_batch( new_instances, peer_dest=dest, batch_size=batch_size )
+        for oid, ok in sent.items():
+            if ok:
+                source.remove( Dixel( meta={'oid': oid}, level=DicomLevel.INSTANCES ) )
 
         current = ret['Last']
         done = ret['Done']
 
     source.clear( desc="exports" )
     source.clear( desc="changes" )
-
-
-
-
@@ -1,7 +1,12 @@
 from .pattern import Pattern
-from .orthanc_id import orthanc_id
+from .orthanc_id import orthanc_id, orthanc_ids, orthanc_ids_for_csv
 from .smart_encode import stringify, SmartJSONEncoder, update_json_file
 from .dtinterval import DatetimeInterval
 from .dtinterval2 import DatetimeInterval as DatetimeInterval2
 from .observable import Event, ObservableMixin, Watcher
 from .import_tricks import merge_dicts_by_glob
+from .cache import TieredCache, IntervalCache
+from .keyset import IndexedKeySet
+from .meta_store import MetaStore
+from .journal import ProgressJournal
+from .leases import LeaseQueue
@@ -0,0 +1,423 @@
+"""
+Two-tier read-through cache: an in-memory LRU in front of an optional sqlite
+file, with size and TTL eviction and hit/miss counters.
+
+Values are pickled on the way into the disk tier and copied on the way in and
+out of the memory tier, so callers can mutate what they get back freely.
+
+Entries can be put in groups, ie, the oids of an instance's series and study,
+so everything under a resource can be invalidated at once.
+
+>>> cache = TieredCache(maxsize=10000, ttl=3600, location="/tmp/tags.db")
+>>> cache.put(("orthanc:8042", "instances", oid, "tags"), tags, groups=[study_oid])
+>>> cache.get(("orthanc:8042", "instances", oid, "tags"))
+>>> cache.invalidate_group(study_oid)
+
+Interval cache: time-stamped results per key (ie, a search) over the spans
+of time already fetched.  Overlapping and adjacent spans are merged, so a
+sliding window only fetches the part it hasn't seen.
+
+>>> cache = IntervalCache(maxsize=100, ttl=3600, settle=300)
+>>> cache.fetch("search index=dose", earliest, latest, fetch_func)
+"""
+
+import logging, os, time, pickle, sqlite3, threading, json
+from collections import OrderedDict, defaultdict
+from copy import deepcopy
+from datetime import datetime, timedelta
+from typing import Hashable, Any, Callable, Iterable, Tuple, List
+import attr
+
+
+@attr.s
+class TieredCache(object):
+    maxsize = attr.ib( default=10000 )     # Entries held in memory
+    ttl = attr.ib( default=None )          # Seconds, or None for no expiry
+    location = attr.ib( default=None )    # sqlite file for the disk tier, or None
+    disk_maxsize = attr.ib( default=1000000 )
+    disk_trim = attr.ib( default=0.9 )     # Fraction of disk_maxsize kept after a trim
+
+    hits = attr.ib( init=False, default=0 )
+    misses = attr.ib( init=False, default=0 )
+    disk_hits = attr.ib( init=False, default=0 )
+
+    memory = attr.ib( init=False, factory=OrderedDict, repr=False )   # key -> (created, value, groups)
+    members = attr.ib( init=False, factory=lambda: defaultdict(set), repr=False )  # group -> keys in memory
+    disk_count = attr.ib( init=False, default=None, repr=False )   # Rows put since the last count
+    lock = attr.ib( init=False, factory=threading.RLock, repr=False )
+    _db = attr.ib( init=False, default=None, repr=False )
+    _db_pid = attr.ib( init=False, default=None, repr=False )
+    logger = attr.ib( init=False, repr=False )
+
+    @logger.default
+    def get_logger(self):
+        return logging.getLogger(__name__)
+
+    @property
+    def db(self):
+        if not self.location:
+            return None
+        # sqlite connections don't survive a fork
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.location, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache "
+                             "(key TEXT PRIMARY KEY, value BLOB, created REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache_groups (grp TEXT, key TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_groups_grp ON cache_groups (grp)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_groups_key ON cache_groups (key)")
+            self._db.commit()
+            self._db_pid = os.getpid()
+            self.disk_count = None
+        return self._db
+
+    @staticmethod
+    def dkey(key: Hashable) -> str:
+        if isinstance(key, tuple):
+            return "|".join(str(k) for k in key)
+        return str(key)
+
+    def expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+
+            entry = self.memory.get(key)
+            if entry is not None:
+                created, value, groups = entry
+                if not self.expired(created):
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return deepcopy(value)
+                self.forget(key)
+
+            if self.db:
+                row = self.db.execute("SELECT value, created FROM cache WHERE key=?",
+                                      (self.dkey(key),)).fetchone()
+                if row and not self.expired(row[1]):
+                    value = pickle.loads(row[0])
+                    groups = [g for (g,) in self.db.execute("SELECT grp FROM cache_groups WHERE key=?",
+                                                            (self.dkey(key),))]
+                    self.remember(key, value, row[1], groups)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return deepcopy(value)
+
+            self.misses += 1
+
+    def remember(self, key: Hashable, value: Any, created: float, groups: Iterable[str]=()):
+        self.forget(key)
+        groups = tuple(groups)
+        self.memory[key] = (created, value, groups)
+        for g in groups:
+            self.members[g].add(key)
+        while len(self.memory) > self.maxsize:
+            self.forget(next(iter(self.memory)))
+
+    def forget(self, key: Hashable):
+        # Memory tier only
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            for g in entry[2]:
+                self.members[g].discard(key)
+                if not self.members[g]:
+                    del self.members[g]
+
+    def put(self, key: Hashable, value: Any, groups: Iterable[str]=()):
+        with self.lock:
+            created = time.time()
+            groups = tuple(groups)
+            self.remember(key, deepcopy(value), created, groups)
+
+            if self.db:
+                dkey = self.dkey(key)
+                self.db.execute("INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)",
+                                (dkey, pickle.dumps(value), created))
+                self.db.execute("DELETE FROM cache_groups WHERE key=?", (dkey,))
+                self.db.executemany("INSERT INTO cache_groups (grp, key) VALUES (?, ?)",
+                                    ((g, dkey) for g in groups))
+                self.trim()
+                self.db.commit()
+
+    def trim(self):
+        # Only walks the index once the table has outgrown disk_maxsize, and
+        # then trims well below it, so most puts don't.  The running count
+        # overcounts replaced keys, the recount before trimming corrects it.
+        if self.disk_count is None:
+            self.disk_count = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        else:
+            self.disk_count += 1
+        if self.disk_count <= self.disk_maxsize:
+            return
+        self.disk_count = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if self.disk_count <= self.disk_maxsize:
+            return
+        keep = int(self.disk_maxsize * self.disk_trim)
+        self.db.execute("DELETE FROM cache WHERE key IN "
+                        "(SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)", (keep,))
+        self.db.execute("DELETE FROM cache_groups WHERE key NOT IN (SELECT key FROM cache)")
+        self.disk_count = keep
+
+    def invalidate(self, key: Hashable):
+        with self.lock:
+            self.forget(key)
+            if self.db:
+                self.db.execute("DELETE FROM cache WHERE key=?", (self.dkey(key),))
+                self.db.execute("DELETE FROM cache_groups WHERE key=?", (self.dkey(key),))
+                self.db.commit()
+
+    def invalidate_group(self, group: str):
+        # Every entry put with this group
+        with self.lock:
+            for key in list(self.members.get(group, ())):
+                self.forget(key)
+            if self.db:
+                self.db.execute("DELETE FROM cache WHERE key IN "
+                                "(SELECT key FROM cache_groups WHERE grp=?)", (group,))
+                self.db.execute("DELETE FROM cache_groups WHERE key IN "
+                                "(SELECT key FROM cache_groups WHERE grp=?)", (group,))
+                self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.members.clear()
+            if self.db:
+                self.db.execute("DELETE FROM cache")
+                self.db.execute("DELETE FROM cache_groups")
+                self.db.commit()
+                self.disk_count = 0
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'size': len(self.memory)}
+
+
+@attr.s
+class IntervalCache(object):
+    maxsize = attr.ib( default=100 )   # Keys held, least recently used go first
+    ttl = attr.ib( default=None )      # Seconds a fetched span is trusted, or None
+    settle = attr.ib( default=0 )      # Seconds before the fetch time that may still change
+
+    hits = attr.ib( init=False, default=0 )     # Lookups served without fetching
+    misses = attr.ib( init=False, default=0 )   # Sub-intervals fetched
+
+    # key -> sorted, disjoint [begin, end, fetched, events], events as sorted (time, value)
+    spans = attr.ib( init=False, factory=OrderedDict, repr=False )
+    lock = attr.ib( init=False, factory=threading.RLock, repr=False )
+
+    def live_spans(self, key: Hashable) -> list:
+        spans = self.spans.get(key, [])
+        if self.ttl is not None:
+            spans = [s for s in spans if time.time() - s[2] <= self.ttl]
+            self.spans[key] = spans
+        return spans
+
+    def missing(self, key: Hashable, begin: datetime, end: datetime) -> List[Tuple[datetime, datetime]]:
+        with self.lock:
+            gaps = []
+            for b, e, _, _ in self.live_spans(key):
+                if e <= begin or b >= end:
+                    continue
+                if b > begin:
+                    gaps.append((begin, b))
+                begin = max(begin, e)
+            if begin < end:
+                gaps.append((begin, end))
+            return gaps
+
+    def add(self, key: Hashable, begin: datetime, end: datetime, events: Iterable[Tuple[datetime, Any]]):
+        fetched = time.time()
+
+        # Don't trust the most recent results to be complete yet
+        end = min(end, datetime.fromtimestamp(fetched - self.settle))
+        if end <= begin:
+            return
+
+        events = sorted(((t, v) for t, v in events if begin <= t <= end), key=lambda x: x[0])
+
+        with self.lock:
+            merged = [begin, end, fetched, events]
+            spans = []
+            for span in self.live_spans(key):
+                if span[1] < merged[0] or span[0] > merged[1]:
+                    spans.append(span)
+                    continue
+                # Overlapping or adjacent, combine them
+                merged = [min(span[0], merged[0]), max(span[1], merged[1]), min(span[2], merged[2]),
+                          self.merge_events(span[3], merged[3])]
+            spans.append(merged)
+            spans.sort(key=lambda s: s[0])
+
+            self.spans[key] = spans
+            self.spans.move_to_end(key)
+            while len(self.spans) > self.maxsize:
+                self.spans.popitem(last=False)
+
+    @staticmethod
+    def merge_events(a: list, b: list) -> list:
+        seen = set()
+        merged = []
+        for t, v in sorted(a + b, key=lambda x: x[0]):
+            k = (t, json.dumps(v, sort_keys=True, default=str))
+            if k not in seen:
+                seen.add(k)
+                merged.append((t, v))
+        return merged
+
+    def pairs(self, key: Hashable, begin: datetime, end: datetime) -> list:
+        with self.lock:
+            if key in self.spans:
+                self.spans.move_to_end(key)
+            return [(t, v) for b, e, _, events in self.live_spans(key) if e >= begin and b <= end
+                           for t, v in events if begin <= t <= end]
+
+    def get(self, key: Hashable, begin: datetime, end: datetime) -> list:
+        return [v for t, v in self.pairs(key, begin, end)]
+
+    def fetch(self, key: Hashable, begin: datetime, end: datetime,
+              fetch_func: Callable[[datetime, datetime], Iterable[Tuple[datetime, Any]]]) -> list:
+        # fetch_func(begin, end) returns (time, value) pairs for a sub-interval
+
+        gaps = self.missing(key, begin, end)
+        if not gaps:
+            self.hits += 1
+            return self.get(key, begin, end)
+
+        # Fresh results are returned whole, even the unsettled part that isn't kept
+        cached = self.pairs(key, begin, end)
+        fresh = []
+        for b, e in gaps:
+            self.misses += 1
+            events = [(t, v) for t, v in fetch_func(b, e) if b <= t <= e]
+            self.add(key, b, e, events)
+            fresh += events
+
+        return [v for t, v in self.merge_events(cached, fresh)]
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+
+def test_tiered_cache():
+
+    import tempfile
+
+    fp = os.path.join(tempfile.mkdtemp(), "cache.db")
+    cache = TieredCache(maxsize=2, location=fp)
+
+    cache.put(("a", 1), {'x': 1})
+    cache.put(("b", 2), {'x': 2})
+    cache.put(("c", 3), {'x': 3})
+
+    # Evicted from memory, but still on disk
+    assert ("a", 1) not in cache.memory
+    assert cache.get(("a", 1)) == {'x': 1}
+    assert cache.disk_hits == 1
+
+    # Copies out, so callers can't corrupt entries
+    v = cache.get(("b", 2))
+    v['x'] = 100
+    assert cache.get(("b", 2)) == {'x': 2}
+
+    cache.invalidate(("b", 2))
+    assert cache.get(("b", 2)) is None
+
+    # Persists across instances
+    other = TieredCache(location=fp)
+    assert other.get(("c", 3)) == {'x': 3}
+
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get(("c", 3)) is None
+
+    cache.clear()
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['size'] == 0
+
+    # Groups invalidate together, in memory and on disk
+    cache.ttl = None
+    cache.put(("i", 1), 1, groups=["study1", "series1"])
+    cache.put(("i", 2), 2, groups=["study1", "series2"])
+    cache.put(("i", 3), 3, groups=["study2"])
+    cache.invalidate_group("series1")
+    assert cache.get(("i", 1)) is None and cache.get(("i", 2)) == 2
+    cache.invalidate_group("study1")
+    assert cache.get(("i", 2)) is None and other.get(("i", 2)) is None
+    assert cache.get(("i", 3)) == 3
+    assert not cache.members.get("study1")
+
+    # The disk tier is only trimmed once it's over disk_maxsize, and then to
+    # disk_trim of it, keeping the newest
+    small = TieredCache(maxsize=1, location=os.path.join(tempfile.mkdtemp(), "small.db"),
+                        disk_maxsize=10, disk_trim=0.5)
+    for i in range(10):
+        small.put(i, i, groups=["g"])
+    assert small.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 10
+    small.put(10, 10, groups=["g"])
+    assert small.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 5
+    assert small.db.execute("SELECT COUNT(*) FROM cache_groups").fetchone()[0] == 5
+    assert small.get(10) == 10 and small.get(5) is None
+
+
+def test_interval_cache():
+
+    t0 = datetime(2018, 10, 1, 12)
+
+    def at(minutes):
+        return t0 + timedelta(minutes=minutes)
+
+    # An event every minute
+    fetched = []
+    def fetch_func(b, e):
+        fetched.append((b, e))
+        m = 0
+        while at(m) <= e:
+            if at(m) >= b:
+                yield at(m), {'minute': m}
+            m += 1
+
+    cache = IntervalCache(maxsize=2)
+
+    assert len(cache.fetch("q", at(0), at(10), fetch_func)) == 11
+    assert fetched == [(at(0), at(10))]
+
+    # Sliding window only asks for the new part, and the boundary event isn't doubled
+    r = cache.fetch("q", at(5), at(15), fetch_func)
+    assert fetched[-1] == (at(10), at(15))
+    assert [v['minute'] for v in r] == list(range(5, 16))
+
+    # Covered, no fetch; spans were merged into one
+    cache.fetch("q", at(2), at(12), fetch_func)
+    assert len(fetched) == 2 and cache.hits == 1
+    assert len(cache.spans["q"]) == 1
+
+    # A gap in the middle
+    cache.fetch("q", at(20), at(25), fetch_func)
+    assert cache.missing("q", at(0), at(25)) == [(at(15), at(20))]
+
+    # LRU on keys
+    cache.fetch("r", at(0), at(1), fetch_func)
+    cache.fetch("s", at(0), at(1), fetch_func)
+    assert "q" not in cache.spans
+
+    # Recent results are returned, but not kept until they settle
+    cache = IntervalCache(settle=60)
+    now = datetime.now().replace(microsecond=0)
+    r = cache.fetch("q", now - timedelta(minutes=5), now, lambda b, e: [(now, {'x': 1})])
+    assert r == [{'x': 1}]
+    assert cache.missing("q", now - timedelta(minutes=5), now)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    test_tiered_cache()
+    test_interval_cache()
@@ -1,4 +1,6 @@
-from .orthanc import Orthanc
+from .requester import Requester
+from .async_requester import AsyncRequester
+from .orthanc import Orthanc, AsyncOrthanc, OrthancJob
 from .file_handler import DicomFile, TextFile, ImageFile
-from .splunk import Splunk
+from .splunk import Splunk, HECBuffer
 from .montage import Montage
\ No newline at end of file
@@ -0,0 +1,85 @@
+# Diana-agnostic asyncio HTTP Gateways
+
+# Requests are still issued through the pooled, retrying Requester session, but
+# on a worker thread, so a single event loop can keep up to `max_concurrency`
+# calls in flight against each endpoint.
+
+import asyncio, weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Mapping
+import attr
+from .requester import Requester
+
+
+@attr.s
+class AsyncRequester(Requester):
+    max_concurrency = attr.ib(default=10)
+    executor = attr.ib(init=False, repr=False)
+
+    # event loop -> endpoint url -> semaphore, shared by every gateway for an
+    # endpoint; entries go away with their loop, ie, after each asyncio.run
+    semaphores = weakref.WeakKeyDictionary()
+
+    @executor.default
+    def make_executor(self):
+        return ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    def __attrs_post_init__(self):
+        # Never queue in-flight requests behind a smaller connection pool
+        self.pool_size = max(self.pool_size, self.max_concurrency)
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        endpoints = AsyncRequester.semaphores.setdefault(asyncio.get_running_loop(), {})
+        url = self._url()
+        if url not in endpoints:
+            endpoints[url] = asyncio.Semaphore(self.max_concurrency)
+        return endpoints[url]
+
+    async def run(self, func, *args, **kwargs):
+        # Run a blocking call on the gateway's executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def _call(self, func, *args, **kwargs):
+        async with self.semaphore:
+            return await self.run(func, *args, **kwargs)
+
+    async def _get(self, url: str, params: Mapping=None, headers: Mapping=None, auth=None, stream: bool=False):
+        return await self._call(Requester._get, self, url, params=params, headers=headers, auth=auth,
+                                stream=stream)
+
+    async def _put(self, url: str, data=None, headers: Mapping=None, auth=None):
+        return await self._call(Requester._put, self, url, data=data, headers=headers, auth=auth)
+
+    async def _post(self, url: str, params: Mapping=None, data=None, json: Mapping=None, headers: Mapping=None, auth=None):
+        return await self._call(Requester._post, self, url, params=params, data=data, json=json,
+                                headers=headers, auth=auth)
+
+    async def _delete(self, url: str, headers: Mapping=None, auth=None):
+        return await self._call(Requester._delete, self, url, headers=headers, auth=auth)
+
+    def close(self):
+        Requester.close(self)
+        self.executor.shutdown(wait=False)
+
+
+def test_semaphores():
+
+    import gc
+
+    gateway = AsyncRequester("localhost", "8042", max_concurrency=2)
+
+    async def peek():
+        assert gateway.semaphore is gateway.semaphore
+        return gateway.semaphore
+
+    a = asyncio.run(peek())
+    b = asyncio.run(peek())
+    assert a is not b and a._value == 2
+
+    # Closed loops don't keep their semaphores around
+    gc.collect()
+    assert len(AsyncRequester.semaphores) == 0
+    gateway.close()
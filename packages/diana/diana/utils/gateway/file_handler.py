@@ -1,6 +1,6 @@
 # Diana-agnostic Dicom file reading and writing
 
-import logging, os
+import logging, os, shutil
 from typing import Sequence
 import attr
 import pydicom
@@ -94,10 +94,31 @@ class DicomFile(FileHandler):
             self.logger.debug("Creating dir tree for {}".format( os.path.dirname(fp) ))
             os.makedirs(os.path.dirname(fp))
 
-        with open(fp, 'wb+') as f:
-            f.write(data)
-
-    def read(self, fn: str, path: str=None, explode: Sequence=None, pixels: bool=False):
+        # Data may be bytes, a source file path, or an iterable of chunks from a
+        # streamed get.  Write to a partial file first so an interrupted stream
+        # never passes `exists`
+        partial_fp = fp + ".partial"
+        try:
+            if isinstance(data, (str, os.PathLike)):
+                # Kernel-side copy (sendfile) where the platform supports it
+                shutil.copyfile(data, partial_fp)
+            else:
+                with open(partial_fp, 'wb+') as f:
+                    if isinstance(data, (bytes, bytearray, memoryview)):
+                        f.write(data)
+                    else:
+                        for chunk in data:
+                            f.write(chunk)
+            os.replace(partial_fp, fp)
+        except BaseException:
+            # Don't leave a half-written download behind
+            if os.path.exists(partial_fp):
+                os.remove(partial_fp)
+            raise
+
+    def read(self, fn: str, path: str=None, explode: Sequence=None, pixels: bool=False,
+             tags: Sequence[str]=None):
+        # With tags (keywords), only those elements are parsed
         fp = self.fp(fn, path, explode)
         self.logger.debug("Reading {}".format(fp))
 
@@ -119,9 +140,33 @@ class DicomFile(FileHandler):
         if not is_dicom(fp):
             raise DicomFormatError("Not a DCM file: {}".format(fp))
 
-        if not pixels:
-            dcm = pydicom.read_file(fp, stop_before_pixels=True)
+        if tags:
+            tags = [t for t in tags if pydicom.datadict.tag_for_keyword(t)]
+            dcm = pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=tags)
+        elif not pixels:
+            dcm = pydicom.dcmread(fp, stop_before_pixels=True)
         else:
-            dcm = pydicom.read_file(fp)
+            dcm = pydicom.dcmread(fp)
 
         return dcm, fp
+
+
+def test_dicom_file_write():
+
+    import tempfile
+
+    files = DicomFile(location=tempfile.mkdtemp())
+    files.write("a.dcm", (c for c in [b"x" * 10, b"y" * 10]), path="p")
+    with open(files.fp("a.dcm", "p"), 'rb') as f:
+        assert f.read() == b"x" * 10 + b"y" * 10
+
+    def broken():
+        yield b"x" * 10
+        raise ConnectionError("stream dropped")
+
+    try:
+        files.write("b.dcm", broken(), path="p")
+        assert False, "expected the stream error"
+    except ConnectionError:
+        pass
+    assert os.listdir(os.path.join(files.location, "p")) == ["a.dcm"]
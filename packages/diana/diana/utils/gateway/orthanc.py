@@ -1,14 +1,69 @@
 # Diana-agnostic API for orthanc, no endpoint or dixel dependencies
 
 
-import json, logging, re, time
+import json, logging, re, time, asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import Mapping
 from jsmin import jsmin
+import requests
 import attr
-from .requester import Requester
+from .requester import Requester, upload_body
+from .async_requester import AsyncRequester
 from diana.utils.dicom.dicom_level import DicomLevel
 
 
+@attr.s
+class OrthancJob(object):
+    """
+    Handle on an Orthanc asynchronous job.  `poll` never blocks on the job
+    itself, `wait` polls with backoff until it succeeds or fails.
+    """
+    gateway = attr.ib( repr=False )
+    jid = attr.ib()
+    info = attr.ib( factory=dict, repr=False )
+
+    def poll(self) -> dict:
+        self.info = self.gateway.get("jobs/{}".format(self.jid))
+        return self.info
+
+    @property
+    def state(self) -> str:
+        return self.info.get("State", "Pending")
+
+    @property
+    def progress(self) -> int:
+        # Percent complete
+        return self.info.get("Progress", 0)
+
+    @property
+    def done(self) -> bool:
+        return self.state in ["Success", "Failure"]
+
+    def wait(self, timeout: float=None, interval: float=0.2, max_interval: float=5.0):
+        tic = time.time()
+        while not self.poll() or not self.done:
+            if timeout is not None and time.time() - tic > timeout:
+                raise TimeoutError("Job {} still {} after {}s".format(self.jid, self.state, timeout))
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+        return self
+
+    def cancel(self):
+        return self.gateway.post("jobs/{}/cancel".format(self.jid))
+
+    def result(self) -> dict:
+        # Job output, ie, the new ID for an anonymization
+        if self.state != "Success":
+            raise RuntimeError("Job {} {}: {}".format(self.jid, self.state,
+                                                     self.info.get("ErrorDescription")))
+        return self.info.get("Content", {})
+
+    def archive(self, stream: bool=False):
+        # Body of a finished archive job
+        self.result()
+        return self.gateway.get("jobs/{}/archive".format(self.jid), stream=stream)
+
+
 @attr.s
 class Orthanc(Requester):
     user = attr.ib(default="orthanc")
@@ -21,10 +76,10 @@ class Orthanc(Requester):
 
     # Wrapper for requester calls
 
-    def get(self, resource: str, params=None):
+    def get(self, resource: str, params=None, stream: bool=False):
         self.logger.debug("Getting {} from orthanc".format(resource))
         url = self._url(resource)
-        return self._get(url, params=params, auth=self.auth)
+        return self._get(url, params=params, auth=self.auth, stream=stream)
 
     def put(self, resource: str, data=None):
         self.logger.debug("Putting {} into orthanc".format(resource))
@@ -43,7 +98,7 @@ class Orthanc(Requester):
 
     # item handling by oid and level
 
-    def get_item(self, oid: str, level: DicomLevel, view: str="meta"):
+    def item_resource(self, oid: str, level: DicomLevel, view: str="meta"):
         # View in [meta, tags, file*, image*, archive**]
         # * only instance level
         # * only series or study level
@@ -70,28 +125,47 @@ class Orthanc(Requester):
 
         else:
             self.logger.error("Unsupported get view format {} for {}".format(view, level))
-            return
+            return None, None
 
         if postfix:
             resource = "{}/{}/{}".format(level, oid, postfix)
         else:
             resource = "{}/{}".format(level, oid)
 
-        return self.get(resource, params)
+        return resource, params
+
+    def get_item(self, oid: str, level: DicomLevel, view: str="meta", stream: bool=False):
+        # Set stream to get file, image, or archive bodies as a generator of chunks
+        resource, params = self.item_resource(oid, level, view)
+        if not resource:
+            return
+
+        return self.get(resource, params, stream=stream)
 
     def put_item(self, file):
+        # File may be bytes, a memoryview, a file path, an open file, or an iterator of chunks
         resource = "instances"
         headers = {'content-type': 'application/dicom'}
-        self.post(resource, data=file, headers=headers)
+        with upload_body(file) as data:
+            # Returns the new instance's ID and parent ID's
+            return self.post(resource, data=data, headers=headers)
 
     def delete_item(self, oid: str, level: DicomLevel):
         resource = "{}/{}".format(level, oid)
         return self.delete(resource)
 
-    def anonymize_item(self, oid: str, level: DicomLevel, replacement_dict: Mapping=None):
+    def anonymize_item(self, oid: str, level: DicomLevel, replacement_dict: Mapping=None,
+                       asynchronous: bool=False):
+        # Orthanc only runs series and study anonymization as a job
 
         resource = "{}/{}/anonymize".format(level, oid)
 
+        if asynchronous:
+            body = dict(replacement_dict or {})
+            body["Asynchronous"] = True
+            r = self.post(resource, json=body, headers={'content-type': 'application/json'})
+            return OrthancJob(self, r["ID"])
+
         if replacement_dict:
             # replacement_json = json.dumps(replacement_dict)
             # data = replacement_json
@@ -100,8 +174,8 @@ class Orthanc(Requester):
 
         return self.post(resource)
 
-    def find(self, query: Mapping, remote_aet: str, retrieve_dest: str=None):
-
+    def query(self, query: Mapping, remote_aet: str):
+        # C-FIND against a remote modality, returns the query id
         resource = 'modalities/{}/query'.format(remote_aet)
         headers = {"Accept-Encoding": "identity",
                    "Accept": "application/json"}
@@ -111,47 +185,128 @@ class Orthanc(Requester):
         if not r:
             self.logger.warning("No reply from orthanc remote lookup")
             return
+        return r["ID"]
 
-        qid = r["ID"]
-        resource = 'queries/{}/answers'.format(qid)
+    def retrieve(self, qid: str, retrieve_dest: str, aid: str=None):
+        # C-MOVE every answer for a query at once, or just one answer
+        if aid is None:
+            resource = 'queries/{}/retrieve'.format(qid)
+        else:
+            resource = 'queries/{}/answers/{}/retrieve'.format(qid, aid)
+        headers = {'content-type': 'application/text'}
+        return self.post(resource, data=retrieve_dest, headers=headers)
+
+    def find_iter(self, query: Mapping, remote_aet: str, retrieve_dest: str=None):
+        """
+        Yields simplified answers as they arrive.  Answers are expanded in one
+        request where Orthanc supports it, otherwise fetched concurrently over
+        the session pool.  With retrieve_dest, a single query-level C-MOVE is
+        issued as soon as there are answers, so it happens however much of the
+        iterator the caller consumes.
+        """
+
+        qid = self.query(query, remote_aet)
+        if not qid:
+            return
 
-        r = self.get(resource)
+        r = self.get('queries/{}/answers'.format(qid), params={'expand': '', 'simplify': ''})
 
         if not r:
             self.logger.warning("No answers from orthanc lookup")
             return
 
-        answers = r
-        ret = []
-        for aid in answers:
-            resource = 'queries/{}/answers/{}/content?simplify'.format(qid, aid)
-            r = self.get(resource)
-            if not r:
-                self.logger.warning("Bad answer from orthanc lookup")
-                return
-            ret.append(r)
+        # If retrieve_dest defined, move data there (usually 1 study to here)
+        if retrieve_dest:
+            self.retrieve(qid, retrieve_dest)
 
-            # If retrieve_dest defined, move data there (usually 1 study to here)
-            if retrieve_dest:
-                resource = 'queries/{}/answers/{}/retrieve'.format(qid, aid)
-                headers = {'content-type': 'application/text'}
-                rr = self.post(resource, data=retrieve_dest, headers=headers)
-                # self.logger.debug(retrieve_dest)
-                # self.logger.debug("Retrieved {}".format(rr))
+        if isinstance(r[0], dict):
+            yield from r
+        else:
+            # Older Orthanc ignores 'expand' and just lists answer ids
+            def get_answer(aid):
+                return self.get('queries/{}/answers/{}/content'.format(qid, aid),
+                                params={'simplify': ''})
+
+            with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+                for answer in pool.map(get_answer, r):
+                    if not answer:
+                        self.logger.warning("Bad answer from orthanc lookup")
+                        return
+                    yield answer
 
+    def find(self, query: Mapping, remote_aet: str, retrieve_dest: str=None):
         # Returns an array of answers
-        return ret
+        return list( self.find_iter(query, remote_aet, retrieve_dest) ) or None
 
-    def send_item(self, oid: str, dest: str, dest_type):
+    def archive_item(self, oid: str, level: DicomLevel):
+        # Zip the item in the background, download it with job.archive()
+        resource = "{}/{}/archive".format(level, oid)
+        r = self.post(resource, json={"Asynchronous": True})
+        return OrthancJob(self, r["ID"])
+
+    def send_item(self, oid: str, dest: str, dest_type, asynchronous: bool=False):
         resource = "/{}/{}/store".format(dest_type, dest)
+
+        if asynchronous:
+            body = {"Resources": [oid], "Asynchronous": True}
+            r = self.post(resource, json=body, headers={'content-type': 'application/json'})
+            return OrthancJob(self, r["ID"])
+
         data = oid
         headers = {'content-type': 'application/text'}
         self.post(resource, data=data, headers=headers)
 
+    def send_items(self, oids: list, dest: str, dest_type, asynchronous: bool=False):
+        # Many resources over one association
+        resource = "/{}/{}/store".format(dest_type, dest)
+        body = {"Resources": list(oids)}
+        headers = {'content-type': 'application/json'}
+
+        if asynchronous:
+            body["Asynchronous"] = True
+            r = self.post(resource, json=body, headers=headers)
+            return OrthancJob(self, r["ID"])
+
+        return self.post(resource, json=body, headers=headers)
+
+    def inventory(self, level: DicomLevel, page_size: int=1000, expand: bool=False):
+        # Yields ids, or resource dicts if expand, a page at a time
+        since = 0
+        while True:
+            params = {'since': since, 'limit': page_size}
+            if expand:
+                params['expand'] = ''
+            page = self.get(str(level), params=params)
+            yield from page
+            if len(page) < page_size:
+                return
+            since += len(page)
+
+    def bulk_delete(self, oids: list, level: DicomLevel):
+        # One request for the lot where Orthanc supports tools/bulk-delete
+        try:
+            return self.post("tools/bulk-delete", json={"Resources": list(oids)})
+        except requests.ConnectionError:
+            self.logger.debug("No bulk delete, deleting one at a time")
+        for oid in oids:
+            self.delete_item(oid, level)
+
+    def get_job(self, jid: str):
+        return OrthancJob(self, jid)
+
+    def jobs(self):
+        return self.get("jobs")
+
     def get_metadata(self, oid: str, level: DicomLevel, key: str ):
         resource = "{}/{}/metadata/{}".format(level, oid, key)
         return self.get(resource)
 
+    def get_all_metadata(self, oid: str, level: DicomLevel):
+        # Orthanc with 'expand' support returns a key: value dict in one round
+        # trip, older versions ignore it and list the keys
+        resource = "{}/{}/metadata".format(level, oid)
+        return self.get(resource, params={'expand': ''})
+
     def put_metadata(self, oid: str, level: DicomLevel, key: str, value: str):
         resource = "{}/{}/metadata/{}".format(level, oid, key)
         data = value
@@ -166,3 +321,245 @@ class Orthanc(Requester):
     def changes(self, current=0, limit=10):
         params = { 'since': current, 'limit': limit }
         return self.get("changes", params=params)
+
+
+@attr.s
+class CannedOrthanc(Orthanc):
+    # Stand-in for tests: answers from canned responses and records each call.
+    # A callable reply is called with the request's params or body instead
+    responses = attr.ib( factory=dict )   # resource -> reply
+    calls = attr.ib( factory=list )
+
+    def reply(self, resource: str, **request):
+        r = self.responses.get(resource)
+        return r(**request) if callable(r) else r
+
+    def get(self, resource: str, params=None, stream: bool=False):
+        self.calls.append(("get", resource))
+        return self.reply(resource, params=params)
+
+    def put(self, resource: str, data=None):
+        self.calls.append(("put", resource, data))
+        return self.reply(resource, data=data)
+
+    def post(self, resource: str, data=None, json: Mapping=None, headers: Mapping=None):
+        self.calls.append(("post", resource, data))
+        return self.reply(resource, data=data, json=json)
+
+    def delete(self, resource: str):
+        self.calls.append(("delete", resource))
+        return self.reply(resource)
+
+
+@attr.s
+class AsyncOrthanc(Orthanc, AsyncRequester):
+    """
+    Asyncio twin of the Orthanc gateway; every request is a coroutine and at most
+    `max_concurrency` of them are in flight against the endpoint at once.
+
+    >>> o = AsyncOrthanc(host="localhost", port=8042, max_concurrency=20)
+    >>> tags = await asyncio.gather(*[o.get_item(oid, DicomLevel.INSTANCES, "tags") for oid in oids])
+    """
+
+    # Wrapper for requester calls
+
+    async def get(self, resource: str, params=None, stream: bool=False):
+        self.logger.debug("Getting {} from orthanc".format(resource))
+        url = self._url(resource)
+        return await self._get(url, params=params, auth=self.auth, stream=stream)
+
+    async def put(self, resource: str, data=None):
+        self.logger.debug("Putting {} into orthanc".format(resource))
+        url = self._url(resource)
+        return await self._put(url, data=data, auth=self.auth)
+
+    async def post(self, resource: str, data=None, json: Mapping=None, headers: Mapping=None):
+        self.logger.debug("Posting {} to orthanc".format(resource))
+        url = self._url(resource)
+        return await self._post(url, data=data, json=json, auth=self.auth, headers=headers)
+
+    async def delete(self, resource: str):
+        self.logger.debug("Deleting {} from orthanc".format(resource))
+        url = self._url(resource)
+        return await self._delete(url, auth=self.auth)
+
+    # item handling by oid and level
+
+    async def get_item(self, oid: str, level: DicomLevel, view: str="meta", stream: bool=False):
+        resource, params = self.item_resource(oid, level, view)
+        if not resource:
+            return
+
+        return await self.get(resource, params, stream=stream)
+
+    async def put_item(self, file):
+        resource = "instances"
+        headers = {'content-type': 'application/dicom'}
+        with upload_body(file) as data:
+            return await self.post(resource, data=data, headers=headers)
+
+    async def delete_item(self, oid: str, level: DicomLevel):
+        resource = "{}/{}".format(level, oid)
+        return await self.delete(resource)
+
+    async def anonymize_item(self, oid: str, level: DicomLevel, replacement_dict: Mapping=None):
+
+        resource = "{}/{}/anonymize".format(level, oid)
+
+        if replacement_dict:
+            headers = {'content-type': 'application/json'}
+            return await self.post(resource, json=replacement_dict, headers=headers)
+
+        return await self.post(resource)
+
+    async def find(self, query: Mapping, remote_aet: str, retrieve_dest: str=None):
+
+        resource = 'modalities/{}/query'.format(remote_aet)
+        headers = {"Accept-Encoding": "identity",
+                   "Accept": "application/json"}
+
+        r = await self.post(resource, json=query, headers=headers)
+
+        if not r:
+            self.logger.warning("No reply from orthanc remote lookup")
+            return
+
+        qid = r["ID"]
+        resource = 'queries/{}/answers'.format(qid)
+
+        answers = await self.get(resource, params={'expand': '', 'simplify': ''})
+
+        if not answers:
+            self.logger.warning("No answers from orthanc lookup")
+            return
+
+        if isinstance(answers[0], dict):
+            ret = answers
+        else:
+            ret = await asyncio.gather(*[
+                self.get('queries/{}/answers/{}/content'.format(qid, aid),
+                         params={'simplify': ''}) for aid in answers])
+
+            if not all(ret):
+                self.logger.warning("Bad answer from orthanc lookup")
+                return
+
+        # If retrieve_dest defined, move data there (usually 1 study to here)
+        if retrieve_dest:
+            headers = {'content-type': 'application/text'}
+            await self.post('queries/{}/retrieve'.format(qid), data=retrieve_dest, headers=headers)
+
+        # Returns an array of answers
+        return list(ret)
+
+    async def send_item(self, oid: str, dest: str, dest_type):
+        resource = "/{}/{}/store".format(dest_type, dest)
+        data = oid
+        headers = {'content-type': 'application/text'}
+        await self.post(resource, data=data, headers=headers)
+
+    async def get_metadata(self, oid: str, level: DicomLevel, key: str ):
+        resource = "{}/{}/metadata/{}".format(level, oid, key)
+        return await self.get(resource)
+
+    async def put_metadata(self, oid: str, level: DicomLevel, key: str, value: str):
+        resource = "{}/{}/metadata/{}".format(level, oid, key)
+        data = value
+        return await self.put(resource, data=data)
+
+    async def statistics(self):
+        return await self.get("statistics")
+
+    async def reset(self):
+        return await self.post("tools/reset")
+
+    async def changes(self, current=0, limit=10):
+        params = { 'since': current, 'limit': limit }
+        return await self.get("changes", params=params)
+
+
+@attr.s
+class CannedAsyncOrthanc(AsyncOrthanc):
+    # Async stand-in for tests, as CannedOrthanc
+    responses = attr.ib( factory=dict )   # resource -> reply
+    calls = attr.ib( factory=list )
+
+    async def get(self, resource: str, params=None, stream: bool=False):
+        self.calls.append(("get", resource))
+        return self.responses.get(resource)
+
+    async def put(self, resource: str, data=None):
+        self.calls.append(("put", resource, data))
+        return self.responses.get(resource)
+
+    async def post(self, resource: str, data=None, json: Mapping=None, headers: Mapping=None):
+        self.calls.append(("post", resource, data))
+        return self.responses.get(resource)
+
+    async def delete(self, resource: str):
+        self.calls.append(("delete", resource))
+        return self.responses.get(resource)
+
+
+def test_find_iter():
+
+    answers = [{"AccessionNumber": "1"}, {"AccessionNumber": "2"}]
+    query = {"Level": "study", "Query": {"PatientID": "abc"}}
+
+    # Expanded answers come back in one request
+    gateway = CannedOrthanc("localhost", "8042",
+                            responses={"modalities/pacs/query": {"ID": "q1"},
+                                       "queries/q1/answers": answers})
+    assert list(gateway.find_iter(query, "pacs")) == answers
+    assert not [c for c in gateway.calls if c[1].endswith("retrieve")]
+
+    # Older Orthanc lists answer ids, and each answer is fetched
+    gateway = CannedOrthanc("localhost", "8042",
+                            responses={"modalities/pacs/query": {"ID": "q2"},
+                                       "queries/q2/answers": ["0", "1"],
+                                       "queries/q2/answers/0/content": answers[0],
+                                       "queries/q2/answers/1/content": answers[1]})
+    assert gateway.find(query, "pacs", retrieve_dest="diana") == answers
+
+    # One query-level retrieve for all the answers
+    retrieves = [c for c in gateway.calls if c[1].endswith("retrieve")]
+    assert retrieves == [("post", "queries/q2/retrieve", "diana")]
+
+    # The retrieve doesn't wait on the caller reading every answer
+    del gateway.calls[:]
+    assert next(gateway.find_iter(query, "pacs", retrieve_dest="diana")) == answers[0]
+    assert ("post", "queries/q2/retrieve", "diana") in gateway.calls
+
+    # nor is it lost when an answer comes back bad
+    del gateway.calls[:]
+    gateway.responses["queries/q2/answers/1/content"] = None
+    assert gateway.find(query, "pacs", retrieve_dest="diana") == answers[:1]
+    assert ("post", "queries/q2/retrieve", "diana") in gateway.calls
+
+    # Nothing found
+    gateway = CannedOrthanc("localhost", "8042",
+                            responses={"modalities/pacs/query": {"ID": "q3"},
+                                       "queries/q3/answers": []})
+    assert gateway.find(query, "pacs", retrieve_dest="diana") is None
+
+
+def test_async_find():
+
+    answers = [{"AccessionNumber": "1"}, {"AccessionNumber": "2"}]
+    query = {"Level": "study", "Query": {"PatientID": "abc"}}
+
+    # Listed answer ids are fetched together, then all of them retrieved at once
+    gateway = CannedAsyncOrthanc("localhost", "8042",
+                                 responses={"modalities/pacs/query": {"ID": "q1"},
+                                            "queries/q1/answers": ["0", "1"],
+                                            "queries/q1/answers/0/content": answers[0],
+                                            "queries/q1/answers/1/content": answers[1]})
+    assert asyncio.run(gateway.find(query, "pacs", retrieve_dest="diana")) == answers
+    assert gateway.calls[-1] == ("post", "queries/q1/retrieve", "diana")
+
+    # A bad answer fails the lookup
+    del gateway.calls[:]
+    gateway.responses["queries/q1/answers/1/content"] = None
+    assert asyncio.run(gateway.find(query, "pacs", retrieve_dest="diana")) is None
+    assert not [c for c in gateway.calls if c[1].endswith("retrieve")]
+    gateway.close()
@@ -1,5 +1,8 @@
-import logging
+import logging, os, mmap
+from contextlib import contextmanager
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import attr
 from typing import Mapping
 import json as json_handler
@@ -9,6 +12,35 @@ from ..smart_encode import SmartJSONEncoder
 
 # TODO: Turn ssl verification on
 
+
+@contextmanager
+def upload_body(data):
+    """
+    Adapt bytes, memoryviews, file paths, open file objects or chunk iterators
+    into something requests can send without first reading it into memory.
+
+    - paths are mmapped and sent as a single memoryview over the page cache
+    - file objects are read through by requests in blocks
+    - other iterables are sent with chunked transfer encoding
+    """
+
+    if isinstance(data, (str, os.PathLike)):
+        with open(data, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Can't mmap an empty file
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                body = memoryview(m)
+                try:
+                    yield body
+                finally:
+                    # Views must be released before the map can close
+                    body.release()
+    else:
+        yield data
+
+
 @attr.s
 class Requester(object):
     host = attr.ib()
@@ -18,10 +50,54 @@ class Requester(object):
     protocol = attr.ib(default="http")
     logger = attr.ib(init=False)
 
+    # Each gateway keeps its own pool of keep-alive connections
+    pool_size = attr.ib(default=10)
+    max_retries = attr.ib(default=3)
+    backoff_factor = attr.ib(default=0.3)
+    chunk_size = attr.ib(default=1024*1024)  # Body chunk size for streamed responses
+    _session = attr.ib(init=False, default=None, repr=False)
+    _session_pid = attr.ib(init=False, default=None, repr=False)
+
     @logger.default
     def get_logger(self):
         return logging.getLogger(__name__)
 
+    @property
+    def session(self) -> requests.Session:
+        # Sockets can't be shared across a fork (ObservableMixin polls in a child
+        # process), so a new session is opened lazily for each pid
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = self.new_session()
+            self._session_pid = os.getpid()
+        return self._session
+
+    def new_session(self) -> requests.Session:
+        # Connect errors are retried for any method, bad gateway/unavailable
+        # responses only for idempotent methods
+        retry = Retry(total=self.max_retries,
+                      connect=self.max_retries,
+                      read=self.max_retries,
+                      status=self.max_retries,
+                      backoff_factor=self.backoff_factor,
+                      status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size,
+                              max_retries=retry)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                'Connection': 'keep-alive'})
+        session.verify = False
+        return session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
     def _url(self, resource: str=''):
         if self.path:
             return "{}://{}:{}/{}/{}".format(self.protocol, self.host, self.port, self.path, resource)
@@ -39,25 +115,49 @@ class Requester(object):
         else:
             return response.content
 
-    def _get(self, url: str, params: Mapping=None, headers: Mapping=None, auth=None):
-        r = requests.get(url, params=params, headers=headers, auth=auth, verify=False)
+    def _stream(self, response: requests.Response):
+        # Check the status up front, so failures raise at the call site rather
+        # than on the first chunk, then hand back the body as a chunk generator
+        if response.status_code < 200 or response.status_code > 299:
+            self.logger.error(response)
+            response.close()
+            raise requests.ConnectionError( response )
+
+        def chunks():
+            try:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if chunk:
+                        yield chunk
+            finally:
+                # Release the connection back to the pool
+                response.close()
+
+        return chunks()
+
+    def _get(self, url: str, params: Mapping=None, headers: Mapping=None, auth=None, stream: bool=False):
+        r = self.session.get(url, params=params, headers=headers, auth=auth, stream=stream)
+        if stream:
+            return self._stream(r)
         return self._return(r)
 
     def _put(self, url: str, data=None, headers: Mapping=None, auth=None):
-        r = requests.put(url, data=data, headers=headers, auth=auth, verify=False)
+        r = self.session.put(url, data=data, headers=headers, auth=auth)
         return self._return(r)
 
-    def _post(self, url: str, data=None, json: Mapping=None, headers: Mapping=None, auth=None):
+    def _post(self, url: str, params: Mapping=None, data=None, json: Mapping=None, headers: Mapping=None, auth=None,
+              stream: bool=False):
 
         # Pre-encode dictionaries as json to handle timestamps and hashes, requests won't do this gracefully
         if json:
             data = json_handler.dumps(json, cls=SmartJSONEncoder)
 
-        r = requests.post(url, data=data, headers=headers, auth=auth, verify=False)
+        r = self.session.post(url, params=params, data=data, headers=headers, auth=auth, stream=stream)
+        if stream:
+            return self._stream(r)
         return self._return(r)
 
     def _delete(self, url: str, headers: Mapping=None, auth=None):
-        r = requests.delete(url, headers=headers, auth=auth, verify=False)
+        r = self.session.delete(url, headers=headers, auth=auth)
         return self._return(r)
 
     def get(self, resource: str, params: Mapping=None):
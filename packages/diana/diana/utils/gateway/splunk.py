@@ -3,18 +3,34 @@
 # splunk-sdk does not support Python 3; this gateway provides a minimal
 # replacement to find and put events
 
-import time, logging, datetime, json
+import time, logging, datetime, json, gzip, threading, atexit, weakref
 from pprint import pprint
-from collections import OrderedDict
-from typing import Mapping
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Mapping, Callable, Iterable
 import attr
 from bs4 import BeautifulSoup
+import dateutil.parser
 from .requester import Requester
 from ..smart_encode import SmartJSONEncoder
 from pprint import pformat
 from datetime import timedelta
 
 
+def iter_lines(chunks: Iterable[bytes]):
+    # Reassemble newline delimited records from a stream of body chunks
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line.decode("UTF8")
+    if pending.strip():
+        yield pending.decode("UTF8")
+
+
 @attr.s
 class Splunk(Requester):
     hec_protocol = attr.ib( default="https" )
@@ -22,6 +38,14 @@ class Splunk(Requester):
     user     = attr.ib( default="admin" )
     password = attr.ib( default="splunk" )
     auth     = attr.ib( init=False )
+    hec_buffers = attr.ib( init=False, factory=dict, repr=False )  # token -> HECBuffer
+
+    # Search job polling interval bounds (secs) and result paging
+    poll_min = attr.ib( default=0.05 )
+    poll_max = attr.ib( default=2.0 )
+    page_size = attr.ib( default=50000 )
+    first_page_size = attr.ib( default=1000 )
+    page_workers = attr.ib( default=4 )
 
     @auth.default
     def set_auth(self):
@@ -39,25 +63,128 @@ class Splunk(Requester):
         url = self._url(resource)
         return self._put(url, data=data, auth=self.auth)
 
-    def post(self, resource: str, params=None, data=None, json: Mapping=None, headers: Mapping=None):
+    def post(self, resource: str, params=None, data=None, json: Mapping=None, headers: Mapping=None,
+             stream: bool=False):
         url = self._url(resource)
         self.logger.debug("Posting {} to splunk".format(url))
-        return self._post(url, params=params, data=data, json=json, auth=self.auth, headers=headers)
+        return self._post(url, params=params, data=data, json=json, auth=self.auth, headers=headers,
+                          stream=stream)
 
     def delete(self, resource: str):
         self.logger.debug("Deleting {} from splunk".format(resource))
         url = self._url(resource)
         return self._delete(url, auth=self.auth)
 
-    def find_events(self, q, timerange=None):
+    @staticmethod
+    def time_bounds(timerange=None, padding: timedelta=timedelta(minutes=2)):
 
         if not timerange:
             earliest = "-1d"
             latest = "now"
         else:
             # TODO: Fix padding for the time range in Splunk b/c Splunk and the PACS disagree on time intervals
-            earliest = (timerange.earliest - timedelta(minutes=2)).isoformat()
-            latest = (timerange.latest + timedelta(minutes=2)).isoformat()
+            earliest = (timerange.earliest - padding).isoformat()
+            latest = (timerange.latest + padding).isoformat()
+
+        return earliest, latest
+
+    def iter_events(self, q, timerange=None, fields: Iterable[str]=None,
+                    padding: timedelta=timedelta(minutes=2), with_time: bool=False):
+        """
+        Streams results from the export endpoint, yielding each parsed event as
+        it arrives with no search job to poll.  With fields, Splunk projects
+        the results and only those fields are returned, rather than the raw json.
+        With with_time, yields (local event time, event) pairs.
+        """
+
+        earliest, latest = self.time_bounds(timerange, padding)
+
+        if fields:
+            fields = list(fields)
+            q = "{} | fields {}".format(q, ", ".join(fields))
+
+        chunks = self.post('services/search/jobs/export',
+                           data = {'search': q,
+                                   'earliest_time': earliest,
+                                   'latest_time': latest,
+                                   'output_mode': 'json'},
+                           stream=True)
+
+        for line in iter_lines(chunks):
+
+            try:
+                r = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                self.logger.warning("Skipping bad export line: {}".format(line[:80]))
+                continue
+
+            # Exports also stream previews and messages
+            if r.get('preview') or not r.get('result'):
+                continue
+            r = r['result']
+
+            if fields:
+                event = { k: r[k] for k in fields if k in r }
+            else:
+                try:
+                    event = json.loads(r['_raw'])
+                except (json.decoder.JSONDecodeError, KeyError):
+                    self.logger.warning("Skipping non-json string: {}".format(pformat(r)))
+                    continue
+
+            if with_time:
+                # Splunk reports _time with an offset, compare in naive local time
+                t = dateutil.parser.parse(r['_time']).astimezone().replace(tzinfo=None)
+                yield t, event
+            else:
+                yield event
+
+    def poll_until_done(self, sid: str) -> int:
+        # Poll fast at first, then back off towards `poll_max`, sleeping about as
+        # long as the job's own progress suggests it still needs
+        interval = self.poll_min
+        i = 0
+        while True:
+            i = i + 1
+            response = self.get('services/search/jobs/{0}'.format(sid),
+                                params={'output_mode': 'json'})
+            content = response['entry'][0]['content']
+
+            if content['isDone']:
+                return content['resultCount']
+
+            progress = float(content.get('doneProgress') or 0)
+            elapsed = float(content.get('runDuration') or 0)
+            if progress > 0 and elapsed > 0:
+                remaining = elapsed * (1 - progress) / progress
+                interval = min(max(remaining / 2, self.poll_min), self.poll_max)
+            else:
+                interval = min(interval * 2, self.poll_max)
+
+            if i % 5 == 1:
+                self.logger.debug('Waiting to finish {0} ({1}, {2:.0%})'.format(i, content['dispatchState'], progress))
+            time.sleep(interval)
+
+    def results_page(self, sid: str, offset: int, count: int) -> list:
+        response = self.get('services/search/jobs/{0}/results'.format(sid),
+                            params={'output_mode': 'json',
+                                    'count': count,
+                                    'offset': offset})
+        result = []
+        for r in response['results']:
+
+            try:
+                data = json.loads(r['_raw'])
+                result.append( data )
+            except (json.decoder.JSONDecodeError, KeyError):
+                self.logger.warning("Skipping non-json string: {}".format(pformat(r)))
+        return result
+
+    def iter_job_events(self, q, timerange=None):
+        # Runs a blocking search job, then yields results in order while up to
+        # `page_workers` pages download at once
+
+        earliest, latest = self.time_bounds(timerange)
 
         # self.logger.debug("Earliest: {}\n           Latest:   {}".format(earliest, latest))
 
@@ -73,52 +200,39 @@ class Splunk(Requester):
         # self.logger.debug(pformat(soup))
         self.logger.debug(sid)
 
-        def poll_until_done(sid):
-            isDone = False
-            i = 0
-            while not isDone:
-                i = i + 1
-                time.sleep(1)
-                response = self.get('services/search/jobs/{0}'.format(sid),
-                                    params={'output_mode': 'json'})
-
-                # self.logger.debug(response)
-
-                isDone = response['entry'][0]['content']['isDone']
-                status = response['entry'][0]['content']['dispatchState']
-                if i % 5 == 1:
-                    self.logger.debug('Waiting to finish {0} ({1})'.format(i, status))
-            return response['entry'][0]['content']['resultCount']
-
-        n = poll_until_done(sid)
-        offset = 0
-        result = []
-        i = 0
-        while offset < n:
-            count = 50000
-            offset = 0 + count*i
-            response = self.get('services/search/jobs/{0}/results'.format(sid),
-                                params={'output_mode': 'json',
-                                        'count': count,
-                                        'offset': offset})
+        n = self.poll_until_done(sid)
 
-            for r in response['results']:
+        # A short first page gets results to the caller sooner
+        first = min(self.first_page_size or self.page_size, self.page_size)
+        pages = [(0, first)] + [(offset, self.page_size) for offset in range(first, n, self.page_size)]
 
-                try:
-                    data = json.loads(r['_raw'])
-                    result.append( data )
-                except (json.decoder.JSONDecodeError, KeyError):
-                    self.logger.warning("Skipping non-json string: {}".format(pformat(r)))
-            i = i+1
+        workers = max(1, min(self.page_workers, self.pool_size))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Only read `workers` pages ahead of the consumer
+            pending = deque()
+            for offset, count in pages:
+                pending.append(pool.submit(self.results_page, sid, offset, count))
+                if len(pending) >= workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
 
-        return result
+    def find_events(self, q, timerange=None):
+        return list( self.iter_job_events(q, timerange) )
 
-    def put_event( self,
-                   timestamp: datetime,
-                   event: Mapping,
-                   host: str,
-                   index: str,
-                   token: str ):
+    def hec_url(self) -> str:
+        if self.path:
+            return "{}://{}:{}/{}/services/collector/event". \
+                format(self.hec_protocol, self.host, self.hec_port, self.path)
+        else:
+            return "{}://{}:{}/services/collector/event". \
+                format(self.hec_protocol, self.host, self.hec_port)
+
+    @staticmethod
+    def event_data( timestamp: datetime,
+                    event: Mapping,
+                    host: str,
+                    index: str ) -> Mapping:
 
         if not timestamp:
             timestamp = datetime.datetime.now()
@@ -129,28 +243,226 @@ class Splunk(Requester):
 
         event_json = json.dumps(event, cls=SmartJSONEncoder)
 
-        data = OrderedDict([('time', epoch(timestamp)),
+        return OrderedDict([('time', epoch(timestamp)),
                             ('host', host),
                             ('sourcetype', '_json'),
                             ('index', index ),
                             ('event', event_json )])
 
-        self.logger.debug(pformat(data))
+    def put_event( self,
+                   timestamp: datetime,
+                   event: Mapping,
+                   host: str,
+                   index: str,
+                   token: str ):
 
-        def _hec_url() -> str:
-            if self.path:
-                return "{}://{}:{}/{}/services/collector/event". \
-                    format(self.hec_protocol, self.host, self.hec_port, self.path)
-            else:
-                return "{}://{}:{}/services/collector/event". \
-                    format(self.hec_protocol, self.host, self.hec_port)
+        data = self.event_data(timestamp, event, host, index)
+
+        self.logger.debug(pformat(data))
 
-        url = _hec_url()
+        url = self.hec_url()
         self.logger.debug("Posting to splunk hec")
 
         headers = {'Authorization': 'Splunk {0}'.format(token)}
         return self._post(url, json=data, headers=headers)
 
-
-
-
+    def put_events( self, body: bytes, token: str, compress: bool=False ):
+        # body is a run of concatenated event json objects, which HEC accepts in one post
+        headers = {'Authorization': 'Splunk {0}'.format(token),
+                   'Content-Type': 'application/json'}
+        if compress:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.logger.debug("Posting {} bytes to splunk hec".format(len(body)))
+        return self._post(self.hec_url(), data=body, headers=headers)
+
+    def hec_buffer( self, token: str, **kwargs ):
+        # One buffer per token, since the token goes in the request header
+        if token not in self.hec_buffers:
+            self.hec_buffers[token] = HECBuffer(gateway=self, token=token, **kwargs)
+        return self.hec_buffers[token]
+
+
+@attr.s(hash=False)
+class HECBuffer(object):
+    """
+    Packs HEC events into as few collector requests as possible.  A batch is
+    sent when it reaches `max_events` or `max_bytes`, when its oldest event is
+    `max_age` seconds old, on `flush`, and at interpreter exit.
+
+    A failed batch is logged, recorded in `errors` as (event count, exception),
+    and passed to `on_error(events, exception)` if given; it is not retried.
+    Keys passed with events are handed to `on_sent(keys)` once their batch posts.
+    """
+    gateway = attr.ib( repr=False )
+    token = attr.ib( repr=False )
+    max_events = attr.ib( default=500 )
+    max_bytes = attr.ib( default=1024*1024 )
+    max_age = attr.ib( default=5.0 )      # Seconds
+    compress = attr.ib( default=False )
+    on_error = attr.ib( default=None, type=Callable )
+    on_sent = attr.ib( default=None, type=Callable )
+
+    sent = attr.ib( init=False, default=0 )
+    errors = attr.ib( init=False, factory=list, repr=False )
+
+    events = attr.ib( init=False, factory=list, repr=False )
+    keys = attr.ib( init=False, factory=list, repr=False )
+    size = attr.ib( init=False, default=0 )
+    oldest = attr.ib( init=False, default=None )
+    lock = attr.ib( init=False, factory=threading.RLock, repr=False )
+    flusher = attr.ib( init=False, default=None, repr=False )
+    closed = attr.ib( init=False, factory=threading.Event, repr=False )
+    logger = attr.ib( init=False, repr=False )
+
+    # Everything still buffered at exit gets flushed
+    buffers = weakref.WeakSet()
+
+    @logger.default
+    def get_logger(self):
+        return logging.getLogger(__name__)
+
+    def __attrs_post_init__(self):
+        HECBuffer.buffers.add(self)
+
+    def add(self, data: Mapping, key=None):
+        event = json.dumps(data, cls=SmartJSONEncoder).encode("UTF8")
+
+        # Batches are swapped out under the lock but posted after it is
+        # released, so other threads can keep adding while one posts
+        batches = []
+        with self.lock:
+            if self.size + len(event) > self.max_bytes:
+                batches.append(self.swap())
+            if not self.events:
+                self.oldest = time.time()
+            self.events.append(event)
+            if key is not None:
+                self.keys.append(key)
+            self.size += len(event)
+            if len(self.events) >= self.max_events:
+                batches.append(self.swap())
+
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_aged, daemon=True)
+                self.flusher.start()
+
+        for events, keys in batches:
+            self.post(events, keys)
+
+    def flush_aged(self):
+        while not self.closed.wait(min(self.max_age, 1.0)):
+            with self.lock:
+                aged = self.oldest is not None and time.time() - self.oldest >= self.max_age
+            if aged:
+                self.flush()
+
+    def swap(self):
+        # Caller holds the lock
+        events, keys = self.events, self.keys
+        self.events, self.keys = [], []
+        self.size = 0
+        self.oldest = None
+        return events, keys
+
+    def post(self, events, keys):
+        if not events:
+            return
+        try:
+            self.gateway.put_events(b"".join(events), token=self.token, compress=self.compress)
+            with self.lock:
+                self.sent += len(events)
+            if self.on_sent and keys:
+                self.on_sent(keys)
+        except Exception as e:
+            self.logger.error("HEC batch of {} events failed: {}".format(len(events), e))
+            with self.lock:
+                self.errors.append((len(events), e))
+            if self.on_error:
+                self.on_error(events, e)
+
+    def flush(self):
+        with self.lock:
+            events, keys = self.swap()
+        self.post(events, keys)
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+
+
+@atexit.register
+def flush_hec_buffers():
+    for buffer in list(HECBuffer.buffers):
+        buffer.close()
+
+
+def test_iter_events():
+
+    rows = [{"preview": True, "result": {"_raw": json.dumps({"n": "early"})}},
+            {"preview": False, "result": {"_raw": json.dumps({"n": 1, "host": "a"}),
+                                          "_time": "2018-10-01T12:00:00.000+00:00", "n": "1"}},
+            {"messages": [{"type": "INFO", "text": "search done"}]},
+            {"preview": False, "result": {"_raw": "not json", "_time": "2018-10-01T12:01:00.000+00:00"}},
+            {"preview": False, "result": {"_raw": json.dumps({"n": 2, "host": "b"}),
+                                          "_time": "2018-10-01T12:02:00.000+00:00", "n": "2"}}]
+    lines = [json.dumps(r).encode("UTF8") for r in rows]
+    lines.insert(2, b'{"preview": fal')     # Mangled
+    body = b"\n".join(lines)
+
+    @attr.s
+    class CannedSplunk(Splunk):
+        posted = attr.ib( factory=list )
+
+        def post(self, resource, params=None, data=None, json=None, headers=None, stream=False):
+            self.posted.append(data)
+            # Chunks split records mid-line, and the last one has no newline
+            return (body[i:i+7] for i in range(0, len(body), 7))
+
+    splunk = CannedSplunk("localhost", "8089")
+
+    # Previews, messages, bad lines and non-json events are passed over
+    assert list(splunk.iter_events("search index=dicom")) == [{"n": 1, "host": "a"}, {"n": 2, "host": "b"}]
+    assert splunk.posted[-1]["search"] == "search index=dicom"
+
+    # With fields, Splunk projects the results and the raw json isn't parsed
+    assert list(splunk.iter_events("search index=dicom", fields=["n"])) == [{"n": "1"}, {}, {"n": "2"}]
+    assert splunk.posted[-1]["search"] == "search index=dicom | fields n"
+
+    # With with_time, naive local event times come along
+    (t, event), _ = splunk.iter_events("search index=dicom", with_time=True)
+    assert event == {"n": 1, "host": "a"} and t.tzinfo is None
+    assert t == datetime.datetime(2018, 10, 1, 12, tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+
+    assert list(iter_lines([b"a\nb", b"c\n\n", b"d"])) == ["a", "bc", "d"]
+
+
+def test_hec_buffer():
+
+    @attr.s
+    class SlowGateway(object):
+        posts = attr.ib( factory=list )
+        buffer = attr.ib( default=None )
+
+        def put_events(self, body, token, compress):
+            # Another thread can still get at the buffer while a batch posts
+            if not self.posts:
+                t = threading.Thread(target=self.buffer.add, args=({"n": "during"},))
+                t.start()
+                t.join(1.0)
+                assert not t.is_alive()
+            self.posts.append(body)
+
+    gateway = SlowGateway()
+    buffer = HECBuffer(gateway=gateway, token="abc", max_events=3, max_age=60)
+    gateway.buffer = buffer
+    assert buffer.logger.name == __name__
+
+    for i in range(3):
+        buffer.add({"n": i}, key=i)
+    assert len(gateway.posts) == 1 and gateway.posts[0].count(b'"n"') == 3
+    assert buffer.sent == 3 and len(buffer.events) == 1
+
+    buffer.close()
+    assert buffer.sent == 4 and not buffer.events
@@ -0,0 +1,143 @@
+"""
+Durable per-item progress for long worklist runs, so a restart can pick up
+where a crash left off instead of re-probing every item.
+
+Each item moves forward through `STATES`; every change is appended to an
+`events` table and the latest state (with whatever oids and meta the next
+step needs) is kept in `items`.  Both live in one sqlite file (WAL).
+
+>>> journal = ProgressJournal(location="/data/pull.journal")
+>>> journal.state("12345")
+>>> journal.mark("12345", "retrieved", meta=d.meta)
+>>> journal.progress(total=50000)
+{'done': 40000, 'remaining': 10000, 'rate': 2.5, 'eta': 4000.0, ...}
+"""
+
+import logging, os, time, pickle, sqlite3, threading
+from typing import Mapping
+import attr
+
+
+@attr.s
+class ProgressJournal(object):
+    location = attr.ib( default=None )     # sqlite file, or None for memory only
+    window = attr.ib( default=300 )        # Secs of recent completions used for the rate
+
+    # In order.  "skipped" items (already in dest, unfindable) are as done as
+    # "cleaned", "failed" ones are tried again on the next run
+    STATES = ("found", "retrieved", "anonymized", "stored", "cleaned")
+    FINISHED = ("cleaned", "skipped")
+
+    lock = attr.ib( init=False, factory=threading.RLock, repr=False )
+    started = attr.ib( init=False, factory=time.time )
+    _db = attr.ib( init=False, default=None, repr=False )
+    _db_pid = attr.ib( init=False, default=None, repr=False )
+    logger = attr.ib( init=False, repr=False )
+
+    @logger.default
+    def get_logger(self):
+        return logging.getLogger(__name__)
+
+    @property
+    def db(self):
+        # sqlite connections don't survive a fork
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.location or ":memory:", check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS items "
+                             "(key TEXT PRIMARY KEY, state TEXT, note TEXT, "
+                             "oid TEXT, sham_oid TEXT, meta BLOB, updated REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS events "
+                             "(key TEXT, state TEXT, note TEXT, at REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS events_at ON events (state, at)")
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def mark(self, key: str, state: str, note: str=None,
+             oid: str=None, sham_oid: str=None, meta: Mapping=None):
+        # Oids and meta are kept from earlier marks unless given again
+        now = time.time()
+        blob = pickle.dumps(dict(meta), pickle.HIGHEST_PROTOCOL) if meta is not None else None
+        with self.lock:
+            self.db.execute("INSERT INTO items (key, state, note, oid, sham_oid, meta, updated) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                            "state=excluded.state, note=excluded.note, updated=excluded.updated, "
+                            "oid=COALESCE(excluded.oid, oid), "
+                            "sham_oid=COALESCE(excluded.sham_oid, sham_oid), "
+                            "meta=COALESCE(excluded.meta, meta)",
+                            (key, state, note, oid, sham_oid, blob, now))
+            self.db.execute("INSERT INTO events (key, state, note, at) VALUES (?, ?, ?, ?)",
+                            (key, state, note, now))
+            self.db.commit()
+
+    def state(self, key: str) -> str:
+        with self.lock:
+            row = self.db.execute("SELECT state FROM items WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def entry(self, key: str) -> Mapping:
+        with self.lock:
+            row = self.db.execute("SELECT state, note, oid, sham_oid, meta FROM items WHERE key=?",
+                                  (key,)).fetchone()
+        if not row:
+            return None
+        state, note, oid, sham_oid, meta = row
+        return {"state": state, "note": note, "oid": oid, "sham_oid": sham_oid,
+                "meta": pickle.loads(meta) if meta else None}
+
+    def finished(self, key: str) -> bool:
+        return self.state(key) in self.FINISHED
+
+    def counts(self) -> Mapping[str, int]:
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+
+    def progress(self, total: int=None) -> Mapping:
+        # Rate is finished items/sec over the last `window` secs (or since this
+        # journal was opened, if that's shorter), so a resumed run's rate isn't
+        # diluted by the time it was down
+        now = time.time()
+        since = max(now - self.window, self.started)
+        counts = self.counts()
+        done = sum(counts.get(s, 0) for s in self.FINISHED)
+        with self.lock:
+            recent = self.db.execute("SELECT COUNT(*) FROM events WHERE state IN ({}) AND at >= ?"
+                                     .format(", ".join("?" * len(self.FINISHED))),
+                                     self.FINISHED + (since,)).fetchone()[0]
+        rate = recent / max(now - since, 1e-6)
+        result = {"done": done, "counts": counts, "rate": rate}
+        if total is not None:
+            remaining = max(total - done, 0)
+            result["remaining"] = remaining
+            result["eta"] = remaining / rate if rate else None
+        return result
+
+
+def test_progress_journal():
+
+    import tempfile
+
+    fp = os.path.join(tempfile.mkdtemp(), "run.journal")
+    journal = ProgressJournal(location=fp)
+
+    journal.mark("a", "found")
+    journal.mark("a", "retrieved", meta={"PatientID": "abc"})
+    journal.mark("a", "anonymized", oid="o1", sham_oid="s1")
+    journal.mark("b", "skipped", note="exists")
+    journal.mark("c", "stored")
+    journal.mark("c", "cleaned")
+
+    # Survives a restart, keeping oids and meta from earlier marks
+    again = ProgressJournal(location=fp)
+    entry = again.entry("a")
+    assert entry["state"] == "anonymized"
+    assert entry["oid"] == "o1" and entry["meta"] == {"PatientID": "abc"}
+    assert again.finished("b") and again.finished("c") and not again.finished("a")
+    assert again.state("z") is None
+
+    p = journal.progress(total=10)
+    assert p["done"] == 2 and p["remaining"] == 8
+    assert p["counts"] == {"anonymized": 1, "skipped": 1, "cleaned": 1}
+    assert p["rate"] > 0 and p["eta"] > 0
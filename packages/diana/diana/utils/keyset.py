@@ -0,0 +1,168 @@
+"""
+Persistent set of keys known to be in each destination index, so a harvester
+only has to ask the index about keys it hasn't seen.
+
+The exact set lives in sqlite (or memory, with no location); an optional Bloom
+filter in front of it answers most "never seen" lookups without touching disk.
+A Bloom filter never gives false negatives, so it is only ever used to skip the
+exact lookup, never to claim membership.
+
+>>> keys = IndexedKeySet(location="/var/cache/diana/keys.db", bloom_capacity=1000000)
+>>> keys.add("dose_reports", ["12345", "12346"])
+>>> keys.unknown("dose_reports", ["12345", "99999"])
+['99999']
+"""
+
+import logging, os, math, time, sqlite3, threading, hashlib
+from typing import Iterable, List
+import attr
+
+
+@attr.s
+class BloomFilter(object):
+    capacity = attr.ib( default=1000000 )
+    error_rate = attr.ib( default=0.01 )
+    size = attr.ib( init=False )         # Bits
+    hashes = attr.ib( init=False )
+    bits = attr.ib( init=False, repr=False )
+
+    def __attrs_post_init__(self):
+        self.size = max(8, int(-self.capacity * math.log(self.error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key: str):
+        # Double hashing off one digest
+        digest = hashlib.blake2b(key.encode("UTF8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+@attr.s
+class IndexedKeySet(object):
+    location = attr.ib( default=None )         # sqlite file, or None for memory only
+    bloom_capacity = attr.ib( default=None )   # Expected keys per index, or None for no Bloom tier
+    bloom_error_rate = attr.ib( default=0.01 )
+
+    blooms = attr.ib( init=False, factory=dict, repr=False )   # index -> BloomFilter
+    lock = attr.ib( init=False, factory=threading.RLock, repr=False )
+    _db = attr.ib( init=False, default=None, repr=False )
+    _db_pid = attr.ib( init=False, default=None, repr=False )
+    logger = attr.ib( init=False, repr=False )
+
+    @logger.default
+    def get_logger(self):
+        return logging.getLogger(__name__)
+
+    @property
+    def db(self):
+        # sqlite connections don't survive a fork
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.location or ":memory:", check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS keys "
+                             "(idx TEXT, key TEXT, PRIMARY KEY (idx, key)) WITHOUT ROWID")
+            self._db.execute("CREATE TABLE IF NOT EXISTS reconciled (idx TEXT PRIMARY KEY, at REAL)")
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def bloom(self, index: str):
+        if not self.bloom_capacity:
+            return None
+        if index not in self.blooms:
+            bloom = BloomFilter(capacity=self.bloom_capacity, error_rate=self.bloom_error_rate)
+            for (key,) in self.db.execute("SELECT key FROM keys WHERE idx=?", (index,)):
+                bloom.add(key)
+            self.blooms[index] = bloom
+        return self.blooms[index]
+
+    def add(self, index: str, keys: Iterable[str]):
+        keys = [str(k) for k in keys if k]
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO keys (idx, key) VALUES (?, ?)",
+                                [(index, k) for k in keys])
+            self.db.commit()
+            bloom = self.bloom(index)
+            if bloom is not None:
+                for k in keys:
+                    bloom.add(k)
+
+    def contains(self, index: str, key: str) -> bool:
+        key = str(key)
+        with self.lock:
+            bloom = self.bloom(index)
+            if bloom is not None and key not in bloom:
+                return False
+            return self.db.execute("SELECT 1 FROM keys WHERE idx=? AND key=?",
+                                   (index, key)).fetchone() is not None
+
+    def unknown(self, index: str, keys: Iterable[str]) -> List[str]:
+        return [k for k in keys if not self.contains(index, k)]
+
+    def count(self, index: str) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM keys WHERE idx=?", (index,)).fetchone()[0]
+
+    def replace(self, index: str, keys: Iterable[str]):
+        # Reconcile with the authoritative list, in one transaction
+        with self.lock:
+            self.db.execute("DELETE FROM keys WHERE idx=?", (index,))
+            self.db.executemany("INSERT OR IGNORE INTO keys (idx, key) VALUES (?, ?)",
+                                ((index, str(k)) for k in keys if k))
+            self.db.execute("INSERT OR REPLACE INTO reconciled (idx, at) VALUES (?, ?)",
+                            (index, time.time()))
+            self.db.commit()
+            # Bloom filters can't forget, so rebuild on next use
+            self.blooms.pop(index, None)
+        self.logger.debug("Reconciled {} keys for {}".format(self.count(index), index))
+
+    def needs_reconcile(self, index: str, period: float) -> bool:
+        with self.lock:
+            row = self.db.execute("SELECT at FROM reconciled WHERE idx=?", (index,)).fetchone()
+        return row is None or time.time() - row[0] > period
+
+
+def test_keyset():
+
+    import tempfile
+
+    fp = os.path.join(tempfile.mkdtemp(), "keys.db")
+    keys = IndexedKeySet(location=fp, bloom_capacity=1000)
+
+    keys.add("dose", ["a", "b", "c"])
+    keys.add("other", ["z"])
+    assert keys.unknown("dose", ["a", "c", "d", "z"]) == ["d", "z"]
+    assert keys.needs_reconcile("dose", 3600)
+
+    # Persists across instances
+    again = IndexedKeySet(location=fp)
+    assert again.contains("dose", "b")
+    assert not again.contains("dose", "z")
+
+    # Reconcile drops keys that aren't really indexed
+    keys.replace("dose", ["a", "d"])
+    assert keys.unknown("dose", ["a", "b", "c", "d"]) == ["b", "c"]
+    assert not keys.needs_reconcile("dose", 3600)
+    assert keys.count("dose") == 2
+
+    bloom = BloomFilter(capacity=10000, error_rate=0.01)
+    for i in range(10000):
+        bloom.add(str(i))
+    assert all(str(i) in bloom for i in range(10000))
+    false_positives = sum(str(i) in bloom for i in range(10000, 20000))
+    assert false_positives < 300
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    test_keyset()
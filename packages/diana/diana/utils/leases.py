@@ -0,0 +1,240 @@
+"""
+Shared worklist for several porters, ie, one per proxy, pulling from the same
+list of studies.
+
+Items are leased to a worker for `ttl` secs.  Workers renew their leases while
+they are alive and release them when an item is finished; the leases of a
+worker that dies run out and its items go to whoever asks next.  An item that
+fails is put back for another worker, up to `max_attempts` times.
+
+Everything lives in one sqlite table (WAL), so any number of processes on one
+machine can share it, and the state counts double as shared progress.
+
+>>> queue = LeaseQueue(location="/data/pull.leases")
+>>> queue.add( (d.meta["AccessionNumber"], d.meta) for d in worklist )
+>>> for key, meta in queue.lease("proxy1", n=10):
+...     queue.release("proxy1", key)
+>>> queue.progress()
+{'done': 40000, 'counts': {'open': 9000, 'leased': 10, ...}, 'rate': 2.5, ...}
+"""
+
+import logging, os, time, pickle, sqlite3, threading
+from contextlib import contextmanager
+from typing import Any, Hashable, Iterable, List, Mapping, Tuple
+import attr
+
+
+@attr.s
+class LeaseQueue(object):
+    location = attr.ib( default=None )     # sqlite file, or None for memory only
+    ttl = attr.ib( default=600 )           # Secs a lease lasts without renewal
+    max_attempts = attr.ib( default=3 )    # Leases per item before it is given up on
+    window = attr.ib( default=300 )        # Secs of recent completions used for the rate
+
+    STATES = ("open", "leased", "done", "failed")
+
+    lock = attr.ib( init=False, factory=threading.RLock, repr=False )
+    started = attr.ib( init=False, factory=time.time )
+    _db = attr.ib( init=False, default=None, repr=False )
+    _db_pid = attr.ib( init=False, default=None, repr=False )
+    logger = attr.ib( init=False, repr=False )
+
+    @logger.default
+    def get_logger(self):
+        return logging.getLogger(__name__)
+
+    @property
+    def db(self):
+        # sqlite connections don't survive a fork
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.location or ":memory:", check_same_thread=False,
+                                       isolation_level=None, timeout=60)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS leases "
+                             "(key TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT 'open', "
+                             "owner TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+                             "finished REAL, note TEXT, value BLOB)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS leases_expires ON leases (state, expires)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS leases_owner ON leases (owner, state)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS leases_finished ON leases (state, finished)")
+            self._db_pid = os.getpid()
+        return self._db
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so two workers can't both
+        # read the same open rows and then lease them
+        with self.lock:
+            db = self.db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def add(self, items: Iterable[Tuple[Hashable, Any]]):
+        # (key, value) pairs; keys already in the queue keep their state
+        with self.transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO leases (key, value) VALUES (?, ?)",
+                           ((str(k), pickle.dumps(v, pickle.HIGHEST_PROTOCOL)) for k, v in items))
+
+    def lease(self, owner: str, n: int=1) -> List[Tuple[str, Any]]:
+        # Expired leases are handed out before fresh items, so a dead worker's
+        # items aren't left until the end of the run.  An expired item that has
+        # used up its attempts is given up on instead, so an item that crashes
+        # or hangs its worker can't go on to take down every other worker too.
+        now = time.time()
+        with self.transaction() as db:
+            for key, previous in db.execute("SELECT key, owner FROM leases WHERE state='leased' "
+                                            "AND expires < ? AND attempts >= ?",
+                                            (now, self.max_attempts)).fetchall():
+                self.logger.warning("Giving up on {}, its lease ran out {} times (last {})".format(
+                    key, self.max_attempts, previous))
+            db.execute("UPDATE leases SET state='failed', expires=NULL, finished=?, note='expired' "
+                       "WHERE state='leased' AND expires < ? AND attempts >= ?",
+                       (now, now, self.max_attempts))
+            rows = db.execute("SELECT key, owner, value FROM leases WHERE state='leased' AND expires < ? "
+                              "LIMIT ?", (now, n)).fetchall()
+            for key, previous, value in rows:
+                self.logger.info("Reassigning {} from {} to {}".format(key, previous, owner))
+            if len(rows) < n:
+                rows += db.execute("SELECT key, owner, value FROM leases WHERE state='open' "
+                                   "ORDER BY rowid LIMIT ?", (n - len(rows),)).fetchall()
+            db.executemany("UPDATE leases SET state='leased', owner=?, expires=?, attempts=attempts+1 "
+                           "WHERE key=?", ((owner, now + self.ttl, key) for key, _, _ in rows))
+        return [(key, pickle.loads(value)) for key, _, value in rows]
+
+    def renew(self, owner: str) -> int:
+        # Heartbeat, extends every lease the owner holds
+        with self.transaction() as db:
+            return db.execute("UPDATE leases SET expires=? WHERE owner=? AND state='leased'",
+                              (time.time() + self.ttl, owner)).rowcount
+
+    def release(self, owner: str, key: str, failed: bool=False, note: str=None) -> bool:
+        # False if the lease had already run out and gone to someone else
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute("SELECT attempts FROM leases WHERE key=? AND owner=? AND state='leased'",
+                             (key, owner)).fetchone()
+            if row is None:
+                self.logger.debug("{} no longer holds the lease on {}".format(owner, key))
+                return False
+            if not failed:
+                state = "done"
+            elif row[0] >= self.max_attempts:
+                state = "failed"
+            else:
+                state = "open"
+            db.execute("UPDATE leases SET state=?, owner=?, expires=NULL, finished=?, note=? WHERE key=?",
+                       (state, owner if state != "open" else None,
+                        now if state != "open" else None, note, key))
+        return True
+
+    def pending(self) -> int:
+        # Items not yet done or given up on, including those leased right now
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM leases WHERE state IN ('open', 'leased')").fetchone()[0]
+
+    def counts(self) -> Mapping[str, int]:
+        now = time.time()
+        with self.lock:
+            counts = dict(self.db.execute("SELECT state, COUNT(*) FROM leases GROUP BY state").fetchall())
+            expired = self.db.execute("SELECT COUNT(*) FROM leases WHERE state='leased' AND expires < ?",
+                                      (now,)).fetchone()[0]
+        if expired:
+            counts["expired"] = expired
+        return counts
+
+    def owners(self) -> Mapping[str, int]:
+        # Items done per worker, ie, to check that adding a proxy added throughput
+        with self.lock:
+            return dict(self.db.execute("SELECT owner, COUNT(*) FROM leases WHERE state='done' "
+                                        "GROUP BY owner").fetchall())
+
+    def progress(self) -> Mapping:
+        # Rate is items done/sec by all workers over the last `window` secs
+        now = time.time()
+        since = max(now - self.window, self.started)
+        counts = self.counts()
+        done = counts.get("done", 0) + counts.get("failed", 0)
+        with self.lock:
+            recent = self.db.execute("SELECT COUNT(*) FROM leases WHERE state IN ('done', 'failed') "
+                                     "AND finished >= ?", (since,)).fetchone()[0]
+        rate = recent / max(now - since, 1e-6)
+        remaining = counts.get("open", 0) + counts.get("leased", 0)
+        return {"done": done, "counts": counts, "rate": rate, "remaining": remaining,
+                "eta": remaining / rate if rate else None}
+
+
+def _drain(fp: str, owner: str) -> List[str]:
+    queue = LeaseQueue(location=fp)
+    done = []
+    while True:
+        items = queue.lease(owner, n=3)
+        if not items:
+            return done
+        for key, value in items:
+            if queue.release(owner, key):
+                done.append(key)
+
+
+def test_lease_queue():
+
+    import tempfile
+    from multiprocessing import Pool
+
+    fp = os.path.join(tempfile.mkdtemp(), "pull.leases")
+    queue = LeaseQueue(location=fp, ttl=0.2, max_attempts=2)
+    queue.add(("{:02d}".format(i), {"n": i}) for i in range(10))
+    queue.add([("00", {"n": "again"})])     # Ignored
+
+    a = queue.lease("a", n=3)
+    b = queue.lease("b", n=3)
+    assert [k for k, v in a] == ["00", "01", "02"] and a[0][1] == {"n": 0}
+    assert [k for k, v in b] == ["03", "04", "05"]
+
+    # a keeps its leases alive, b dies
+    time.sleep(0.15)
+    assert queue.renew("a") == 3
+    time.sleep(0.1)
+    assert queue.counts() == {"open": 4, "leased": 6, "expired": 3}
+
+    # b's items go first to the next worker, and b's late release is refused
+    c = queue.lease("c", n=4)
+    assert [k for k, v in c] == ["03", "04", "05", "06"]
+    assert not queue.release("b", "03")
+    assert queue.release("c", "03") and queue.release("a", "00")
+
+    # Failures go back in the queue until they run out of attempts
+    queue.release("a", "01", failed=True, note="unretrievable")
+    assert queue.counts()["open"] == 4
+    queue.release("c", "04", failed=True)
+    assert queue.counts()["failed"] == 1
+
+    # Several processes drain the rest with no item done twice
+    for owner, key in (("a", "02"), ("c", "05"), ("c", "06")):
+        assert queue.release(owner, key)
+    with Pool(3) as pool:
+        drained = pool.starmap(_drain, [(fp, "w{}".format(i)) for i in range(3)])
+    keys = [k for d in drained for k in d]
+    assert len(keys) == len(set(keys))
+
+    p = LeaseQueue(location=fp).progress()
+    assert p["remaining"] == 0 and p["done"] == 10
+    assert p["counts"] == {"done": 9, "failed": 1}
+    assert queue.owners()["a"] >= 1
+
+    # An item whose leases keep running out, ie, one that hangs or crashes its
+    # worker, is given up on rather than passed on to the next worker
+    poison = LeaseQueue(ttl=0.05, max_attempts=2)
+    poison.add([("x", None), ("y", None)])
+    assert [k for k, v in poison.lease("a")] == ["x"]
+    time.sleep(0.1)
+    assert [k for k, v in poison.lease("b")] == ["x"]
+    time.sleep(0.1)
+    assert [k for k, v in poison.lease("c")] == ["y"]
+    assert poison.counts() == {"failed": 1, "leased": 1}
+    assert not poison.release("b", "x")
@@ -0,0 +1,273 @@
+"""
+On-disk dict-of-dicts for large worklists, ie, a MetaCache backend that
+doesn't have to fit in memory.
+
+Items live in one sqlite table (WAL) with their meta pickled, keyed by the
+MetaCache item id.  A few fields are also kept in their own indexed columns,
+so items can be found by them without a scan, and popping a random item for a
+work queue is an index seek rather than a walk of the keys.
+
+Writes are committed as they are made, or once for a whole batch inside
+`with store.transaction():`.
+
+>>> store = MetaStore(location="/data/pull_list.db")
+>>> store["12345"] = {"AccessionNumber": "12345", "PatientID": "abc"}
+>>> store.find(PatientID="abc")
+>>> key, meta = store.pop_random()
+"""
+
+import logging, os, random, pickle, sqlite3, threading, json, datetime
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from typing import Hashable, Iterable, Iterator, Tuple
+import attr
+
+
+@attr.s(cmp=False)
+class MetaStore(MutableMapping):
+    location = attr.ib( default=None )    # sqlite file, or None for memory only
+    indexed = attr.ib( default=("AccessionNumber", "PatientID", "StudyInstanceUID", "StudyDate"),
+                       converter=tuple )
+    page_size = attr.ib( default=1000 )   # Rows per query when walking the store
+    cache_mb = attr.ib( default=64 )      # sqlite page cache, keeps index inserts off the disk
+
+    lock = attr.ib( init=False, factory=threading.RLock, repr=False )
+    depth = attr.ib( init=False, default=0, repr=False )    # Open transactions
+    _upsert_sql = attr.ib( init=False, default=None, repr=False )
+    _db = attr.ib( init=False, default=None, repr=False )
+    _db_pid = attr.ib( init=False, default=None, repr=False )
+    logger = attr.ib( init=False, repr=False )
+
+    @logger.default
+    def get_logger(self):
+        return logging.getLogger(__name__)
+
+    @property
+    def db(self):
+        # sqlite connections don't survive a fork
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.location or ":memory:", check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("PRAGMA cache_size=-{}".format(self.cache_mb * 1024))
+            columns = "".join(", {} TEXT".format(f) for f in self.indexed)
+            self._db.execute("CREATE TABLE IF NOT EXISTS items "
+                             "(rid INTEGER PRIMARY KEY, did TEXT UNIQUE NOT NULL{}, meta BLOB)".format(columns))
+            for f in self.indexed:
+                self._db.execute("CREATE INDEX IF NOT EXISTS items_{0} ON items ({0})".format(f))
+            self._db_pid = os.getpid()
+            self.depth = 0
+        return self._db
+
+    @staticmethod
+    def dkey(key: Hashable) -> str:
+        # Tuple ids (series, instances) round trip as json lists
+        return json.dumps(key)
+
+    @staticmethod
+    def ukey(dkey: str) -> Hashable:
+        key = json.loads(dkey)
+        return tuple(key) if isinstance(key, list) else key
+
+    @staticmethod
+    def column_value(v):
+        # Dates as ISO strings, so they sort and compare as ranges
+        if isinstance(v, datetime.datetime):
+            return v.date().isoformat()
+        if isinstance(v, datetime.date):
+            return v.isoformat()
+        if v is None or v == "":
+            return None
+        return str(v)
+
+    @contextmanager
+    def transaction(self):
+        # Nested transactions join the outer one
+        with self.lock:
+            db = self.db
+            if self.depth == 0:
+                db.execute("BEGIN IMMEDIATE")
+            self.depth += 1
+            try:
+                yield db
+            except:
+                self.depth -= 1
+                if self.depth == 0:
+                    db.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                db.execute("COMMIT")
+
+    def row(self, key: Hashable, meta: dict) -> tuple:
+        return (self.dkey(key),) + \
+               tuple(self.column_value(meta.get(f)) for f in self.indexed) + \
+               (pickle.dumps(meta, pickle.HIGHEST_PROTOCOL),)
+
+    @property
+    def upsert_sql(self) -> str:
+        if self._upsert_sql is None:
+            fields = ", ".join(self.indexed)
+            marks = ", ".join("?" * (len(self.indexed) + 2))
+            updates = ", ".join("{0}=excluded.{0}".format(f) for f in self.indexed + ("meta",))
+            self._upsert_sql = "INSERT INTO items (did, {}, meta) VALUES ({}) " \
+                               "ON CONFLICT(did) DO UPDATE SET {}".format(fields, marks, updates)
+        return self._upsert_sql
+
+    def update_many(self, items: Iterable[Tuple[Hashable, dict]]):
+        # Upserts (key, meta) pairs in one transaction
+        with self.transaction() as db:
+            db.executemany(self.upsert_sql, (self.row(k, m) for k, m in items))
+
+    def __setitem__(self, key: Hashable, meta: dict):
+        with self.transaction() as db:
+            db.execute(self.upsert_sql, self.row(key, meta))
+
+    def __getitem__(self, key: Hashable) -> dict:
+        with self.lock:
+            row = self.db.execute("SELECT meta FROM items WHERE did=?", (self.dkey(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __delitem__(self, key: Hashable):
+        with self.transaction() as db:
+            if db.execute("DELETE FROM items WHERE did=?", (self.dkey(key),)).rowcount == 0:
+                raise KeyError(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM items WHERE did=?",
+                                   (self.dkey(key),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def pages(self, columns: str) -> Iterator[tuple]:
+        # Walks the table a page at a time by rowid, so items can be added or
+        # removed while iterating and no cursor is held open in between
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT rid, {} FROM items WHERE rid > ? ORDER BY rid LIMIT ?".format(columns),
+                                       (last, self.page_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            last = rows[-1][0]
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for (dkey,) in self.pages("did"):
+            yield self.ukey(dkey)
+
+    def items(self) -> Iterator[Tuple[Hashable, dict]]:
+        for dkey, meta in self.pages("did, meta"):
+            yield self.ukey(dkey), pickle.loads(meta)
+
+    def values(self) -> Iterator[dict]:
+        for (meta,) in self.pages("meta"):
+            yield pickle.loads(meta)
+
+    def find(self, **criteria) -> Iterator[Tuple[Hashable, dict]]:
+        # Equality on indexed fields, ie, find(PatientID="abc", StudyDate=date(2018, 1, 1)),
+        # compared as column values, so a datetime matches any time on its date
+        for f in criteria:
+            if f not in self.indexed:
+                raise KeyError("{} is not an indexed field".format(f))
+        where = " AND ".join("{}=?".format(f) for f in criteria)
+        with self.lock:
+            rows = self.db.execute("SELECT did, meta FROM items WHERE {}".format(where),
+                                   [self.column_value(v) for v in criteria.values()]).fetchall()
+        for dkey, meta in rows:
+            yield self.ukey(dkey), pickle.loads(meta)
+
+    def between(self, field: str, earliest, latest) -> Iterator[Tuple[Hashable, dict]]:
+        # Inclusive range on an indexed field, ie, StudyDate
+        if field not in self.indexed:
+            raise KeyError("{} is not an indexed field".format(field))
+        with self.lock:
+            rows = self.db.execute("SELECT did, meta FROM items WHERE {0} >= ? AND {0} <= ? "
+                                   "ORDER BY {0}".format(field),
+                                   (self.column_value(earliest), self.column_value(latest))).fetchall()
+        for dkey, meta in rows:
+            yield self.ukey(dkey), pickle.loads(meta)
+
+    def random_row(self, db, columns: str):
+        # A random rowid and the first row at or after it: an index seek rather
+        # than a scan.  Gaps left by deletes make this slightly uneven, which is
+        # fine for spreading out a work queue.
+        top = db.execute("SELECT MAX(rid) FROM items").fetchone()[0]
+        if top is None:
+            return None
+        rid = random.randint(1, top)
+        return db.execute("SELECT rid, {} FROM items WHERE rid >= ? ORDER BY rid LIMIT 1".format(columns),
+                          (rid,)).fetchone()
+
+    def random_key(self) -> Hashable:
+        with self.lock:
+            row = self.random_row(self.db, "did")
+        if row is None:
+            raise KeyError("random_key(): store is empty")
+        return self.ukey(row[1])
+
+    def pop_random(self) -> Tuple[Hashable, dict]:
+        # Atomic, so workers in several processes can share one store as a queue
+        with self.transaction() as db:
+            row = self.random_row(db, "did, meta")
+            if row is None:
+                raise KeyError("pop_random(): store is empty")
+            db.execute("DELETE FROM items WHERE rid=?", (row[0],))
+        return self.ukey(row[1]), pickle.loads(row[2])
+
+    def clear(self):
+        with self.transaction() as db:
+            db.execute("DELETE FROM items")
+
+
+def test_meta_store():
+
+    import tempfile
+
+    fp = os.path.join(tempfile.mkdtemp(), "meta.db")
+    store = MetaStore(location=fp, page_size=3)
+
+    with store.transaction():
+        for i in range(10):
+            store["{:04d}".format(i)] = {"AccessionNumber": "{:04d}".format(i),
+                                         "PatientID": "p{}".format(i % 3),
+                                         "StudyDate": datetime.datetime(2018, 1, 1 + i)}
+        store[("0001", "AX")] = {"AccessionNumber": "0001", "SeriesDescription": "AX"}
+
+    assert len(store) == 11
+    assert ("0001", "AX") in store and "0001" in store and "9999" not in store
+    assert store["0003"]["StudyDate"] == datetime.datetime(2018, 1, 4)
+    assert sorted(k for k, m in store.find(PatientID="p1")) == ["0001", "0004", "0007"]
+    assert [k for k, m in store.between("StudyDate", datetime.date(2018, 1, 2),
+                                        datetime.date(2018, 1, 3))] == ["0001", "0002"]
+
+    # Updates replace the meta and its indexed columns
+    store["0004"] = {"AccessionNumber": "0004", "PatientID": "p9"}
+    assert [k for k, m in store.find(PatientID="p9")] == ["0004"]
+    assert len(store) == 11
+
+    # A failed transaction leaves nothing behind
+    try:
+        with store.transaction():
+            del store["0005"]
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert "0005" in store
+
+    # Persists, and pops every item exactly once
+    again = MetaStore(location=fp)
+    assert len(list(again.items())) == 11
+    popped = set()
+    while len(again):
+        key, meta = again.pop_random()
+        assert key not in popped
+        popped.add(key)
+    assert len(popped) == 11 and len(store) == 0
@@ -2,9 +2,12 @@
 Generic Multi-processing Event Routing Framework
 
 - Enumerate EventTypes
-- Watched sources should implement the ObservableMixin.changes() interface and return a list of tuples (type, data)
+- Watched sources should implement the ObservableMixin.changes() interface and return a list
+  (or yield a sequence) of tuples (type, data)
 - Configure a routing table as in the example, use functools.partial for complex handlers with multiple arguments.
-- Call the Watcher with "run"
+- Call the Watcher with "run", and "stop" to shut it down from a handler or another thread
+- All sources put their events on the Watcher's one queue, so it blocks until an event
+  arrives and dispatches it at once, rather than checking each source's queue in turn
 
 """
 
@@ -24,6 +27,7 @@ class Event(object):
     event_data = attr.ib()
     event_source = attr.ib( default=None )  # Cannot pass these through mp queue, have to addend them later
     event_count = attr.ib( type=int, default=None )
+    event_source_key = attr.ib( type=int, default=None )   # Index of the source in its Watcher
     event_uid = attr.ib( init=False, factory=uuid.uuid4 )
 
     def __str__(self):
@@ -40,6 +44,7 @@ class ObservableMixin(object):
     logger = attr.ib(factory=logging.getLogger)
     events = attr.ib(factory=Queue)
     polling_interval = attr.ib( default=1.0 )
+    watcher_key = attr.ib( init=False, default=None, repr=False )
 
     def changes(self) -> List[Tuple[Enum, Any]]:
         raise NotImplementedError
@@ -64,18 +69,21 @@ class ObservableMixin(object):
                     # self.logger.debug("Sleeping {} secs".format(self.polling_interval - (toc-tic).seconds))
                     time.sleep(self.polling_interval - (toc-tic).seconds)
 
-        p = Process(target=poll)
+        p = Process(target=poll, daemon=True)
         p.start()
+        return p
 
     def gen_event( self, event_type: Enum, event_data: Any=None ):
         self.event_count += 1
-        return Event(event_type=event_type, event_data=event_data, event_count=self.event_count)
+        return Event(event_type=event_type, event_data=event_data, event_count=self.event_count,
+                     event_source_key=self.watcher_key)
 
 
 @attr.s
 class Watcher(object):
     routes = attr.ib( factory=dict ) # form = { [source, event_type]: partial(func, args), ... }
     logger = attr.ib()
+    events = attr.ib( init=False, factory=Queue, repr=False )  # Shared by every source
 
     @logger.default
     def get_logger(self):
@@ -92,25 +100,102 @@ class Watcher(object):
         if func:
             return func(event)
 
-    def run(self):
-
+    def sources(self) -> List[ObservableMixin]:
         sources = []
-        route_keys = self.routes.keys()
-        for key in route_keys:
+        for key in self.routes.keys():
             if key[0] not in sources:
                 sources.append(key[0])
+        return sources
 
-        for source in sources:
-            source.poll_events()
+    def stop(self):
+        # Safe from a handler or another thread
+        self.events.put(None)
+
+    def run(self):
 
-        while True:
-            # self.logger.debug("Checking queues")
+        sources = self.sources()
+        pollers = []
+
+        # Sources are pointed at the shared queue before their pollers fork
+        for key, source in enumerate(sources):
+            source.events = self.events
+            source.watcher_key = key
+        try:
             for source in sources:
-                while not source.events.empty():
-                    event = source.events.get()
-                    event.event_source = source
-                    self.fire(event)
-            time.sleep(1)
+                pollers.append(source.poll_events())
+
+            while True:
+                event = self.events.get()
+                if event is None:
+                    break
+                event.event_source = sources[event.event_source_key]
+                self.fire(event)
+
+        finally:
+            self.logger.debug("Stopping {} pollers".format(len(pollers)))
+            for poller in pollers:
+                if hasattr(poller, "terminate"):
+                    poller.terminate()  # Polling process
+                elif hasattr(poller, "stop"):
+                    poller.stop()       # Watchdog observer thread
+            for poller in pollers:
+                if poller is not None:
+                    poller.join()
+
+
+class MockEventType(Enum):
+    # Module level, so events can be pickled through the queue
+    ADDED = 1
+
+
+@attr.s(hash=False)
+class CountingObserver(ObservableMixin):
+    # Emits `n` events of `event_type`, a batch at a time, with the time each
+    # was queued as its data
+    event_type = attr.ib( default=MockEventType.ADDED )
+    n = attr.ib( default=10 )
+    batch = attr.ib( default=1 )
+    sent = attr.ib( init=False, default=0 )
+
+    def changes(self):
+        if self.sent >= self.n:
+            return
+        k = min(self.batch, self.n - self.sent)
+        self.sent += k
+        return [(self.event_type, time.time()) for _ in range(k)]
+
+
+def test_watcher():
+
+    import threading
+
+    sources = [CountingObserver(n=5, polling_interval=0.1)
+               for _ in range(3)]
+    watcher = Watcher()
+    received = []
+
+    def handle(event):
+        received.append((event.event_source, time.time() - event.event_data))
+        if len(received) == 15:
+            watcher.stop()
+
+    watcher.routes = {(source, MockEventType.ADDED): handle for source in sources}
+
+    tic = time.time()
+    watcher.run()
+
+    # Every event reached its own source's route, well inside the old 1s tick,
+    # and the pollers were shut down with the watcher
+    assert sorted(sources.index(s) for s, latency in received) == sorted([0, 1, 2] * 5)
+    assert max(latency for s, latency in received) < 0.5
+    assert time.time() - tic < 2.0
+
+    # Stops while idle too
+    idle = CountingObserver(n=0)
+    watcher = Watcher(routes={(idle, MockEventType.ADDED): handle})
+    threading.Timer(0.2, watcher.stop).start()
+    watcher.run()
+
 
 if __name__ == "__main__":
 
@@ -1,7 +1,14 @@
+import csv
 from hashlib import sha1
+from itertools import islice, tee
+from multiprocessing import Pool
+from typing import Iterable, Iterator, Sequence
 
-def orthanc_hash(PatientID: str, StudyInstanceUID: str, SeriesInstanceUID=None, SOPInstanceUID=None) -> sha1:
-    if not SeriesInstanceUID:
+def orthanc_hash(PatientID: str, StudyInstanceUID: str=None, SeriesInstanceUID=None, SOPInstanceUID=None) -> sha1:
+    # Only None is a patient-level id, an empty study uid still hashes as "pid|"
+    if StudyInstanceUID is None:
+        s = PatientID
+    elif not SeriesInstanceUID:
         s = "|".join([PatientID, StudyInstanceUID])
     elif not SOPInstanceUID:
         s = "|".join([PatientID, StudyInstanceUID, SeriesInstanceUID])
@@ -10,7 +17,82 @@ def orthanc_hash(PatientID: str, StudyInstanceUID: str, SeriesInstanceUID=None,
     return sha1(s.encode("UTF8"))
 
 
-def orthanc_id(PatientID: str, StudyInstanceUID: str, SeriesInstanceUID=None, SOPInstanceUID=None) -> str:
+def orthanc_id(PatientID: str, StudyInstanceUID: str=None, SeriesInstanceUID=None, SOPInstanceUID=None) -> str:
     h = orthanc_hash(PatientID, StudyInstanceUID, SeriesInstanceUID, SOPInstanceUID)
     d = h.hexdigest()
     return '-'.join(d[i:i+8] for i in range(0, len(d), 8))
+
+
+def _orthanc_id_rows(rows: Sequence[Sequence[str]]) -> list:
+    return [orthanc_id(*row) for row in rows]
+
+
+def orthanc_ids(rows: Iterable[Sequence[str]], processes: int=None, chunksize: int=10000) -> Iterator[str]:
+    """
+    Orthanc ids for a column of (PatientID, StudyUID[, SeriesUID[, SOPUID]]) tuples,
+    in order.  With processes > 1, chunks of rows are hashed by a worker pool.  Rows
+    are read a round of chunks at a time, so a long stream is never held in memory.
+
+    >>> list(orthanc_ids([("abc", "1.2.3"), ("abc", "1.2.3", "1.2.3.4")]))
+    """
+
+    if not processes or processes < 2:
+        for row in rows:
+            yield orthanc_id(*row)
+        return
+
+    rows = iter(rows)
+    with Pool(processes) as pool:
+        while True:
+            chunks = [list(islice(rows, chunksize)) for _ in range(processes)]
+            chunks = [c for c in chunks if c]
+            if not chunks:
+                break
+            for ids in pool.map(_orthanc_id_rows, chunks):
+                yield from ids
+
+
+def orthanc_ids_for_csv(fp_in: str, fp_out: str,
+                        columns: Sequence[str]=("PatientID", "StudyInstanceUID",
+                                                "SeriesInstanceUID", "SOPInstanceUID"),
+                        key: str="oid", processes: int=None, chunksize: int=10000):
+    # Copies a csv inventory, adding an oid column from whichever id columns it has.
+    # Rows are streamed, so the file never has to fit in memory.
+
+    with open(fp_in, newline="") as f_in, open(fp_out, "w", newline="") as f_out:
+        reader = csv.DictReader(f_in)
+        columns = [c for c in columns if c in reader.fieldnames]
+        writer = csv.DictWriter(f_out, fieldnames=reader.fieldnames + [key])
+        writer.writeheader()
+
+        # The ids run up to a round of chunks ahead, tee holds the rows in between
+        rows, keyed = tee(reader)
+        ids = orthanc_ids((tuple(r[c] for c in columns) for r in keyed), processes, chunksize)
+        for r, oid in zip(rows, ids):
+            r[key] = oid
+            writer.writerow(r)
+
+
+def test_orthanc_ids():
+
+    import tempfile, os
+
+    rows = [("abc", "1.2.{}".format(i), "1.2.{}.1".format(i)) for i in range(1000)]
+    expected = [orthanc_id(*r) for r in rows]
+    assert list(orthanc_ids(rows)) == expected
+    assert list(orthanc_ids(iter(rows), processes=2, chunksize=64)) == expected
+
+    # Patient ids hash the PatientID alone, an empty study column is not a patient id
+    assert orthanc_id("abc") == "-".join(sha1(b"abc").hexdigest()[i:i+8] for i in range(0, 40, 8))
+    assert orthanc_id("abc", "") == "-".join(sha1(b"abc|").hexdigest()[i:i+8] for i in range(0, 40, 8))
+
+    d = tempfile.mkdtemp()
+    fp_in, fp_out = os.path.join(d, "in.csv"), os.path.join(d, "out.csv")
+    with open(fp_in, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["PatientID", "StudyInstanceUID", "SeriesInstanceUID", "Note"])
+        w.writerows([r + ("x",) for r in rows])
+
+    orthanc_ids_for_csv(fp_in, fp_out, processes=2, chunksize=100)
+    with open(fp_out, newline="") as f:
+        assert [r["oid"] for r in csv.DictReader(f)] == expected
@@ -1,8 +1,14 @@
-import uuid, logging, socket
+import uuid, logging, socket, functools
 import attr
 import inspect
 
 
+@functools.lru_cache()
+def process_hostname():
+    # Looked up once, not per instance
+    return socket.gethostname()
+
+
 @attr.s(cmp=False, hash=None)
 class Pattern(object):
     uid = attr.ib(factory=uuid.uuid4)
@@ -15,7 +21,7 @@ class Pattern(object):
 
     @hostname.default
     def get_hostname(self):
-        return socket.gethostname()
+        return process_hostname()
 
     def __hash__(self):
         return hash(self.uid)
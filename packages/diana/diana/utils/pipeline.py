@@ -0,0 +1,166 @@
+"""
+Staged pipeline: each stage has its own worker threads and a bounded input
+queue, so slow, latency-bound steps (C-MOVEs, anonymization, downloads)
+overlap instead of running one item at a time end-to-end.
+
+A stage function takes an item and returns the item for the next stage, or
+None to drop it.  Exceptions drop the item too, after `on_error`.  Bounded
+queues mean the feeder and the early stages only run `maxsize` items ahead of
+the stages behind them.
+
+>>> p = Pipeline([Stage("retrieve", retrieve, workers=4),
+...               Stage("download", download, workers=2),
+...               Stage("put", put)])
+>>> p.run(worklist)
+{'retrieve': {'done': 20000, 'dropped': 12, 'failed': 3, 'busy': 5321.2}, ...}
+"""
+
+import logging, threading, time
+from queue import Queue
+from typing import Callable, Iterable, List, Mapping
+import attr
+
+
+STOP = object()
+
+
+@attr.s
+class Stage(object):
+    name = attr.ib()
+    func = attr.ib( type=Callable )
+    workers = attr.ib( default=1 )
+    maxsize = attr.ib( default=4 )      # Items waiting for this stage
+
+    done = attr.ib( init=False, default=0 )
+    dropped = attr.ib( init=False, default=0 )
+    failed = attr.ib( init=False, default=0 )
+    busy = attr.ib( init=False, default=0.0 )    # Worker secs spent in func
+
+    def stats(self) -> Mapping:
+        return {"done": self.done, "dropped": self.dropped,
+                "failed": self.failed, "busy": self.busy}
+
+
+@attr.s
+class Pipeline(object):
+    stages = attr.ib( type=List[Stage] )
+    on_error = attr.ib( default=None )  # f(stage name, item, exception)
+
+    lock = attr.ib( init=False, factory=threading.Lock, repr=False )
+    logger = attr.ib( init=False, repr=False )
+
+    @logger.default
+    def get_logger(self):
+        return logging.getLogger(__name__)
+
+    def work(self, i: int, queues: List[Queue], remaining: List[int]):
+        stage = self.stages[i]
+        inbox = queues[i]
+        outbox = queues[i + 1] if i + 1 < len(self.stages) else None
+
+        while True:
+            item = inbox.get()
+            if item is STOP:
+                break
+
+            tic = time.time()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                result = None
+                with self.lock:
+                    stage.failed += 1
+                self.logger.warning("{} failed for {} ({})".format(stage.name, item, e))
+                if self.on_error:
+                    self.on_error(stage.name, item, e)
+            else:
+                with self.lock:
+                    if result is None:
+                        stage.dropped += 1
+                    else:
+                        stage.done += 1
+            finally:
+                with self.lock:
+                    stage.busy += time.time() - tic
+
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+        # The last worker out tells the next stage's workers to stop
+        with self.lock:
+            remaining[i] -= 1
+            last = remaining[i] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[i + 1].workers):
+                outbox.put(STOP)
+
+    def run(self, items: Iterable) -> Mapping[str, Mapping]:
+
+        queues = [Queue(maxsize=s.maxsize) for s in self.stages]
+        remaining = [s.workers for s in self.stages]
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                t = threading.Thread(target=self.work, args=(i, queues, remaining),
+                                     name="{}-{}".format(stage.name, n), daemon=True)
+                t.start()
+                threads.append(t)
+
+        try:
+            for item in items:
+                # Blocks while the first stage is `maxsize` items ahead
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(STOP)
+            for t in threads:
+                t.join()
+
+        return self.stats()
+
+    def stats(self) -> Mapping[str, Mapping]:
+        return {s.name: s.stats() for s in self.stages}
+
+
+def test_pipeline():
+
+    seen = []
+    in_flight = {"now": 0, "max": 0}
+    lock = threading.Lock()
+    overlapped = threading.Event()
+
+    def slow_double(x):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            if in_flight["now"] > 1:
+                overlapped.set()
+        # Hold on until a second worker joins, however slow the machine
+        overlapped.wait(1.0)
+        with lock:
+            in_flight["now"] -= 1
+        return x * 2
+
+    def drop_odd_quarters(x):
+        if x % 4:
+            return None
+        if x == 8:
+            raise ValueError("bad item")
+        return x
+
+    errors = []
+    p = Pipeline([Stage("double", slow_double, workers=8, maxsize=2),
+                  Stage("filter", drop_odd_quarters, workers=2),
+                  Stage("collect", seen.append)],
+                 on_error=lambda stage, item, e: errors.append((stage, item)))
+
+    stats = p.run(range(100))
+
+    # Doubling ran on several workers at once, never more than 8
+    assert 1 < in_flight["max"] <= 8
+    assert sorted(seen) == [x for x in range(0, 200, 4) if x != 8]
+    assert errors == [("filter", 8)]
+    assert stats["double"]["done"] == 100
+    assert stats["filter"] == dict(stats["filter"], done=49, dropped=50, failed=1)
+    # `append` returns None, so the last stage drops everything
+    assert stats["collect"]["dropped"] == 49
@@ -0,0 +1,80 @@
+"""
+Dixel footprint benchmark
+Merck, Fall 2018
+
+Creates 1M study-level dixels from find-style answers (fresh dicts, as if each
+came out of a separate JSON page) and reports, in a fresh process per run:
+
+- creation time, from answers that are already parsed
+- the RSS added by holding the dixels, parsing answers as they arrive
+
+$ python3 tests/benchmarks/bench_dixel.py [n]
+"""
+
+import logging, time, sys, json
+from multiprocessing import Process, Queue
+from diana.apis import Dixel, CompactDixel
+from diana.utils.dicom import DicomLevel
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * 4096 / 1024 / 1024
+
+
+def answers(n):
+    # Separate json.loads calls, so keys aren't shared between answers
+    for i in range(n):
+        yield json.loads(json.dumps(
+            {"PatientID": "{:08d}".format(i % 99999),
+             "PatientName": "PATIENT^{}".format(i % 99999),
+             "StudyInstanceUID": "1.2.826.0.1.3680043.2.{}".format(i),
+             "AccessionNumber": "{:08d}".format(i),
+             "StudyDate": "20180101",
+             "StudyDescription": "CT CHEST WITH CONTRAST"}))
+
+
+def create(cls, n, results: Queue):
+    # Time creation alone, from answers that are already parsed
+    metas = list(answers(n))
+    tic = time.time()
+    dixels = [cls(meta=m, level=DicomLevel.STUDIES) for m in metas]
+    results.put((time.time() - tic, len(dixels)))
+
+
+def footprint(cls, n, results: Queue):
+    # RSS added by holding n dixels, parsing answers as they arrive
+    before = rss_mb()
+    dixels = [cls(meta=m, level=DicomLevel.STUDIES) for m in answers(n)]
+    results.put(rss_mb() - before)
+
+
+def in_process(func, *args):
+    q = Queue()
+    p = Process(target=func, args=args + (q,))
+    p.start()
+    result = q.get()
+    p.join()
+    return result
+
+
+def bench(n=1000000):
+
+    results = {}
+    for cls in (Dixel, CompactDixel):
+        elapsed, count = in_process(create, cls, n)
+        assert count == n
+        results[cls.__name__] = (elapsed, in_process(footprint, cls, n))
+
+    logging.info("{} study dixels".format(n))
+    for name, (elapsed, mb) in results.items():
+        logging.info("  {:14} create: {:6.2f}s  rss: {:7.1f} MB".format(name, elapsed, mb))
+    return results
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    bench(n)
@@ -0,0 +1,59 @@
+"""
+Sharded porter benchmark
+Merck, Fall 2018
+
+Times one shared worklist pulled by 1, 2 and 4 porter processes, each with its
+own stand-in proxy (the latency-only stand-ins from bench_porter), leasing
+items from one sqlite lease queue.
+
+$ python3 tests/benchmarks/bench_leases.py [studies]
+"""
+
+import logging, time, sys, os, tempfile
+from multiprocessing import Process
+from diana.daemon.porter import Porter
+from diana.utils import LeaseQueue
+from bench_porter import LatentProxy, LatentFiles, worklist
+
+
+def work(fp, owner):
+    porter = Porter(source=LatentProxy(), proxy_domain="pacs", dest=LatentFiles(),
+                    spool=tempfile.mkdtemp(), progress_every=1000000)
+    porter.run_leased(LeaseQueue(location=fp), owner)
+
+
+def bench(n=1000, workers=(1, 2, 4)):
+
+    logging.info("{} studies".format(n))
+    results = {}
+    for w in workers:
+        fp = os.path.join(tempfile.mkdtemp(), "pull.leases")
+        queue = LeaseQueue(location=fp)
+        Porter(source=None, proxy_domain="pacs").share(worklist(n), queue)
+
+        tic = time.time()
+        procs = [Process(target=work, args=(fp, "proxy{}".format(i))) for i in range(w)]
+        for p in procs:
+            p.start()
+        # Until the last item is done; idle porters then linger for up to
+        # `lease_poll_interval` in case another's leases run out
+        while queue.pending():
+            time.sleep(0.01)
+        secs = time.time() - tic
+        for p in procs:
+            p.join()
+
+        assert queue.counts() == {"done": n}
+        results[w] = secs
+        shares = sorted(queue.owners().values())
+        logging.info("  {} porters {:8.3f}s {:8.1f} studies/s  (per porter {})".format(
+            w, secs, n / secs, shares))
+
+    return results
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bench(n)
@@ -0,0 +1,86 @@
+"""
+MetaCache backend benchmark
+Merck, Fall 2018
+
+Fills a MetaCache with n Montage-like study rows, in memory and in the sqlite
+store, and reports (in a fresh process each) the fill time, the RSS added,
+the time for a lookup by PatientID and the time per select_random(remove=True).
+
+$ python3 tests/benchmarks/bench_meta_cache.py [n]
+"""
+
+import logging, time, sys, os, tempfile, datetime
+from multiprocessing import Process, Queue
+from diana.apis import MetaCache
+from diana.utils.dicom import DicomLevel
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * 4096 / 1024 / 1024
+
+
+def rows(n):
+    for i in range(n):
+        yield {"AccessionNumber": "{:09d}".format(i),
+               "PatientID": "{:08d}".format(i % 500000),
+               "PatientFirstName": "FIRST{}".format(i % 1000),
+               "PatientLastName": "LAST{}".format(i % 7000),
+               "PatientSex": "MF"[i % 2],
+               "PatientAge": str(i % 90),
+               "StudyDate": datetime.datetime(2018, 1, 1) + datetime.timedelta(days=i % 365),
+               "OrderCode": "CT{}".format(i % 300),
+               "StudyDescription": "CT CHEST WITH CONTRAST",
+               "ReferringPhysicianName": "DOCTOR^{}".format(i % 500),
+               "_report": "Findings: none. " * 20,
+               "_level": DicomLevel.STUDIES}
+
+
+def run(store, n, results: Queue):
+    before = rss_mb()
+    m = MetaCache(store=store)
+
+    tic = time.time()
+    with m.transaction():
+        for meta in rows(n):
+            m.cache[m.did(meta)] = meta
+    fill = time.time() - tic
+    mb = rss_mb() - before
+
+    tic = time.time()
+    found = list(m.find(PatientID="{:08d}".format(12345)))
+    lookup = time.time() - tic
+
+    tic = time.time()
+    for i in range(100):
+        m.select_random()
+    pop = (time.time() - tic) / 100
+
+    results.put((fill, mb, lookup, pop, len(found)))
+
+
+def bench(n=1000000):
+
+    fp = os.path.join(tempfile.mkdtemp(), "bench.db")
+    results = {}
+    for name, store in (("dict", None), ("sqlite store", fp)):
+        q = Queue()
+        p = Process(target=run, args=(store, n, q))
+        p.start()
+        results[name] = q.get()
+        p.join()
+
+    logging.info("{} studies".format(n))
+    for name, (fill, mb, lookup, pop, found) in results.items():
+        logging.info("  {:14} fill: {:6.1f}s  rss: {:7.1f} MB  find: {:8.4f}s ({})  "
+                     "select_random: {:8.5f}s".format(name, fill, mb, lookup, found, pop))
+    logging.info("  sqlite file: {:.1f} MB".format(os.path.getsize(fp) / 1024 / 1024))
+    return results
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    bench(n)
@@ -0,0 +1,84 @@
+"""
+MetaCache csv load benchmark
+Merck, Fall 2018
+
+Writes a Montage-style export with n rows and times loading it with:
+
+- the old row-by-row loader (DictReader, dateutil on every date), on the first 100k rows only
+- MetaCache.load, with per-column date formats, memoized dates and column-wise remapping
+- MetaCache.iter_load, which walks the file in chunks without keeping it
+
+$ python3 tests/benchmarks/bench_meta_cache_load.py [n]
+"""
+
+import logging, time, sys, os, csv, tempfile
+from csv import DictReader
+from dateutil import parser as dtparser
+from diana.apis import MetaCache
+from diana.utils.dicom import DicomLevel
+
+
+def write_export(fp, n):
+    with open(fp, "w", newline="", encoding="cp1252") as f:
+        w = csv.writer(f)
+        w.writerow(["Accession Number", "Patient MRN", "Patient First Name", "Patient Last Name",
+                    "Patient Sex", "Patient Age", "Exam Completed Date", "Organization",
+                    "Exam Code", "Exam Description", "Patient Status", "Ordered By", "Report Text"])
+        for i in range(n):
+            w.writerow(["{:09d}".format(i), "{:08d}".format(i % 500000), "FIRST", "LAST",
+                        "MF"[i % 2], str(i % 90),
+                        "{}/{}/2018 {}:{:02d}".format(i % 12 + 1, i % 28 + 1, i % 24, i % 60),
+                        "HOSPITAL", "CT{}".format(i % 300), "CT CHEST", "Outpatient",
+                        "DOCTOR", "Findings: none."])
+
+
+def old_load(fp, keymap, limit):
+    # As MetaCache.load used to do it
+    cache = {}
+    with open(fp, encoding="cp1252") as f:
+        for n, item in enumerate(DictReader(f)):
+            if n >= limit:
+                break
+            item = {v: item.get(k) for k, v in keymap.items() if item.get(k)}
+            item["_level"] = DicomLevel.STUDIES
+            for k, v in item.items():
+                if v and (k.lower().find("date") >= 0 or k.lower().find("dob") >= 0):
+                    item[k] = dtparser.parse(v)
+            cache[item["AccessionNumber"]] = item
+    return cache
+
+
+def bench(n=2000000, old_max=100000):
+
+    fp = os.path.join(tempfile.mkdtemp(), "montage.csv")
+    write_export(fp, n)
+    keymap = MetaCache.montage_keymap
+
+    results = {}
+
+    tic = time.time()
+    old = old_load(fp, keymap, min(n, old_max))
+    results["old loader ({} rows)".format(len(old))] = time.time() - tic
+
+    m = MetaCache(location=fp)
+    tic = time.time()
+    m.load(keymap=keymap)
+    results["load"] = time.time() - tic
+    assert len(m) == n
+
+    tic = time.time()
+    count = sum(len(chunk) for chunk in m.iter_load(keymap=keymap))
+    results["iter_load (dixels)"] = time.time() - tic
+    assert count == n
+
+    logging.info("{} rows".format(n))
+    for mode, secs in results.items():
+        logging.info("  {:28} {:7.2f}s".format(mode, secs))
+    return results
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    bench(n)
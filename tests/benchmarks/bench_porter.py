@@ -0,0 +1,94 @@
+"""
+Porter pipeline benchmark
+Merck, Fall 2018
+
+Times pulling a worklist of studies through a stand-in proxy whose calls only
+wait, ie, a latency-bound PACS pull, with a journal as in production.
+
+- `run`, one study end-to-end at a time
+- `run_pipelined` with the default stage workers, and with more retrievers
+
+Latencies are scaled down from a typical CT pull (C-MOVE ~20s, anonymize ~5s,
+archive download ~10s, put ~2s, remove ~0.5s) by 1000x.
+
+$ python3 tests/benchmarks/bench_porter.py [studies]
+"""
+
+import logging, time, sys, os, tempfile
+from diana.apis import Dixel
+from diana.daemon.porter import Porter
+from diana.utils import ProgressJournal
+from diana.utils.dicom import DicomLevel
+
+LATENCY = {"retrieve": 0.020, "anonymize": 0.005, "download": 0.010,
+           "put": 0.002, "remove": 0.0005}
+
+
+class LatentProxy(object):
+
+    def find_item(self, d, domain, retrieve):
+        time.sleep(LATENCY["retrieve"])
+        d.meta["PatientID"] = "p" + d.meta["AccessionNumber"]
+        return d
+
+    def anonymize(self, d):
+        time.sleep(LATENCY["anonymize"])
+        return Dixel(meta={"oid": "sham-" + d.meta["AccessionNumber"],
+                           "AccessionNumber": d.meta["AccessionNumber"]}, level=d.level)
+
+    def get(self, e, view, stream):
+        time.sleep(LATENCY["download"])
+        e.file = [b"x" * 65536] * 16
+        return e
+
+    def remove(self, d):
+        time.sleep(LATENCY["remove"])
+
+
+class LatentFiles(object):
+
+    def check(self, d, **kwargs):
+        return False
+
+    def put(self, e, **kwargs):
+        time.sleep(LATENCY["put"])
+
+
+def worklist(n):
+    return [Dixel(meta={"AccessionNumber": "{:06d}".format(i), "ShamAccession": "s{}".format(i),
+                        "StudyInstanceUID": "1.2.{}".format(i)}, level=DicomLevel.STUDIES)
+            for i in range(n)]
+
+
+def bench(n=1000):
+
+    end_to_end = sum(LATENCY.values()) + LATENCY["remove"]
+    logging.info("{} studies, {:.1f}ms per study end-to-end".format(n, end_to_end * 1000))
+
+    spool = tempfile.mkdtemp()
+    modes = [("run", "run", {}),
+             ("run_pipelined", "run_pipelined", {}),
+             ("run_pipelined x8 retrieve", "run_pipelined", {"retrieve": 8, "anonymize": 4,
+                                                             "download": 4})]
+    results = {}
+    for name, method, workers in modes:
+        journal = ProgressJournal(location=os.path.join(spool, name + ".journal"))
+        porter = Porter(source=LatentProxy(), proxy_domain="pacs", dest=LatentFiles(),
+                        journal=journal, spool=spool, stage_workers=workers,
+                        progress_every=n + 1)
+        items = worklist(n)
+        tic = time.time()
+        getattr(porter, method)(items)
+        secs = time.time() - tic
+        assert journal.counts() == {"cleaned": n}
+        results[name] = secs
+        logging.info("  {:28} {:8.3f}s {:8.1f} studies/s".format(name, secs, n / secs))
+
+    return results
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bench(n)
@@ -0,0 +1,77 @@
+"""
+Requester connection reuse benchmark
+Merck, Fall 2018
+
+Times a burst of small GETs against a local keep-alive stand-in for Orthanc,
+once with a fresh connection per call (the old module-level `requests.get`)
+and once through the pooled `Requester` session.
+
+$ python3 tests/benchmarks/bench_requester.py
+"""
+
+import logging, json, threading, time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import requests
+from diana.utils.gateway import Orthanc
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # Keep-alive
+    wbufsize = -1                   # Send headers and body in one segment
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({"Version": "stand-in", "path": self.path}).encode("UTF8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stand_in(port=0):
+    server = ThreadingHTTPServer(("localhost", port), StandInHandler)
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+
+def bench(n=1000):
+
+    server = start_stand_in()
+    port = server.server_address[1]
+    url = "http://localhost:{}/system".format(port)
+
+    tic = time.time()
+    for i in range(n):
+        requests.get(url, auth=("orthanc", "orthanc")).json()
+    unpooled = time.time() - tic
+
+    gateway = Orthanc(host="localhost", port=port)
+    tic = time.time()
+    for i in range(n):
+        gateway.get("system")
+    pooled = time.time() - tic
+
+    server.shutdown()
+
+    logging.info("{} requests".format(n))
+    logging.info("  fresh connections: {:.3f}s ({:.2f} ms/req)".format(unpooled, 1000 * unpooled / n))
+    logging.info("  pooled session:    {:.3f}s ({:.2f} ms/req)".format(pooled, 1000 * pooled / n))
+    logging.info("  speedup:           {:.2f}x".format(unpooled / pooled))
+
+    return unpooled, pooled
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    bench()
@@ -0,0 +1,161 @@
+"""
+Splunk search retrieval benchmark
+Merck, Fall 2018
+
+Runs a search against a local stand-in for Splunk's REST API and reports the
+time to the first event and the total time for 10k, 100k and 1M events, for:
+
+- the old job workflow (fixed 1s polls, serial result pages)
+- the job workflow with adaptive polling and concurrent result pages
+- the streaming export endpoint
+
+The stand-in runs in its own (forking) process, takes `job_secs` to finish each search
+job, and adds `page_latency` plus `event_latency` per event to every results
+page, roughly as a busy search head would.
+
+$ python3 tests/benchmarks/bench_splunk.py [max events]
+"""
+
+import logging, json, time, sys
+from multiprocessing import Process, Queue
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ForkingMixIn
+from urllib.parse import urlparse, parse_qs
+from diana.utils.gateway import Splunk
+
+
+def stand_in_event(i):
+    return json.dumps({"AccessionNumber": "{:08d}".format(i),
+                       "PatientID": "{:08d}".format(i % 9999),
+                       "StudyDescription": "CT CHEST WITH CONTRAST",
+                       "level": "series"})
+
+
+class StandInSplunk(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    job_secs = 1.0
+    page_latency = 0.05      # Per page
+    event_latency = 0.00002  # Per event in a page, ie, 1s for a 50k page
+
+    def reply(self, body: bytes, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        n = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(n).decode("UTF8"))
+        count = int(form["search"][0].split("count=")[1].split()[0])
+
+        if self.path.endswith("/export"):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            block = []
+            for i in range(count):
+                block.append(json.dumps({"preview": False, "offset": i,
+                                         "result": {"_raw": stand_in_event(i)}}))
+                if len(block) == 1000 or i == count - 1:
+                    chunk = ("\n".join(block) + "\n").encode("UTF8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    block = []
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        # Requests are served by forked children, so the sid carries the job state
+        sid = "{}-{}".format(count, time.time())
+        self.reply("<response><sid>{}</sid></response>".format(sid).encode("UTF8"), "text/xml")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        count, started = url.path.split("/")[4].split("-")
+        count, started = int(count), float(started)
+
+        if url.path.endswith("/results"):
+            offset = int(params["offset"][0])
+            end = min(offset + int(params["count"][0]), count)
+            time.sleep(self.page_latency + self.event_latency * (end - offset))
+            results = [{"_raw": stand_in_event(i)} for i in range(offset, end)]
+            self.reply(json.dumps({"results": results}).encode("UTF8"))
+            return
+
+        elapsed = time.time() - started
+        progress = min(elapsed / self.job_secs, 1.0)
+        content = {"isDone": progress >= 1.0,
+                   "dispatchState": "DONE" if progress >= 1.0 else "RUNNING",
+                   "doneProgress": progress,
+                   "runDuration": elapsed,
+                   "resultCount": count}
+        self.reply(json.dumps({"entry": [{"content": content}]}).encode("UTF8"))
+
+    def log_message(self, *args):
+        pass
+
+
+class ForkingHTTPServer(ForkingMixIn, HTTPServer):
+    # A child per connection, so concurrent result pages really are served in parallel
+    pass
+
+
+def serve(port_queue: Queue):
+    server = ForkingHTTPServer(("localhost", 0), StandInSplunk)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_stand_in():
+    ports = Queue()
+    p = Process(target=serve, args=(ports,), daemon=True)
+    p.start()
+    return p, ports.get()
+
+
+def timed(events):
+    tic = time.time()
+    first = None
+    n = 0
+    for e in events:
+        if first is None:
+            first = time.time() - tic
+        n += 1
+    return first, time.time() - tic, n
+
+
+def bench(sizes=(10000, 100000, 1000000)):
+
+    p, port = start_stand_in()
+
+    legacy = Splunk(host="localhost", port=port, protocol="http",
+                    poll_min=1.0, poll_max=1.0, page_workers=1, first_page_size=None)
+    gateway = Splunk(host="localhost", port=port, protocol="http")
+
+    results = {}
+    for n in sizes:
+        q = "search index=bench count={}".format(n)
+        results[n] = {
+            "fixed poll, serial pages": timed(legacy.iter_job_events(q)),
+            "adaptive poll, concurrent pages": timed(gateway.iter_job_events(q)),
+            "export stream": timed(gateway.iter_events(q))
+        }
+
+        logging.info("{} events".format(n))
+        for mode, (first, total, count) in results[n].items():
+            assert count == n
+            logging.info("  {:32} first: {:6.3f}s  total: {:7.3f}s".format(mode, first, total))
+
+    p.terminate()
+    return results
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    max_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    bench( [n for n in (10000, 100000, 1000000) if n <= max_events] )
@@ -0,0 +1,86 @@
+"""
+Watcher dispatch benchmark
+Merck, Fall 2018
+
+Times event-to-handler latency and throughput for 10 mock sources, each
+polling in its own process.
+
+- the old dispatch loop, checking each source's queue in turn and then
+  sleeping for 1s
+- Watcher.run, blocking on the one queue shared by every source
+
+Latency: each source emits one event every 50ms.  Throughput: each source
+emits its events in batches of 1000, as fast as it can.
+
+$ python3 tests/benchmarks/bench_watcher.py [events per source]
+"""
+
+import logging, time, sys, statistics
+from diana.utils.observable import Watcher, CountingObserver, MockEventType
+
+
+def polling_run(watcher, done):
+    # As Watcher.run used to do it
+    sources = watcher.sources()
+    pollers = [source.poll_events() for source in sources]
+    while not done():
+        for source in sources:
+            while not source.events.empty():
+                event = source.events.get()
+                event.event_source = source
+                watcher.fire(event)
+        time.sleep(1)
+    for p in pollers:
+        p.terminate()
+        p.join()
+
+
+def trial(mode, sources, total):
+
+    watcher = Watcher()
+    latencies = []
+
+    def handle(event):
+        latencies.append(time.time() - event.event_data)
+        if len(latencies) == total:
+            watcher.stop()
+
+    watcher.routes = {(source, MockEventType.ADDED): handle for source in sources}
+
+    tic = time.time()
+    if mode == "polling":
+        polling_run(watcher, lambda: len(latencies) >= total)
+    else:
+        watcher.run()
+    return time.time() - tic, latencies
+
+
+def bench(n=100, n_sources=10):
+
+    results = {}
+    for mode in ("polling", "shared queue"):
+
+        sources = [CountingObserver(n=min(n, 40), polling_interval=0.05) for _ in range(n_sources)]
+        secs, latencies = trial(mode, sources, len(sources) * min(n, 40))
+        latencies.sort()
+        r = {"mean latency": statistics.mean(latencies),
+             "p99 latency": latencies[int(len(latencies) * 0.99) - 1],
+             "max latency": latencies[-1]}
+
+        sources = [CountingObserver(n=n, batch=1000, polling_interval=0) for _ in range(n_sources)]
+        secs, latencies = trial(mode, sources, len(sources) * n)
+        r["events/s"] = len(latencies) / secs
+
+        results[mode] = r
+        logging.info("{} ({} sources)".format(mode, n_sources))
+        for k, v in r.items():
+            logging.info("  {:14} {:10.4f}{}".format(k, v, "s" if "latency" in k else ""))
+
+    return results
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    bench(n)
@@ -0,0 +1,72 @@
+"""
+Worklist diff benchmark
+Merck, Fall 2018
+
+Times finding the new items in a harvester window, ie, the recent items whose
+accession numbers aren't indexed yet, with half of the window already indexed.
+
+- the old nested comprehension, only at small sizes since it is O(n*m)
+- Worklist difference, intersection and join, at 10k, 100k and 1M items
+
+$ python3 tests/benchmarks/bench_worklist.py [max items]
+"""
+
+import logging, time, sys
+from diana.apis import Dixel
+from diana.apis.worklist import Worklist, ACCESSION, SERIES
+from diana.utils.dicom import DicomLevel
+
+
+def window(n, offset=0):
+    return [Dixel(meta={"AccessionNumber": "{:08d}".format(i),
+                        "StudyInstanceUID": "1.2.{}".format(i),
+                        "SeriesInstanceUID": "1.2.{}.1".format(i)},
+                  level=DicomLevel.SERIES)
+            for i in range(offset, offset + n)]
+
+
+def nested_difference(recent, indexed):
+    # As Harvester.collect used to do it
+    return [x for x in recent if x.meta["AccessionNumber"] not in
+            [y.meta["AccessionNumber"] for y in indexed]]
+
+
+def timed(func, *args):
+    tic = time.time()
+    result = func(*args)
+    return time.time() - tic, result
+
+
+def bench(sizes=(10000, 100000, 1000000), nested_max=10000):
+
+    results = {}
+    for n in sizes:
+        recent = window(n)
+        indexed = window(n, offset=n // 2)
+
+        r = {}
+        if n <= nested_max:
+            r["nested comprehension"], new = timed(nested_difference, recent, indexed)
+            assert len(new) == n // 2
+        r["index window"], w = timed(Worklist, recent, ACCESSION)
+        r["difference"], new = timed(w.difference, indexed)
+        assert len(new) == n // 2
+        r["intersection"], both = timed(w.intersection, indexed)
+        assert len(both) == n - n // 2
+        by_series = w.reindex(SERIES)
+        r["join by series"], pairs = timed(lambda: list(by_series.join(indexed)))
+        assert len(pairs) == n - n // 2
+
+        results[n] = r
+        logging.info("{} items".format(n))
+        for mode, secs in r.items():
+            logging.info("  {:24} {:8.3f}s".format(mode, secs))
+
+    return results
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    max_items = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    bench( [n for n in (10000, 100000, 1000000) if n <= max_items] )
@@ -2,10 +2,62 @@
 import logging
 from diana.utils.dtinterval import test_timerange
 from diana.utils.dicom.dicom_simplify import test_simplify
+from diana.utils.cache import test_tiered_cache, test_interval_cache
+from diana.utils.keyset import test_keyset
+from diana.utils.meta_store import test_meta_store
+from diana.utils.journal import test_progress_journal
+from diana.apis.worklist import test_worklist
+from diana.apis.meta_cache import test_meta_cache_load
+from diana.daemon.porter import test_porter_journal, test_porter_pipeline, test_porter_leases, \
+    test_porter_async, test_porter_jobs
+from diana.utils.pipeline import test_pipeline
+from diana.utils.leases import test_lease_queue
+from diana.utils.observable import test_watcher
+from diana.apis.orthanc import test_orthanc_find, test_orthanc_tag_cache, test_send_batch, \
+    test_orthanc_clear
+from diana.apis.orthanc_meta_extras import test_orthanc_metadata
+from diana.utils.gateway.orthanc import test_find_iter, test_async_find
+from diana.utils.gateway.async_requester import test_semaphores
+from diana.utils.gateway.splunk import test_hec_buffer, test_iter_events
+from diana.utils.gateway.file_handler import test_dicom_file_write
+from diana.apis.splunk import test_find_items_cache
+from diana.apis.dixel import test_compact_dixel, test_oid_memo, test_lazy_meta
+from diana.utils.orthanc_id import test_orthanc_ids
 
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
     test_timerange()
     test_simplify()
+    test_tiered_cache()
+    test_interval_cache()
+    test_keyset()
+    test_meta_store()
+    test_progress_journal()
+    test_worklist()
+    test_meta_cache_load()
+    test_porter_journal()
+    test_porter_pipeline()
+    test_pipeline()
+    test_lease_queue()
+    test_porter_leases()
+    test_porter_async()
+    test_porter_jobs()
+    test_watcher()
+    test_orthanc_find()
+    test_orthanc_tag_cache()
+    test_send_batch()
+    test_orthanc_clear()
+    test_orthanc_metadata()
+    test_find_iter()
+    test_async_find()
+    test_semaphores()
+    test_hec_buffer()
+    test_iter_events()
+    test_dicom_file_write()
+    test_find_items_cache()
+    test_compact_dixel()
+    test_oid_memo()
+    test_lazy_meta()
+    test_orthanc_ids()
 